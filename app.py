@@ -2,7 +2,7 @@ import sys
 
 sys.path.append("./server/")
 
-from flask import Flask, send_from_directory
+from flask import Flask, request, send_from_directory
 from flask_sock import Server, Sock
 
 import protocol
@@ -21,9 +21,15 @@ def public(path):
     return send_from_directory("public", path)
 
 
+@app.route('/metrics')
+def metrics():
+    return net.outboxMetrics()
+
+
 @sock.route('/stream')
 def socket(sock: Server):
-    net.addConnection(sock)
+    # clients ask for the binary encoding with ?format=binary, and otherwise get JSON
+    net.addConnection(sock, request.args.get("format") == "binary")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,38 @@
+import sys
+
+sys.path.append("./server/")
+
+from argparse import ArgumentParser
+
+from aiohttp import web
+
+import asyncnet
+import net
+
+# Serves the same pages and /stream endpoint as app.py, on asyncio instead of a thread per connection, for when a process
+# has to hold many connections at once. Run from the repository root with `python asyncapp.py --help`.
+
+
+async def index(request: web.Request):
+    return web.FileResponse("public/index.html")
+
+
+async def metrics(request: web.Request):
+    return web.json_response(net.outboxMetrics())
+
+
+def makeApp():
+    app = web.Application()
+    app.router.add_get("/stream", asyncnet.stream)
+    app.router.add_get("/metrics", metrics)
+    app.router.add_get("/", index)
+    app.router.add_static("/", "public")
+    return app
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Runs the server on asyncio.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    args = parser.parse_args()
+    web.run_app(makeApp(), host=args.host, port=args.port)
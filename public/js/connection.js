@@ -1,5 +1,6 @@
 import { id, setState, state } from "./index.js"
 import * as ui from "./ui.js"
+import * as wire from "./wire.js"
 
 /**
  * @param {GameEvent} event
@@ -18,6 +19,9 @@ export function handleEvent(event) {
         case "start":
             ui.resetBoard(event)
             break
+        case "sync":
+            ui.syncBoard(event)
+            break
         case "turn":
             if (state.type !== "game") return
             state.board.turn = {
@@ -40,10 +44,12 @@ export function handleEvent(event) {
             break
         case "redeck":
             if (state.type !== "game") return
-            if (event.new_card_ids.length != state.board.discard.length) throw Error("Invalid number of cards")
-            state.board.deck = event.new_card_ids.map(id => ({ id }))
+            if (event.count != state.board.discard.length) throw Error("Invalid number of cards")
+            // the new IDs are made from the nonce, from the bottom of the deck up
+            let newCardIDs = Array.from({ length: event.count }, (_, i) => `${event.nonce}-${i}`)
+            state.board.deck = newCardIDs.map(id => ({ id }))
             for (let oldCard of state.board.discard) {
-                let newID = event.new_card_ids.shift()
+                let newID = newCardIDs.shift()
                 let cardElement = id(`card-${oldCard.id}`)
                 cardElement.id = `card-${newID}`
                 cardElement.dataset.id = newID
@@ -51,6 +57,15 @@ export function handleEvent(event) {
             state.board.discard = []
             ui.updateBoardState()
             break
+        case "error":
+            console.warn(`The server rejected a ${event.action} action: ${event.code}`)
+            break
+        case "batch":
+            // a whole deal, or every meld and lay of a turn, applied as one step
+            for (let batched of event.events) {
+                handleEvent(batched)
+            }
+            break
         case "end":
             if (state.type !== "game") return
             if (event.winner_id) {
@@ -90,6 +105,9 @@ function handleNextEvent() {
     if (event.type == "move" && state.type == "game" && !state.board.turn) {
         // use a shorter delay for dealing
         eventQueueTimer = setTimeout(handleNextEvent, 600 / state.board.players.length)
+    } else if (event.type == "batch") {
+        // wait as long as the slowest event in the batch would have
+        eventQueueTimer = setTimeout(handleNextEvent, Math.max(0, ...event.events.map(batched => eventDelays[batched.type] || 0)))
     } else {
         eventQueueTimer = setTimeout(handleNextEvent, eventDelays[event.type] || 0)
     }
@@ -99,8 +117,8 @@ function handleNextEvent() {
  * @param {GameEvent} event
  */
 function queueEvent(event) {
-    if (event.type === "ping") {
-        // ping events are handled immediately
+    if (event.type === "ping" || event.type === "error") {
+        // ping and error events are handled immediately, since they don't change the board
         handleEvent(event)
         return
     }
@@ -112,10 +130,21 @@ function queueEvent(event) {
 
 /** @type {WebSocket} */
 let ws = null
+// opening the page with ?format=binary asks the server for the binary encoding (see wire.js) instead of JSON
+const binary = new URLSearchParams(location.search).get("format") === "binary"
 
 export function init() {
-    ws = new WebSocket(`${location.protocol.replace("http", "ws")}//${location.host}/stream`)
-    ws.onmessage = d => queueEvent(JSON.parse(d.data))
+    ws = new WebSocket(`${location.protocol.replace("http", "ws")}//${location.host}/stream${binary ? "?format=binary" : ""}`)
+    ws.binaryType = "arraybuffer"
+    ws.onmessage = d => {
+        let message = d.data instanceof ArrayBuffer ? wire.decode(d.data) : JSON.parse(d.data)
+        // the server may send several events in one message, which are handled as if they had arrived one at a time
+        if (Array.isArray(message)) {
+            for (let event of message) queueEvent(event)
+        } else {
+            queueEvent(message)
+        }
+    }
     ws.onclose = () => {
         ws = null
         setState({
@@ -134,5 +163,5 @@ export function init() {
  */
 export function sendAction(action) {
     console.log(`Sending ${action.type} action`, action)
-    if (ws) ws.send(JSON.stringify(action))
+    if (ws) ws.send(binary ? wire.encode(action) : JSON.stringify(action))
 }
@@ -53,6 +53,32 @@ export function resetBoard(event) {
     updateBoardState()
 }
 
+/**
+ * @param {SyncEvent} event
+ */
+export function syncBoard(event) {
+    let board = event.board
+    // the board is rebuilt around every card in the game, and then the cards are put where the server says they are
+    let cards = [board.deck, board.discard, ...board.melds, ...board.players.map(player => player.hand)].flat()
+    resetBoard({
+        type: "start",
+        players: board.players,
+        current_player_id: board.current_player_id,
+        card_ids: cards.map(card => card.id),
+        game_code: board.game_code,
+        settings: event.settings
+    })
+    if (state.type !== "game") return
+    Object.assign(state.board, {
+        players: board.players,
+        turn: board.turn ?? undefined,
+        melds: board.melds,
+        deck: board.deck,
+        discard: board.discard
+    })
+    updateBoardState()
+}
+
 
 
 /**
@@ -0,0 +1,183 @@
+// The compact binary encoding that clients can choose instead of JSON, matching server/wire.py.
+// A message is the same object that would be sent as JSON, written as a tree of tagged values. Numbers are written as
+// varints, and the strings that make up most of the protocol are written as an index into WORDS.
+
+const NULL = 0
+const FALSE = 1
+const TRUE = 2
+const INT = 3
+const NEGATIVE_INT = 4
+const FLOAT = 5
+const STRING = 6
+const WORD = 7
+const ARRAY = 8
+const OBJECT = 9
+
+// this list has to match the one in server/wire.py exactly
+export const WORDS = [
+    // event and action types
+    "type", "ping", "pong", "lobby", "start", "turn", "move", "redeck", "end", "batch",
+    "name", "ai", "join", "draw", "meld", "lay", "discard", "settings",
+    // keys
+    "id", "face", "suit", "rank", "cards", "card_id", "card_ids", "destination", "player", "player_id", "position",
+    "meld_number", "state", "play", "winner_id", "hand_values", "nonce", "count", "events", "players",
+    "current_player_id", "code", "game_code", "hand", "human", "action", "add", "remove",
+    // settings
+    "deck_count", "enable_jokers", "hand_size", "first_turn", "allow_draw_choice", "allow_run_mixed_suit",
+    "allow_set_duplicate_suit", "limit_meld_size", "ace_rank", "deck_exhaust", "require_end_discard", "lay_at_end",
+    "next_player", "prev_winner", "random", "low", "high", "flip_discard", "shuffle_discard", "end_round",
+    // faces
+    "hearts", "clubs", "diamonds", "spades", "joker",
+    "W", "A", "2", "3", "4", "5", "6", "7", "8", "9", "10", "J", "Q", "K",
+    // errors
+    "error", "invalid_action", "internal_error", "game_started", "no_game", "not_your_turn", "already_drawn", "not_drawn",
+    "card_not_found", "illegal_meld", "no_such_meld", "must_keep_discard", "cannot_discard", "invalid_name", "cannot_join",
+    "not_enough_players",
+    // resyncs
+    "sync", "board", "melds", "deck",
+]
+const wordIndex = new Map(WORDS.map((word, i) => [word, i]))
+
+const textEncoder = new TextEncoder()
+const textDecoder = new TextDecoder()
+
+/**
+ * @param {number[]} out
+ * @param {number} number
+ */
+function writeVarint(out, number) {
+    while (number > 0x7F) {
+        out.push(number % 0x80 | 0x80)
+        number = Math.floor(number / 0x80)
+    }
+    out.push(number)
+}
+
+/**
+ * @param {number[]} out
+ * @param {any} value
+ */
+function write(out, value) {
+    if (value === null || value === undefined) {
+        out.push(NULL)
+    } else if (value === true) {
+        out.push(TRUE)
+    } else if (value === false) {
+        out.push(FALSE)
+    } else if (typeof value === "number") {
+        if (Number.isSafeInteger(value)) {
+            out.push(value >= 0 ? INT : NEGATIVE_INT)
+            writeVarint(out, value >= 0 ? value : -value - 1)
+        } else {
+            out.push(FLOAT)
+            let bytes = new Uint8Array(8)
+            new DataView(bytes.buffer).setFloat64(0, value, true)
+            out.push(...bytes)
+        }
+    } else if (typeof value === "string") {
+        let index = wordIndex.get(value)
+        if (index !== undefined) {
+            out.push(WORD)
+            writeVarint(out, index)
+        } else {
+            let bytes = textEncoder.encode(value)
+            out.push(STRING)
+            writeVarint(out, bytes.length)
+            out.push(...bytes)
+        }
+    } else if (Array.isArray(value)) {
+        out.push(ARRAY)
+        writeVarint(out, value.length)
+        for (let item of value) write(out, item)
+    } else {
+        // undefined properties are left out, as JSON.stringify would
+        let entries = Object.entries(value).filter(([, item]) => item !== undefined)
+        out.push(OBJECT)
+        writeVarint(out, entries.length)
+        for (let [key, item] of entries) {
+            write(out, key)
+            write(out, item)
+        }
+    }
+}
+
+/**
+ * @param {any} value
+ * @return {Uint8Array}
+ */
+export function encode(value) {
+    /** @type {number[]} */
+    let out = []
+    write(out, value)
+    return Uint8Array.from(out)
+}
+
+/**
+ * @param {ArrayBuffer} data
+ * @return {any}
+ */
+export function decode(data) {
+    let bytes = new Uint8Array(data)
+    let view = new DataView(data)
+    let position = 0
+
+    function varint() {
+        let number = 0
+        let scale = 1
+        while (true) {
+            let byte = bytes[position++]
+            number += (byte & 0x7F) * scale
+            if (byte < 0x80) return number
+            scale *= 0x80
+        }
+    }
+
+    /** @return {any} */
+    function value() {
+        let tag = bytes[position++]
+        switch (tag) {
+            case NULL:
+                return null
+            case FALSE:
+                return false
+            case TRUE:
+                return true
+            case INT:
+                return varint()
+            case NEGATIVE_INT:
+                return -varint() - 1
+            case FLOAT: {
+                let number = view.getFloat64(position, true)
+                position += 8
+                return number
+            }
+            case STRING: {
+                let length = varint()
+                let text = textDecoder.decode(bytes.subarray(position, position + length))
+                position += length
+                return text
+            }
+            case WORD:
+                return WORDS[varint()]
+            case ARRAY: {
+                let length = varint()
+                let result = []
+                for (let i = 0; i < length; i++) result.push(value())
+                return result
+            }
+            case OBJECT: {
+                let length = varint()
+                /** @type {Object<string, any>} */
+                let result = {}
+                for (let i = 0; i < length; i++) {
+                    let key = value()
+                    result[key] = value()
+                }
+                return result
+            }
+        }
+        throw new Error(`Unknown tag ${tag}`)
+    }
+
+    return value()
+}
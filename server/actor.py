@@ -0,0 +1,68 @@
+import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+from typing import Any, Callable
+
+# This file contains the actors that lobbies and games are run by.
+#
+# Each lobby (and the game played in it) has an actor: a queue of tasks that are run one at a time, in the order they
+# were submitted. The actions of its players, the turns played by its scheduler and the removal of players who disconnect
+# all go through it, so only one thread is ever working on a game, and no thread ever sits waiting on a game's lock.
+# Actors don't have threads of their own; an actor with tasks waiting runs them on the shared pool below.
+
+# the threads actors run on, tuned with the RUMMY_GAME_WORKERS environment variable
+gameWorkers = ThreadPoolExecutor(int(os.environ.get("RUMMY_GAME_WORKERS", 4)), thread_name_prefix="game")
+
+# the most tasks an actor runs before giving its thread to another actor, so a busy table can't hold a worker forever
+TASKS_PER_RUN = 16
+
+
+class Actor:
+    """
+    Runs the tasks submitted to it one at a time, in order, on a shared pool of threads.
+
+    Properties:
+        pool (ThreadPoolExecutor): The threads the tasks are run on.
+    """
+
+    def __init__(self, pool: ThreadPoolExecutor = gameWorkers):
+        self.pool = pool
+        self._tasks: deque[tuple[Future, Callable, tuple]] = deque()
+        # guards _tasks and _running, and is only held for a moment
+        self._lock = Lock()
+        # whether a run is queued on the pool or running, in which case it picks up new tasks itself
+        self._running = False
+
+    def submit(self, task: Callable[..., Any], *args: Any) -> Future:
+        """
+        Queues a task, returning a future for its result. Tasks never run at the same time as each other.
+
+        Args:
+            task (Callable): The function to call.
+            *args: The arguments to call it with.
+        """
+        future: Future = Future()
+        with self._lock:
+            self._tasks.append((future, task, args))
+            if self._running:
+                return future
+            self._running = True
+        self.pool.submit(self._run)
+        return future
+
+    def _run(self):
+        for _ in range(TASKS_PER_RUN):
+            with self._lock:
+                if not self._tasks:
+                    self._running = False
+                    return
+                future, task, args = self._tasks.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(task(*args))
+            except BaseException as e:
+                future.set_exception(e)
+        # there may be more to do, but other actors get a turn on the pool first
+        self.pool.submit(self._run)
@@ -0,0 +1,183 @@
+from typing import Optional
+
+import classes
+import funlib
+import solver
+from cardcodes import JOKER
+from gamerules import GameRules
+from protocol import CardFace
+
+# This file contains the per-turn analysis of an AI player's hand.
+#
+# An AI turn asks many questions about nearly the same hand: which melds it holds with or without the top of the discard
+# pile, what an extra wild would add, and how to partition it before and after drawing. The analysis works each answer out
+# once and, when the hand changes, only redoes the parts that depend on the cards that changed.
+
+
+class _Wild:
+    """
+    A wild card that isn't in the hand, used to ask what the hand could do with one more wild.
+    It looks enough like a ServerCard to be printed or counted, but has no ID of its own.
+    """
+    id = ""
+    face = CardFace("joker", "W")
+    code = JOKER
+
+
+WILD = _Wild()
+
+
+class HandAnalysis:
+    """
+    The meld structure of a hand, kept up to date as cards are added to it or melds are removed from it.
+
+    Properties:
+        rules (GameRules): The compiled rules of the game.
+        cards (list[ServerCard]): The hand, in hand order.
+    """
+
+    def __init__(self, cards: list['classes.ServerCard'], rules: GameRules):
+        """
+        Args:
+            cards (list[ServerCard]): The hand to analyze. The list is copied.
+            rules (GameRules): The compiled rules of the game.
+        """
+        self.rules = rules
+        self.cards = cards.copy()
+        # runs and sets found with a number of extra wilds, grouped by the suit (for runs) or rank (for sets) they're made of
+        self._runs: dict[int, dict[int, list[list]]] = {}
+        self._sets: dict[int, dict[int, list[list]]] = {}
+        # solver states shared by every partition of this hand, one dict per value of `wildMelds`
+        self._memos: dict[bool, dict] = {True: {}, False: {}}
+        self._partitions: dict[tuple[int, bool], solver.HandPartition] = {}
+
+    def _runKey(self, code: int):
+        return 0 if self.rules.mixedSuit else code >> 4
+
+    def _forget(self, cards: list['classes.ServerCard']):
+        self._partitions.clear()
+        if any(card.code == JOKER for card in cards):
+            # every meld can use wilds, so all of them have to be found again
+            self._runs.clear()
+            self._sets.clear()
+            return
+        for groups in self._runs.values():
+            for card in cards:
+                groups.pop(self._runKey(card.code), None)
+        for groups in self._sets.values():
+            for card in cards:
+                groups.pop(card.code & 15, None)
+
+    def addCard(self, card: 'classes.ServerCard', position: Optional[int] = None):
+        self.cards.insert(len(self.cards) if position is None else position, card)
+        self._forget([card])
+
+    def removeCards(self, cards: list['classes.ServerCard']):
+        self.cards = [card for card in self.cards if card not in cards]
+        self._forget(cards)
+
+    def _wilds(self, extraWilds: int):
+        return [card for card in self.cards if card.code == JOKER] + [WILD] * extraWilds
+
+    def _groups(self, extraWilds: int):
+        # the runs and sets of the hand by group, finding only the groups that changed since the last time
+        runs = self._runs.setdefault(extraWilds, {})
+        sets = self._sets.setdefault(extraWilds, {})
+        wilds = self._wilds(extraWilds)
+        runKeys = {self._runKey(card.code) for card in self.cards if card.code != JOKER}
+        setKeys = {card.code & 15 for card in self.cards if card.code != JOKER}
+        missingRuns = runKeys.difference(runs)
+        missingSets = setKeys.difference(sets)
+        if len(missingRuns) == len(runKeys) and len(missingSets) == len(setKeys):
+            # nothing is known yet, so find every meld at once and sort them into groups
+            for run in self.rules.findRuns(self.cards + wilds[len(wilds) - extraWilds:]):
+                runs.setdefault(self._runKey(run[0].code), []).append(run)
+            for meld in self.rules.findSets(self.cards + wilds[len(wilds) - extraWilds:]):
+                if meld[0].code != JOKER:
+                    sets.setdefault(meld[0].code & 15, []).append(meld)
+        else:
+            for key in missingRuns:
+                runs[key] = self.rules.findRuns(
+                    [card for card in self.cards if card.code != JOKER and self._runKey(card.code) == key] + wilds)
+            for key in missingSets:
+                sets[key] = [meld for meld in self.rules.findSets(
+                    [card for card in self.cards if card.code != JOKER and card.code & 15 == key] + wilds) if meld[0].code != JOKER]
+        for key in runKeys:
+            runs.setdefault(key, [])
+        for key in setKeys:
+            sets.setdefault(key, [])
+        return runs, sets, wilds
+
+    def melds(self, extra: Optional['classes.ServerCard'] = None, extraWilds: int = 0):
+        """
+        The melds that funlib.findMelds would find in the hand, in no particular order.
+
+        Args:
+            extra (ServerCard | None): A card to add to the end of the hand, such as the top of the discard pile.
+            extraWilds (int): The number of wilds to add after that.
+        """
+        if extra is not None and extra.code == JOKER:
+            # a wild changes every group, so there's nothing to reuse
+            cards = self.cards + [extra] + [WILD] * extraWilds
+            return funlib.findMelds(cards, self.rules, None)  # type: ignore
+
+        runs, sets, wilds = self._groups(extraWilds)
+        total = len(self.cards) + extraWilds
+        melds: list[list] = [wilds[:i] for i in range(3, len(wilds) + 1)]
+        if extra is None:
+            for group in runs.values():
+                melds += group
+            for group in sets.values():
+                melds += group
+        else:
+            # only the run and set groups the extra card belongs to change
+            total += 1
+            runKey = self._runKey(extra.code)
+            setKey = extra.code & 15
+            for key, group in runs.items():
+                if key != runKey:
+                    melds += group
+            for key, group in sets.items():
+                if key != setKey:
+                    melds += group
+            melds += self.rules.findRuns(
+                [card for card in self.cards if card.code != JOKER and self._runKey(card.code) == runKey] + [extra] + wilds)
+            melds += [meld for meld in self.rules.findSets(
+                [card for card in self.cards if card.code != JOKER and card.code & 15 == setKey] + [extra] + wilds) if meld[0].code != JOKER]
+        return [meld for meld in melds if funlib.keepMeld(meld, total, self.rules, None)]
+
+    def meldCount(self, extra: Optional['classes.ServerCard'] = None, extraWilds: int = 0):
+        return len(self.melds(extra, extraWilds))
+
+    def partition(self, reserve: int = 0, wildMelds: bool = True):
+        key = (reserve, wildMelds)
+        partition = self._partitions.get(key)
+        if partition is None:
+            partition = self._partitions[key] = solver.solveHand(
+                self.cards, self.rules, reserve, wildMelds, self._memos[wildMelds])
+        return partition
+
+    def meldPlan(self, cannotDiscard: Optional['classes.ServerCard']):
+        """
+        The melds to lay down this turn, taken from the partition of the hand that leaves the least deadwood.
+        If the whole hand can't be played, melds with fewer than two natural cards are held back to save wilds.
+
+        Args:
+            cannotDiscard (ServerCard | None): A card that can't be discarded this turn, so it mustn't be left alone.
+        """
+        reserve = 1 if self.rules.requireEndDiscard else 0
+        partition = self.partition(reserve)
+        if (len(partition.deadwood) > reserve or partition.deadwood == [cannotDiscard]) and \
+                any(funlib.nonWildCards(meld) < 2 for meld in partition.melds):
+            # when every meld already has two natural cards, holding wilds back can't change anything
+            partition = self.partition(reserve, False)
+        plan: list[list['classes.ServerCard']] = []
+        remaining = self.cards.copy()
+        for meld in partition.melds:
+            left = [card for card in remaining if card not in meld]
+            # never leave the card we can't discard as the only card in our hand
+            if left == [cannotDiscard]:
+                continue
+            plan.append(meld)
+            remaining = left
+        return plan
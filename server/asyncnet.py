@@ -0,0 +1,103 @@
+import asyncio
+from traceback import print_exc
+
+from aiohttp import WSMsgType, web
+
+import net
+from outbox import COALESCE_WINDOW, OUTBOX_BYTES, OUTBOX_LIMIT, Outbox
+
+# This file contains the asyncio version of the /stream endpoint, served with aiohttp by asyncapp.py.
+#
+# A connection that isn't doing anything is just a coroutine waiting on its socket, instead of a thread blocked in
+# receive(), so one process can hold many more of them. Everything else (lobbies, games and the handling of actions) is
+# the same code the Flask server runs: actions are queued on the actor of the player's lobby (see actor.py), and the
+# coroutine waits for them without holding up the event loop.
+
+# the longest message a client may send, in bytes
+MAX_MESSAGE_SIZE = 1 << 16
+
+
+class AsyncSocket(Outbox):
+    """
+    Lets a Connection send on an aiohttp websocket from any thread. Sends are queued in the outbox, and written by a task
+    on the event loop, in order.
+
+    Properties:
+        ws (WebSocketResponse): The websocket.
+        loop (AbstractEventLoop): The event loop the websocket belongs to.
+    """
+
+    def __init__(self, ws: web.WebSocketResponse, loop: asyncio.AbstractEventLoop, limit: int = OUTBOX_LIMIT,
+                 maxBytes: int = OUTBOX_BYTES, window: float = COALESCE_WINDOW):
+        super().__init__(limit, maxBytes, window)
+        self.ws = ws
+        self.loop = loop
+        self._ready = asyncio.Event()
+        self._frameEnded = asyncio.Event()
+
+    def wake(self):
+        self.loop.call_soon_threadsafe(self._ready.set)
+
+    def endFrame(self):
+        self.loop.call_soon_threadsafe(self._frameEnded.set)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.loop.call_soon_threadsafe(self._frameEnded.set)
+            self.loop.call_soon_threadsafe(self._ready.set)
+
+    async def write(self):
+        # runs until the socket is closed, writing whatever is sent
+        try:
+            while True:
+                await self._ready.wait()
+                self._ready.clear()
+                if self.window > 0:
+                    try:
+                        await asyncio.wait_for(self._frameEnded.wait(), self.window)
+                    except asyncio.TimeoutError:
+                        pass
+                    self._frameEnded.clear()
+                while (data := self.takeFrame()) is not None:
+                    if isinstance(data, bytes):
+                        await self.ws.send_bytes(data)
+                    else:
+                        await self.ws.send_str(data)
+                if self.closed:
+                    break
+        except Exception:
+            # the client has gone, so the next send fails and drops the connection
+            self.closed = True
+        await self.ws.close()
+
+
+async def stream(request: web.Request):
+    ws = web.WebSocketResponse(max_msg_size=MAX_MESSAGE_SIZE)
+    await ws.prepare(request)
+    loop = asyncio.get_running_loop()
+    sock = AsyncSocket(ws, loop)
+    writer = asyncio.create_task(sock.write())
+    # clients ask for the binary encoding with ?format=binary, and otherwise get JSON
+    binary = request.query.get("format") == "binary"
+    connection = net.Connection(sock, binary)
+    # the timer wheel pings the client when it's quiet, and closes the socket (ending the loop) if it's gone
+    net.watch(connection)
+    try:
+        while not sock.closed:
+            message = await ws.receive()
+            if message.type == WSMsgType.TEXT or message.type == WSMsgType.BINARY:
+                # messages are handled one at a time, in the order they arrived
+                future = net.submitMessage(connection, message.data)
+                if future is not None:
+                    await asyncio.wrap_future(future)
+            else:
+                # the client closed the socket, or sent something that isn't a message
+                break
+    except Exception:
+        print_exc()
+    finally:
+        await asyncio.wrap_future(net.dropConnection(connection))
+        sock.close()
+        await writer
+    return ws
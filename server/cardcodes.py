@@ -0,0 +1,310 @@
+from sys import maxsize
+from typing import Callable, Optional, Protocol, Sequence
+
+from protocol import CardFace, CardRank, CardSuit
+
+# This file contains the integer card encoding used by the meld engine.
+#
+# Every face is packed into a small integer: the low four bits hold the rank (1 for an ace through 13 for a king), and the
+# bits above that hold the suit, using the same suit order that hands are sorted by. Jokers get a code of their own.
+# A group of cards is then described by one rank bitmask per suit, so runs and sets can be found with bit operations
+# instead of repeatedly comparing rank and suit strings.
+
+SUITS: list[CardSuit] = ["hearts", "clubs", "diamonds", "spades", "joker"]
+RANKS: list[CardRank] = ["W", "A", "2", "3", "4", "5",
+                         "6", "7", "8", "9", "10", "J", "Q", "K"]
+
+JOKER = 4 << 4
+CODE_COUNT = JOKER + 1
+# the code of every card other than a joker
+NATURAL_CODES = [suit << 4 | rank for suit in range(4) for rank in range(1, 14)]
+
+
+def encodeFace(face: CardFace) -> int:
+    if face.rank == "W":
+        return JOKER
+    return SUITS.index(face.suit) << 4 | RANKS.index(face.rank)
+
+
+def decodeFace(code: int) -> CardFace:
+    if code == JOKER:
+        return CardFace("joker", "W")
+    return CardFace(SUITS[code >> 4], RANKS[code & 15])
+
+
+def suitOf(code: int):
+    return code >> 4
+
+
+def rankOf(code: int):
+    return code & 15
+
+
+def _rankValue(code: int, aceHigh: bool):
+    if code == JOKER:
+        return -1
+    rank = code & 15
+    return 14 if rank == 1 and aceHigh else rank
+
+
+def _scoreValue(code: int, aceHigh: bool):
+    if code == JOKER:
+        return 15
+    rank = code & 15
+    if rank == 1:
+        return 11 if aceHigh else 1
+    return min(rank, 10)
+
+
+def _meldSortKey(code: int, aceHigh: bool):
+    # melds are sorted by rank, then by suit, with wilds at the very end
+    if code == JOKER:
+        return 15 << 3 | 4
+    return _rankValue(code, aceHigh) << 3 | (code >> 4)
+
+
+# lookup tables indexed by [aceHigh][code]
+# codes that don't correspond to a face are filled in, but never looked up
+RANK_VALUES = [[_rankValue(code, aceHigh) for code in range(CODE_COUNT)]
+               for aceHigh in (False, True)]
+SCORE_VALUES = [[_scoreValue(code, aceHigh) for code in range(CODE_COUNT)]
+                for aceHigh in (False, True)]
+MELD_SORT_KEYS = [[_meldSortKey(code, aceHigh) for code in range(CODE_COUNT)]
+                  for aceHigh in (False, True)]
+
+
+class Coded(Protocol):
+    """
+    Anything with a face code, such as a ServerCard.
+    """
+    code: int
+
+
+def bitCount(mask: int):
+    return bin(mask).count("1")
+
+
+def runChecker(aceHigh: bool, mixedSuit: bool) -> Callable[[Sequence[int]], bool]:
+    values = RANK_VALUES[aceHigh]
+
+    def checkRun(codes: Sequence[int]):
+        # prevent using a wild as a 14th card
+        if len(codes) > 13:
+            return False
+        mask = 0
+        suits = 0
+        wilds = 0
+        for code in codes:
+            if code == JOKER:
+                wilds += 1
+                continue
+            bit = 1 << values[code]
+            # two cards of the same rank can never be part of the same run
+            if mask & bit:
+                return False
+            mask |= bit
+            suits |= 1 << (code >> 4)
+        if mask == 0:
+            return True
+        # more than one suit bit set means the run is mixed
+        if suits & (suits - 1):
+            return False
+        return countGaps(mask) <= wilds
+
+    def checkMixedRun(codes: Sequence[int]):
+        if len(codes) > 13:
+            return False
+        mask = 0
+        wilds = 0
+        for code in codes:
+            if code == JOKER:
+                wilds += 1
+                continue
+            bit = 1 << values[code]
+            if mask & bit:
+                return False
+            mask |= bit
+        if mask == 0:
+            return True
+        return countGaps(mask) <= wilds
+
+    return checkMixedRun if mixedSuit else checkRun
+
+
+def countGaps(mask: int):
+    # every rank missing between the lowest and highest card has to be filled by a wild
+    low = (mask & -mask).bit_length()
+    return mask.bit_length() - low + 1 - bitCount(mask)
+
+
+def setChecker(duplicateSuit: bool) -> Callable[[Sequence[int]], bool]:
+    def checkSet(codes: Sequence[int]):
+        # prevent using a wild as a 5th card
+        if len(codes) > 4:
+            return False
+        rank = 0
+        suits = 0
+        for code in codes:
+            if code == JOKER:
+                continue
+            if rank == 0:
+                rank = code & 15
+            elif rank != code & 15:
+                return False
+            bit = 1 << (code >> 4)
+            if suits & bit:
+                return False
+            suits |= bit
+        return True
+
+    def checkDuplicateSet(codes: Sequence[int]):
+        rank = 0
+        for code in codes:
+            if code == JOKER:
+                continue
+            if rank == 0:
+                rank = code & 15
+            elif rank != code & 15:
+                return False
+        return True
+
+    return checkDuplicateSet if duplicateSuit else checkSet
+
+
+def legalChecker(aceHigh: bool, mixedSuit: bool, duplicateSuit: bool, limit: Optional[int]) -> Callable[[Sequence[int]], bool]:
+    checkRun = runChecker(aceHigh, mixedSuit)
+    checkSet = setChecker(duplicateSuit)
+    most = limit if limit is not None else maxsize
+
+    def checkLegal(codes: Sequence[int]):
+        return 3 <= len(codes) <= most and (checkSet(codes) or checkRun(codes))
+
+    return checkLegal
+
+
+# checkers for every variant, indexed like [aceHigh][mixedSuit] and [duplicateSuit]
+_RUN_CHECKERS = [[runChecker(aceHigh, mixedSuit) for mixedSuit in (False, True)]
+                 for aceHigh in (False, True)]
+_SET_CHECKERS = [setChecker(duplicateSuit) for duplicateSuit in (False, True)]
+
+
+def checkRun(codes: Sequence[int], aceHigh: bool, mixedSuit: bool):
+    return _RUN_CHECKERS[aceHigh][mixedSuit](codes)
+
+
+def checkSet(codes: Sequence[int], duplicateSuit: bool):
+    return _SET_CHECKERS[duplicateSuit](codes)
+
+
+def checkLegal(codes: Sequence[int], aceHigh: bool, mixedSuit: bool, duplicateSuit: bool, limit: Optional[int]):
+    if len(codes) < 3 or (limit is not None and len(codes) > limit):
+        return False
+    return checkSet(codes, duplicateSuit) or checkRun(codes, aceHigh, mixedSuit)
+
+
+def sortMeld(cards: list[Coded], aceHigh: bool):
+    keys = MELD_SORT_KEYS[aceHigh]
+    cards.sort(key=lambda card: keys[card.code])
+    return cards
+
+
+def findRuns(cards: list[Coded], aceHigh: bool, mixedSuit: bool, limit: Optional[int]):
+    values = RANK_VALUES[aceHigh]
+    wilds: list[Coded] = []
+    # for each suit (or just one bucket for mixed runs), cards are grouped by rank value, in hand order
+    buckets: dict[int, list[list[Coded]]] = {}
+    masks: dict[int, int] = {}
+    for card in cards:
+        code = card.code
+        if code == JOKER:
+            wilds.append(card)
+            continue
+        suit = 0 if mixedSuit else code >> 4
+        ranks = buckets.get(suit)
+        if ranks is None:
+            ranks = buckets[suit] = [[] for _ in range(15)]
+            masks[suit] = 0
+        value = values[code]
+        ranks[value].append(card)
+        masks[suit] |= 1 << value
+
+    runs: list[list[Coded]] = []
+    for suit, ranks in buckets.items():
+        mask = masks[suit]
+        starts = mask
+        while starts:
+            lowest = starts & -starts
+            starts ^= lowest
+            start = lowest.bit_length() - 1
+
+            # extend the run upwards, one present rank at a time, filling gaps with wilds
+            chain = [start]
+            length = 1
+            availableWilds = len(wilds)
+            above = mask >> (start + 1)
+            while above:
+                step = (above & -above).bit_length()
+                if step - 1 > availableWilds or (limit is not None and length + step > limit):
+                    break
+                availableWilds -= step - 1
+                length += step
+                chain.append(chain[-1] + step)
+                above = mask >> (chain[-1] + 1)
+
+            if length + availableWilds < 3:
+                continue
+            # each card of the starting rank begins its own run
+            for head in ranks[start]:
+                run = [head]
+                used = 0
+                for i in range(1, len(chain)):
+                    gap = chain[i] - chain[i - 1] - 1
+                    run += wilds[used:used + gap]
+                    used += gap
+                    run.append(ranks[chain[i]][0])
+                if len(run) < 3:
+                    run += wilds[used:used + 3 - len(run)]
+                runs.append(sortMeld(run, aceHigh))
+    return runs
+
+
+def findSets(cards: list[Coded], duplicateSuit: bool, limit: Optional[int]):
+    wilds: list[Coded] = []
+    # for each rank (in the order they appear in the hand), cards are grouped by suit
+    buckets: dict[int, list[list[Coded]]] = {}
+    masks: dict[int, int] = {}
+    for card in cards:
+        code = card.code
+        if code == JOKER:
+            wilds.append(card)
+            continue
+        rank = code & 15
+        suits = buckets.get(rank)
+        if suits is None:
+            suits = buckets[rank] = [[], [], [], []]
+            masks[rank] = 0
+        suits[code >> 4].append(card)
+        masks[rank] |= 1 << (code >> 4)
+
+    sets: list[list[Coded]] = [wilds[:i] for i in range(3, len(wilds) + 1)]
+    for rank, suits in buckets.items():
+        mask = masks[rank]
+        bucket: list[Coded] = []
+        while mask:
+            lowest = mask & -mask
+            mask ^= lowest
+            suit = suits[lowest.bit_length() - 1]
+            if duplicateSuit:
+                bucket += suit
+            else:
+                bucket.append(suit[0])
+        if limit is not None and len(bucket) > limit:
+            bucket = bucket[:limit]
+        if len(bucket) >= 3:
+            sets.append(bucket)
+        # only add wilds to sets of 2 or more, since a lone card will be caught by findRuns as a run of 3 with two wilds
+        if len(wilds) > 0 and len(bucket) >= 2 and len(bucket) + len(wilds) >= 3:
+            if len(bucket) < 3 and len(bucket) + len(wilds) > 3:
+                sets.append(bucket + wilds[:3 - len(bucket)])
+            sets.append(bucket + wilds)
+    return sets
@@ -0,0 +1,56 @@
+from hashlib import blake2b
+from itertools import count
+from secrets import token_bytes
+
+# This file contains the compact card IDs used in place of random UUIDs.
+#
+# Each game numbers its cards 0, 1, 2, ... as it hands out IDs, and hashes the numbers with a key kept secret by that
+# game, so an ID says nothing about when its card was numbered (and so nothing about its face, since decks are numbered
+# before they're shuffled). Players know the faces, and so the numbers, of their own cards, which is why the hash has to
+# be a keyed cryptographic one: knowing some numbers and their IDs doesn't help to work out the number behind any other
+# ID. The result is written as 8 base-32 characters instead of 32 hex characters, without reading the system's entropy
+# for every card.
+
+# IDs are 40 bit hashes, which is 8 characters of 5 bits each
+_BYTES = 5
+
+# every pair of characters, indexed by the 10 bits they stand for
+_DIGITS = "0123456789abcdefghijklmnopqrstuv"
+_PAIRS = [high + low for high in _DIGITS for low in _DIGITS]
+
+
+class CardIDs:
+    """
+    Hands out card IDs for one game. IDs never repeat within the same CardIDs.
+
+    Properties:
+        key (bytes): The secret key of the hash.
+    """
+
+    def __init__(self):
+        self.key = token_bytes(16)
+        self._counter = count()
+        # the hashes handed out so far, since two numbers can hash the same, however unlikely that is with a game's cards
+        self._used: set[int] = set()
+
+    def next(self):
+        hashed = self._hash()
+        while hashed in self._used:
+            hashed = self._hash()
+        self._used.add(hashed)
+        return _PAIRS[hashed >> 30] + _PAIRS[hashed >> 20 & 1023] + _PAIRS[hashed >> 10 & 1023] + _PAIRS[hashed & 1023]
+
+    def _hash(self):
+        # the next number, hashed with the game's key
+        number = next(self._counter).to_bytes(8, "little")
+        return int.from_bytes(blake2b(number, digest_size=_BYTES, key=self.key).digest(), "little")
+
+
+def redeckIDs(nonce: str, count: int):
+    # the IDs of a new deck, which clients work out for themselves from the nonce and count in the redeck event
+    # the "-" keeps them apart from IDs handed out by CardIDs
+    return [f"{nonce}-{i}" for i in range(count)]
+
+
+# IDs for cards that don't belong to a game, such as the ones made up by tests
+cardIDs = CardIDs()
@@ -1,79 +1,73 @@
+import os
+from contextlib import contextmanager
 from random import shuffle
 from secrets import choice
+from threading import RLock
+from traceback import print_exc
 from typing import Union
-from uuid import uuid4
 
+import analysis
+import cardcodes
 import funlib
 import net
+from cardids import CardIDs, cardIDs, redeckIDs
+from gamerules import GameRules
+from meldindex import MeldAccepts
 from protocol import *
+from registry import Registry
+from timerwheel import timers
 
 # This file should contain all classes created by Super Rummy.
 
-games: dict[str, "Game"] = {}
+games: Registry[str, "Game"] = Registry()
+
+# AI turns, and the turns of disconnected players, are played on the game's actor (see actor.py)
+# how long AI turns wait so clients can follow them, in seconds, set in milliseconds with the RUMMY_AI_TURN_DELAY
+# environment variable
+AI_TURN_DELAY = float(os.environ.get("RUMMY_AI_TURN_DELAY", 0)) / 1000
 
 
 class ServerCard:
-    def __init__(self, face: CardFace):
-        self.id = uuid4().hex
+    def __init__(self, face: CardFace, ids: Optional[CardIDs] = None):
+        self.id = (ids or cardIDs).next()
         self.face = face
+        # faces never change, so the integer encoding used by the meld engine is computed once
+        self.code = cardcodes.encodeFace(face)
 
     def makeForClient(self, visible: bool):
         return ClientCard(id=self.id, face=self.face if visible else None)
 
-    def sortingSuitPosition(self, settings: GameSettings):
-        if self.face.suit == "hearts":
-            return 0
-        elif self.face.suit == "clubs":
-            return 1
-        elif self.face.suit == "diamonds":
-            return 2
-        elif self.face.suit == "spades":
-            return 3
-        else:
-            return 4
-
-    def sortingRankPosition(self, settings: GameSettings):
-        if self.face.rank == "A":
-            return 14 if settings.ace_rank == "high" else 1
-        elif self.face.rank == "2":
-            return 2
-        elif self.face.rank == "3":
-            return 3
-        elif self.face.rank == "4":
-            return 4
-        elif self.face.rank == "5":
-            return 5
-        elif self.face.rank == "6":
-            return 6
-        elif self.face.rank == "7":
-            return 7
-        elif self.face.rank == "8":
-            return 8
-        elif self.face.rank == "9":
-            return 9
-        elif self.face.rank == "10":
-            return 10
-        elif self.face.rank == "J":
-            return 11
-        elif self.face.rank == "Q":
-            return 12
-        elif self.face.rank == "K":
-            return 13
-        else:
-            return 15
+    def sortingSuitPosition(self, rules: GameRules):
+        return rules.handSortKeys[self.code] >> 4
 
-    def isSortedBefore(self, other: Self, settings: GameSettings):
-        if self.sortingSuitPosition(settings) < other.sortingSuitPosition(settings):
-            return True
-        elif self.sortingSuitPosition(settings) == other.sortingSuitPosition(settings):
-            return self.sortingRankPosition(settings) < other.sortingRankPosition(settings)
-        else:
-            return False
+    def sortingRankPosition(self, rules: GameRules):
+        return rules.handSortKeys[self.code] & 15
+
+    def isSortedBefore(self, other: Self, rules: GameRules):
+        keys = rules.handSortKeys
+        return keys[self.code] < keys[other.code]
 
 
 class Stack:
-    def __init__(self, num_decks: int = 0, jokers: bool = False):
-        self.cards = funlib.newDeck(num_decks, 2 * num_decks if jokers else 0)
+    def __init__(self, num_decks: int = 0, jokers: bool = False, ids: Optional[CardIDs] = None):
+        # for stacks used as melds, the cards that can be laid onto them (see acceptsFor)
+        self.accepts: Optional[MeldAccepts] = None
+        self.cards = funlib.newDeck(
+            num_decks, 2 * num_decks if jokers else 0, ids)
+
+    @property
+    def cards(self):
+        return self._cards
+
+    @cards.setter
+    def cards(self, cards: list[ServerCard]):
+        self._cards = cards
+        # the cards in the stack, so checking for a card doesn't have to search the list
+        self._members = set(cards)
+        self.accepts = None
+
+    def __contains__(self, card: ServerCard):
+        return card in self._members
 
     @classmethod
     def of(cls, cards: list[ServerCard]):
@@ -81,6 +75,11 @@ class Stack:
         stack.cards = cards
         return stack
 
+    def acceptsFor(self, rules: GameRules):
+        if self.accepts is None or self.accepts.rules is not rules:
+            self.accepts = MeldAccepts(self.cards, rules)
+        return self.accepts
+
     def top(self):
         return self.cards[-1] if len(self.cards) > 0 else None
 
@@ -88,21 +87,40 @@ class Stack:
         assert len(self.cards) > 0
         return self.cards[-1]
 
-    def reshuffle(self):
-        shuffle(self.cards)
-        for i in range(len(self.cards)):
-            self.cards[i].id = uuid4().hex
+    def sortedPosition(self, card: ServerCard, rules: GameRules):
+        # the position after every card that sorts before or alongside this one
+        # hands only ever gain cards at this position, so they stay sorted and the position can be found by bisection
+        keys = rules.handSortKeys
+        key = keys[card.code]
+        cards = self._cards
+        low = 0
+        high = len(cards)
+        while low < high:
+            middle = (low + high) // 2
+            if key < keys[cards[middle].code]:
+                high = middle
+            else:
+                low = middle + 1
+        return low
 
     def remove(self, cards: list[ServerCard]):
-        for card in cards:
-            if card in self.cards:
-                self.cards.remove(card)
+        removed = [card for card in cards if card in self._members]
+        if len(removed) == 0:
+            return
+        self._members.difference_update(removed)
+        self.accepts = None
+        # cards are usually taken from the top, which doesn't need to touch the rest of the stack
+        if self._cards[-len(removed):] == removed:
+            del self._cards[-len(removed):]
+        else:
+            removedSet = set(removed)
+            self._cards[:] = [card for card in self._cards if card not in removedSet]
 
     def insert(self, cards: list[ServerCard], position: int):
         self.remove(cards)
-        for card in cards:
-            self.cards.insert(position, card)
-            position = position + 1
+        self.accepts = None
+        self._cards[position:position] = cards
+        self._members.update(cards)
 
 
 class BoardPlayer():
@@ -110,11 +128,8 @@ class BoardPlayer():
         self.hand = Stack(0, False)
         self.connection = connection
 
-    def getDestinationHandPosition(self, card: ServerCard, settings: GameSettings):
-        for i in range(len(self.hand.cards)):
-            if card.isSortedBefore(self.hand.cards[i], settings):
-                return i
-        return len(self.hand.cards)
+    def getDestinationHandPosition(self, card: ServerCard, rules: GameRules):
+        return self.hand.sortedPosition(card, rules)
 
     def makeForClient(self, visibleCards: bool):
         return ClientPlayer(self.connection.name, self.connection.id, [card.makeForClient(visibleCards) for card in self.hand.cards], True)
@@ -132,7 +147,7 @@ class BoardPlayer():
         else:
             card = game.deck.assertedTop()
             game.moveCardsToHand(
-                [card], game.deck, self, self.getDestinationHandPosition(card, game.settings))
+                [card], game.deck, self, self.getDestinationHandPosition(card, game.rules))
             game.moveCardsToDiscard([choice(self.hand.cards)], self.hand)
             game.nextTurn()
 
@@ -142,39 +157,29 @@ class BoardAIPlayer():
         self.hand = Stack(0, False)
         self.profile = lobbyPlayer
 
-    def getDestinationHandPosition(self, card: ServerCard, settings: GameSettings):
-        for i in range(len(self.hand.cards)):
-            if card.isSortedBefore(self.hand.cards[i], settings):
-                return i
-        return len(self.hand.cards)
+    def getDestinationHandPosition(self, card: ServerCard, rules: GameRules):
+        return self.hand.sortedPosition(card, rules)
 
     def makeForClient(self):
         return ClientPlayer(self.profile.name, self.profile.id, [card.makeForClient(False) for card in self.hand.cards], False)
 
-    def canEmptyHand(self, game: 'Game'):
-        hand = Stack.of(self.hand.cards.copy())
-        melds = [Stack.of(meld.cards.copy()) for meld in game.melds]
-        # find the next "best" meld to play
-        # melds are prioritized that use fewer wilds
-        meld = funlib.findNextMeld(hand.cards, game.settings, None)
-        while meld is not None:
+    def canEmptyHand(self, game: 'Game', handAnalysis: Optional['analysis.HandAnalysis'] = None):
+        if handAnalysis is None:
+            handAnalysis = analysis.HandAnalysis(self.hand.cards, game.rules)
+        hand = Stack.of(handAnalysis.cards.copy())
+        melds = game.melds.copy()
+        # play every meld from the partition of our hand that leaves the least deadwood
+        reserve = 1 if game.rules.requireEndDiscard else 0
+        for meld in handAnalysis.partition(reserve).melds:
             hand.remove(meld)
             melds.append(Stack.of(meld))
-            meld = funlib.findNextMeld(hand.cards, game.settings, None)
 
         # after we've played all melds, we try to lay onto existing ones
         # the "preferred" lay will start with runs, then sets
         # wilds will be used if possible
-        cardToLay, meldIndex = funlib.findNextPreferredLay(
-            hand.cards, melds, game.settings, None)
-        while cardToLay is not None and meldIndex is not None and (not game.settings.require_end_discard or len(hand.cards) > 1):
-            newMeld = funlib.sortStack(
-                [hand.cards[cardToLay]] + melds[meldIndex].cards, game.settings)
-            hand.remove(newMeld)
-            melds[meldIndex].cards = newMeld
-            cardToLay, meldIndex = funlib.findNextPreferredLay(
-                hand.cards, melds, game.settings, None)
-        return len(hand.cards) == 0
+        lays = funlib.findLayPlan(hand.cards, melds, game.rules, None)
+        # if a discard is required, going out means having only that card left
+        return len(hand.cards) - len(lays) <= reserve
 
     def takeTurn(self, game: 'Game'):
         print(f"{self.profile.name}'s hand:")
@@ -184,7 +189,9 @@ class BoardAIPlayer():
         drawnFrom = game.deck
         drawnCard = game.deck.assertedTop()
         cannotDiscard: Optional[ServerCard] = None
-        if discardTop is not None and not self.canEmptyHand(game):
+        # the meld structure of our hand, worked out once and updated as the hand changes
+        hand = analysis.HandAnalysis(self.hand.cards, game.rules)
+        if discardTop is not None and not self.canEmptyHand(game, hand):
             # check if the discard pile's card is helpful to us
             print("Discard pile:")
             funlib.printCards([discardTop])
@@ -193,19 +200,15 @@ class BoardAIPlayer():
             # otherwise, if it forms a new meld with our cards plus a wild (indicating it pairs with our card), we also take it
             # if neither of these apply, we just draw from the deck
             # if we draw from the discard pile, we also need to remember that we're not allowed to discard it again
-            meldsWithDiscard = len(funlib.findMelds(
-                self.hand.cards + [discardTop], game.settings, cannotDiscard))
-            meldsWithoutDiscard = len(funlib.findMelds(
-                self.hand.cards, game.settings, cannotDiscard))
-            doublesWithDiscard = len(funlib.findMelds(
-                self.hand.cards + [discardTop, ServerCard(CardFace("joker", "W"))], game.settings, cannotDiscard))
-            doublesWithoutDiscard = len(funlib.findMelds(
-                self.hand.cards + [ServerCard(CardFace("joker", "W"))], game.settings, cannotDiscard))
+            meldsWithDiscard = hand.meldCount(discardTop)
+            meldsWithoutDiscard = hand.meldCount()
+            doublesWithDiscard = hand.meldCount(discardTop, 1)
+            doublesWithoutDiscard = hand.meldCount(None, 1)
 
             # if the settings disallow sets with duplicate suits and we already have this card, only draw if it forms multiple new melds
             discardDeficit = len(
                 [*filter(lambda card: discardTop.face.suit == card.face.suit and discardTop.face.rank == card.face.rank, self.hand.cards)])
-            if not game.settings.allow_set_duplicate_suit and discardDeficit > 0:
+            if not game.rules.duplicateSuit and discardDeficit > 0:
                 print(
                     f"Saw a card we already have, decrementing discard potential by {discardDeficit}")
                 meldsWithDiscard -= discardDeficit
@@ -223,30 +226,26 @@ class BoardAIPlayer():
         funlib.printCards(self.hand.cards)
 
         # draw the chosen card
-        game.moveCardsToAIHand(
-            [drawnCard], drawnFrom, self, self.getDestinationHandPosition(drawnCard, game.settings))
-
-        # find the next "best" meld to play
-        # melds are prioritized that use fewer wilds
-        meld = funlib.findNextMeld(
-            self.hand.cards, game.settings, cannotDiscard)
-        while meld is not None:
-            game.moveCardsToMeld(meld, self.hand, len(game.melds), 0)
-            meld = funlib.findNextMeld(
-                self.hand.cards, game.settings, cannotDiscard)
-
-        # after we've played all melds, we try to lay onto existing ones
-        # the "preferred" lay will start with runs, then sets
-        # wilds will be used if possible
-        cardToLay, meldIndex = funlib.findNextPreferredLay(
-            self.hand.cards, game.melds, game.settings, cannotDiscard)
-        while cardToLay is not None and meldIndex is not None and (not game.settings.require_end_discard or len(self.hand.cards) > 1):
-            newMeld = funlib.sortStack(
-                [self.hand.cards[cardToLay]] + game.melds[meldIndex].cards, game.settings)
-            game.moveCardsToMeld(newMeld, self.hand,
-                                 meldIndex, 0)
-            cardToLay, meldIndex = funlib.findNextPreferredLay(
-                self.hand.cards, game.melds, game.settings, cannotDiscard)
+        position = self.getDestinationHandPosition(drawnCard, game.rules)
+        game.moveCardsToAIHand([drawnCard], drawnFrom, self, position)
+        hand.addCard(drawnCard, position)
+
+        # clients get all of our melds and lays at once
+        with game.batchEvents():
+            # play the melds from the partition of our hand that leaves the least deadwood
+            for meld in hand.meldPlan(cannotDiscard):
+                game.moveCardsToMeld(meld, self.hand, len(game.melds), 0)
+                hand.removeCards(meld)
+
+            # after we've played all melds, we try to lay onto existing ones
+            # the "preferred" lay will start with runs, then sets
+            # wilds will be used if possible
+            for card, meldIndex in funlib.findLayPlan(self.hand.cards, game.melds, game.rules, cannotDiscard):
+                newMeld = game.rules.sortMeld(
+                    [card] + game.melds[meldIndex].cards)
+                game.moveCardsToMeld(newMeld, self.hand,
+                                     meldIndex, 0)
+                hand.removeCards([card])
 
         # if our hand is empty, the game is over
         if game.checkGameOver():
@@ -257,14 +256,14 @@ class BoardAIPlayer():
             *filter(lambda c: c is not cannotDiscard, self.hand.cards)]  # filter out the card we cannot discard
         # first we sort by rank (highest rank first)
         # this will act as a tiebreaker for the next sort
-        discardRank.sort(key=lambda x: -funlib.rankValue(x, game.settings))
+        discardRank.sort(key=lambda x: -game.rules.rankValues[x.code])
 
         ranks: dict[str, int] = {}
         for card in discardRank:
             ranks[card.id] = 0
         # each card is "ranked" by how many times it appears in a meld if we were to add a wild to our hand
         # more melds means it's more likely that we'll want to keep that card
-        for meld in funlib.findMelds(self.hand.cards + [ServerCard(CardFace("joker", "W"))], game.settings, None):
+        for meld in hand.melds(None, 1):
             for card in meld:
                 if card.id in ranks:
                     ranks[card.id] = ranks[card.id] + 1
@@ -280,87 +279,235 @@ class BoardAIPlayer():
 
 
 class Game:
-    def __init__(self, l: 'net.Lobby'):
+    def __init__(self, l: 'net.Lobby', headless: bool = False):
         self.net = l.code
+        # a headless game is played out by AI players alone, with nobody connected (see simulate.py)
+        self.headless = headless
         self.settings = l.settings
-        games[self.net] = self
-        self.deck = Stack(l.settings.deck_count, l.settings.enable_jokers)
+        self.rules = l.rules
+        # card IDs are handed out by the game, so they can't be compared with the IDs of another game
+        self.cardIDs = CardIDs()
+        self.deck = Stack(l.settings.deck_count,
+                          l.settings.enable_jokers, self.cardIDs)
         self.discard = Stack(0, False)
+        # a player who has just disconnected may still be in the lobby until its actor gets to them
         self.players: list["BoardPlayer"] = [BoardPlayer(
-            net.connections[player]) for player in l.connections]
+            net.connections[player]) for player in l.connections if player in net.connections]
         self.aiPlayers = [BoardAIPlayer(player) for player in l.aiPlayers]
+        # the human players by connection ID, so actions don't have to search for the player sending them
+        self.playersByConnection = {
+            player.connection.id: player for player in self.players}
+        # every card in the game by ID, and the stack it's in, kept up to date by the moveCardsTo methods and redeck()
+        self.cardsByID = {card.id: card for card in self.deck.cards}
+        self.cardStacks = {card.id: self.deck for card in self.deck.cards}
         self.melds: list[Stack] = []
         self.turn_player: int = 0  # TODO: respect settings.first_turn
         self.turn_has_drawn: bool = False
         self.non_discardable_card: Optional[ServerCard] = None
+        # the game is changed by tasks on the lobby's actor, one at a time
+        self.actor = l.actor
+        # held while the game is changed, which is never contended on the actor, but keeps callers that play a game
+        # directly (such as the simulator) safe
+        self.lock = RLock()
+        self.scheduler = TurnScheduler(self)
+        # the number of turns that have been started, and who won once the round is over
+        self.turns = 0
+        self.winnerID: Optional[str] = None
+        # while events are being batched (see batchEvents), the events waiting to be sent
+        # moves are kept as (cards, destination, visible, owner), since each player may see a different version of them
+        self.batch: Optional[list] = None
+        # the game is only registered once it's complete, since other threads may look it up
+        games[self.net] = self
+
+    def broadcast(self, event: Event):
+        if self.batch is not None:
+            self.batch.append(event)
+            return
+        # every player gets the same event, so it's only encoded once per format (and not at all when nobody is connected)
+        encoded: dict[bool, Union[str, bytes]] = {}
+        for client in self.players:
+            binary = client.connection.binary
+            if binary not in encoded:
+                encoded[binary] = client.connection.encodeEvent(event)
+            client.connection.sendEncoded(encoded[binary])
+
+    def broadcastMove(self, cards: list[ServerCard], destination: Union[MoveDestinationPlayer, MoveDestinationMeld, MoveDesinationDiscard], visible: bool,
+                      owner: Optional[BoardPlayer] = None):
+        # a move has at most two versions, with the faces of the cards or without them, and each is only encoded once per
+        # format
+        # the owner (a player the cards are moving into the hand of) sees the faces even when nobody else does
+        if self.batch is not None:
+            self.batch.append((cards.copy(), destination, visible, owner))
+            return
+        encoded: dict[tuple[bool, bool], Union[str, bytes]] = {}
+        for client in self.players:
+            shown = visible or client is owner
+            key = (shown, client.connection.binary)
+            if key not in encoded:
+                encoded[key] = client.connection.encodeEvent(
+                    MoveEvent([card.makeForClient(shown) for card in cards], destination))
+            client.connection.sendEncoded(encoded[key])
+
+    @contextmanager
+    def batchEvents(self):
+        """
+        Collects the events broadcast inside the block, and sends them to each player as a single batch event when the
+        block ends. Batches can be nested; only the outermost one sends anything.
+        """
+        if self.batch is not None:
+            yield
+            return
+        self.batch = []
+        try:
+            yield
+        finally:
+            self.flushBatch()
+            self.batch = None
+
+    def flushBatch(self):
+        # sends the events batched so far, and keeps batching
+        if not self.batch:
+            return
+        batch = self.batch
+        self.batch = []
+        encoded: dict[tuple, Union[str, bytes]] = {}
+        for client in self.players:
+            # players only get different batches when they see the faces of different moves (or use different formats)
+            shownMoves = tuple(entry[2] or client is entry[3]
+                               for entry in batch if isinstance(entry, tuple))
+            key = (client.connection.binary,) + shownMoves
+            if key not in encoded:
+                events: list = []
+                shown = iter(shownMoves)
+                for entry in batch:
+                    if isinstance(entry, tuple):
+                        visible = next(shown)
+                        entry = MoveEvent(
+                            [card.makeForClient(visible) for card in entry[0]], entry[1])
+                    events.append(entry)
+                encoded[key] = client.connection.encodeEvent(
+                    events[0] if len(events) == 1 else BatchEvent(events))
+            client.connection.sendEncoded(encoded[key])
 
     def moveCardsToDiscard(self, cards: list[ServerCard], originalStack: Stack):
         originalStack.remove(cards)
         destPosition = len(self.discard.cards)
-        for client in self.players:
-            client.connection.sendEvent(MoveEvent([
-                card.makeForClient(True) for card in cards
-            ], MoveDesinationDiscard()))
+        self.broadcastMove(cards, MoveDesinationDiscard(), True)
         self.discard.insert(cards, destPosition)
+        self.placeCards(cards, self.discard)
 
     def moveCardsToHand(self, cards: list[ServerCard], originalStack: Stack, player: BoardPlayer, destPosition: int):
         originalStack.remove(cards)
         destPosition = min(max(destPosition, 0), len(player.hand.cards))
-        for client in self.players:
-            client.connection.sendEvent(MoveEvent([
-                card.makeForClient(client is player) for card in cards
-            ], MoveDestinationPlayer(player.connection.id, destPosition)))
+        self.broadcastMove(cards, MoveDestinationPlayer(
+            player.connection.id, destPosition), False, player)
         player.hand.insert(cards, destPosition)
+        self.placeCards(cards, player.hand)
 
     def moveCardsToAIHand(self, cards: list[ServerCard], originalStack: Stack, player: BoardAIPlayer, destPosition: int):
         originalStack.remove(cards)
         destPosition = min(max(destPosition, 0), len(player.hand.cards))
-        for client in self.players:
-            client.connection.sendEvent(MoveEvent([
-                card.makeForClient(False) for card in cards
-            ], MoveDestinationPlayer(player.profile.id, destPosition)))
+        self.broadcastMove(cards, MoveDestinationPlayer(
+            player.profile.id, destPosition), False)
         player.hand.insert(cards, destPosition)
+        self.placeCards(cards, player.hand)
 
     def moveCardsToMeld(self, cards: list[ServerCard], originalStack: Stack, meldNumber: int, destPosition: int):
         originalStack.remove(cards)
         meldNumber = min(max(meldNumber, 0), len(self.melds))
         if (meldNumber > len(self.melds) - 1):
             self.melds.append(Stack(0, False))
-        destPosition = min(max(destPosition, 0), len(
-            self.melds[meldNumber].cards))
-        for client in self.players:
-            client.connection.sendEvent(MoveEvent([
-                card.makeForClient(True) for card in cards
-            ], MoveDestinationMeld(meldNumber, destPosition)))
-        self.melds[meldNumber].insert(cards, destPosition)
+        meld = self.melds[meldNumber]
+        destPosition = min(max(destPosition, 0), len(meld.cards))
+        self.broadcastMove(cards, MoveDestinationMeld(
+            meldNumber, destPosition), True)
+        # cards already in the meld may be passed in to reorder it, so only the new ones are added to its index
+        accepts = meld.acceptsFor(self.rules)
+        added = [card for card in cards if card not in meld]
+        meld.insert(cards, destPosition)
+        meld.accepts = accepts.add(added)
+        self.placeCards(added, meld)
+
+    def placeCards(self, cards: list[ServerCard], stack: Stack):
+        for card in cards:
+            self.cardStacks[card.id] = stack
+
+    def playerFor(self, connection: 'net.Connection'):
+        return self.playersByConnection.get(connection.id)
+
+    def findCards(self, cardIDs: list[str], stack: Stack):
+        """
+        Looks up cards by ID, making sure they're all in a stack (such as a player's hand).
+
+        Args:
+            cardIDs (list[str]): The IDs of the cards. An ID that's repeated only counts once.
+            stack (Stack): The stack the cards have to be in.
+
+        Returns:
+            The cards, in the order of their IDs, or None if any of them isn't in the stack.
+        """
+        cards: list[ServerCard] = []
+        for cardID in dict.fromkeys(cardIDs):
+            if self.cardStacks.get(cardID) is not stack:
+                return None
+            cards.append(self.cardsByID[cardID])
+        return cards
+
+    def reassignIDs(self, cards: list[ServerCard], ids: list[str]):
+        # new IDs obscure the order of the cards, and replace the old ones in the index
+        for card, cardID in zip(cards, ids):
+            stack = self.cardStacks.pop(card.id)
+            del self.cardsByID[card.id]
+            card.id = cardID
+            self.cardsByID[card.id] = card
+            self.cardStacks[card.id] = stack
 
     def deal(self):
+        with self.batchEvents():
+            self.dealCards()
+
+    def dealCards(self):
         for i in range(self.settings.hand_size):
             for player in self.players:
                 card = self.deck.top()
                 assert card is not None
                 self.moveCardsToHand(
-                    [card], self.deck, player, player.getDestinationHandPosition(card, self.settings))
+                    [card], self.deck, player, player.getDestinationHandPosition(card, self.rules))
             for player in self.aiPlayers:
                 card = self.deck.top()
                 assert card is not None
                 self.moveCardsToAIHand(
-                    [card], self.deck, player, player.getDestinationHandPosition(card, self.settings))
+                    [card], self.deck, player, player.getDestinationHandPosition(card, self.rules))
         discard = self.deck.top()
         assert discard is not None
         self.moveCardsToDiscard([discard], self.deck)
 
-    def notifyPlayersOfTurnState(self):
+    def turnPlayerID(self):
         if (self.turn_player < len(self.players)):
             # it's a human player's turn
+            return self.players[self.turn_player].connection.id
+        # it's an AI player's turn
+        return self.aiPlayers[self.turn_player - len(self.players)].profile.id
+
+    def notifyPlayersOfTurnState(self):
+        self.broadcast(TurnEvent(self.turnPlayerID(), "play" if self.turn_has_drawn else "draw"))
+        if self.batch is None:
+            # a new turn ends the frame, so clients coalescing events see it without waiting out the window
             for client in self.players:
-                client.connection.sendEvent(TurnEvent(
-                    self.players[self.turn_player].connection.id, "play" if self.turn_has_drawn else "draw"))
-        else:
-            # it's an AI player's turn
-            for client in self.players:
-                client.connection.sendEvent(TurnEvent(
-                    self.aiPlayers[self.turn_player - len(self.players)].profile.id, "play" if self.turn_has_drawn else "draw"))
+                client.connection.endFrame()
+
+    def syncEventFor(self, client: BoardPlayer):
+        # the whole game as one player sees it, for a client that fell behind (see Connection.overflow)
+        return SyncEvent(ClientBoard(
+            [player.makeForClient(client is player) for player in self.players] +
+            [player.makeForClient() for player in self.aiPlayers],
+            client.connection.id,
+            TurnState(self.turnPlayerID(), "play" if self.turn_has_drawn else "draw"),
+            [[card.makeForClient(True) for card in meld.cards] for meld in self.melds],
+            [card.makeForClient(False) for card in self.deck.cards],
+            [card.makeForClient(True) for card in self.discard.cards],
+            self.net
+        ), self.settings)
 
     def start(self):
         for client in self.players:
@@ -375,6 +522,8 @@ class Game:
         self.deal()
         # kick off the first turn
         self.notifyPlayersOfTurnState()
+        if self.scheduler.turnPending():
+            self.scheduler.wake()
 
     def redeck(self):
         if self.settings.deck_exhaust == "end_round" or len(self.discard.cards) == 0:
@@ -387,15 +536,14 @@ class Game:
             self.deck.cards = self.discard.cards
             self.deck.cards.reverse()
             self.discard.cards = []
+            self.placeCards(self.deck.cards, self.deck)
 
             # reassign new IDs to the cards in the deck, to obscure the order of the cards
-            for card in self.deck.cards:
-                card.id = uuid4().hex
-
-            # send the new card IDs to the client
-            for client in self.players:
-                client.connection.sendEvent(RedeckEvent(
-                    [card.id for card in self.deck.cards]))
+            # clients work the new IDs out from the nonce, so only the nonce and the number of cards are sent
+            nonce = self.cardIDs.next()
+            self.reassignIDs(self.deck.cards, redeckIDs(
+                nonce, len(self.deck.cards)))
+            self.broadcast(RedeckEvent(nonce, len(self.deck.cards)))
 
             # flip the top card to start the discard pile
             discard = self.deck.top()
@@ -409,15 +557,14 @@ class Game:
             self.deck.cards = self.discard.cards
             shuffle(self.deck.cards)
             self.discard.cards = []
+            self.placeCards(self.deck.cards, self.deck)
 
             # reassign new IDs to the cards in the deck, to obscure the order of the cards
-            for card in self.deck.cards:
-                card.id = uuid4().hex
-
-            # send the new card IDs to the client
-            for client in self.players:
-                client.connection.sendEvent(RedeckEvent(
-                    [card.id for card in self.deck.cards]))
+            # clients work the new IDs out from the nonce, so only the nonce and the number of cards are sent
+            nonce = self.cardIDs.next()
+            self.reassignIDs(self.deck.cards, redeckIDs(
+                nonce, len(self.deck.cards)))
+            self.broadcast(RedeckEvent(nonce, len(self.deck.cards)))
 
             # flip the top card to start the discard pile
             discard = self.deck.top()
@@ -427,22 +574,29 @@ class Game:
             return True
 
     def end(self, winnerID: Optional[str]):
-        # TODO: if settings.lay_at_end is enabled, automatically all possible cards to minimize hand scores
+        self.winnerID = winnerID
         event = EndEvent(winnerID, {
-            player.connection.id: sum(funlib.scoreValue(card, self.settings) for card in player.hand.cards) for player in self.players
+            player.connection.id: self.handValue(player.hand) for player in self.players
         } | {
-            player.profile.id: sum(funlib.scoreValue(card, self.settings) for card in player.hand.cards) for player in self.aiPlayers
+            player.profile.id: self.handValue(player.hand) for player in self.aiPlayers
         })
-        for client in self.players:
-            client.connection.sendEvent(event)
+        self.broadcast(event)
+        # the lobby event below has to arrive after everything that led up to the end
+        self.flushBatch()
 
         # deleting the games entry stops player actions from being processed as game actions
-        del games[self.net]
+        games.discard(self.net, self)
 
         # sending a net event updates clients on what players are still in the net for the next round
         if self.net in net.lobbies:
             net.lobbies[self.net].informPlayersOfLobby()
 
+    def handValue(self, hand: Stack):
+        if self.settings.lay_at_end:
+            # all possible cards are automatically laid down to minimize the hand's score
+            return funlib.handValue(hand.cards, self.melds, self.rules)
+        return sum(self.rules.scoreValues[card.code] for card in hand.cards)
+
     def checkGameOver(self):
         winner = None
         for player in self.players:
@@ -470,18 +624,22 @@ class Game:
                 connectedPlayers += 1
 
         # if there are no human players left, or if there are less than two active (connected or AI) players, end the round
-        if connectedPlayers == 0 or connectedPlayers + len(self.aiPlayers) < 2:
+        if (connectedPlayers == 0 and not self.headless) or connectedPlayers + len(self.aiPlayers) < 2:
             self.end(None)
             return
 
         # if the deck is exhausted, flip or resuffle the deck according to the game settings
         if len(self.deck.cards) == 0:
-            if not self.redeck():
+            # the new deck and the card flipped onto the discard pile go out together
+            with self.batchEvents():
+                redecked = self.redeck()
+            if not redecked:
                 return
 
         # increment the turn counter, wrapping around at the end (once we've gone through all AI and human players)
         self.turn_player = (self.turn_player +
                             1) % (len(self.players) + len(self.aiPlayers))
+        self.turns += 1
 
         # set game state to the beginning of a turn
         self.turn_has_drawn = False
@@ -490,23 +648,110 @@ class Game:
         # send a message to all clients notifying them of the current turn state
         self.notifyPlayersOfTurnState()
 
-        # turns start with players, then AI, so low self.turn_player indicates a player turn
-        if (self.turn_player < len(self.players)):
-            # a human player needs to take a turn
-            if not self.players[self.turn_player].connection.id in net.connections:
-                # skip this player if they have disconnected
-                self.players[self.turn_player].skipTurn(self)
-        else:
-            # an AI player needs to take a turn
-            self.aiPlayers[self.turn_player - len(self.players)].takeTurn(self)
+        # AI turns and the turns of disconnected players are played by the scheduler, one after another
+        if self.scheduler.turnPending():
+            self.scheduler.wake()
 
     def removePlayer(self, playerID: str):
         # the player is still in the game, but no longer in the net (disconnected)
-        # if they were currently playing a turn, skip to the next player
-        if (self.turn_player < len(self.players)):
-            if (self.players[self.turn_player].connection.id == playerID):
-                self.players[self.turn_player].skipTurn(self)
+        # if they were currently playing a turn, the scheduler skips to the next player
+        with self.lock:
+            if (self.turn_player < len(self.players)):
+                if (self.players[self.turn_player].connection.id == playerID):
+                    self.scheduler.wake()
+
+    def isCurrentTurn(self, connection: 'net.Connection'):
+        return self.turn_player < len(self.players) and self.players[self.turn_player].connection is connection
+
+
+class TurnScheduler:
+    """
+    Plays the turns that don't wait on a human: AI turns, and the turns of players who have disconnected.
+
+    Turns are played one at a time rather than by each turn starting the next. In the background (the default), each turn
+    is a separate task on the game's actor, so the connection whose action ended a human turn doesn't wait for the AI
+    turns that follow, actions that arrive meanwhile are handled between turns, and a table with a long run of AI turns
+    doesn't keep a worker from the other tables.
+
+    Properties:
+        game (Game): The game whose turns are played.
+        background (bool): Whether turns are played on the game's actor, rather than by whoever wakes the scheduler.
+        running (bool): Whether a turn is currently being played or waiting to be played.
+    """
+
+    def __init__(self, game: Game, background: bool = True):
+        """
+        Args:
+            game (Game): The game whose turns are played.
+            background (bool): Whether turns are played on the game's actor.
+        """
+        self.game = game
+        self.background = background
+        self.running = False
+
+    def turnPending(self):
+        # whether the current turn is one the scheduler should play
+        game = self.game
+        if games.get(game.net) is not game:
+            return False
+        if game.turn_player >= len(game.players):
+            return True
+        return not game.players[game.turn_player].connection.id in net.connections
 
-    def assertCurrentTurn(self, connection: 'net.Connection'):
-        assert self.turn_player < len(
-            self.players) and self.players[self.turn_player].connection is connection
+    def wake(self):
+        # called with the game lock held, whenever the current turn might be one to play
+        if self.running:
+            # a turn is already on its way, and the scheduler checks for another one after it
+            return
+        self.running = True
+        if self.background:
+            self.schedule()
+        else:
+            self.run()
+
+    def schedule(self):
+        # AI turns wait a moment so clients can follow them; skipping a disconnected player doesn't
+        if AI_TURN_DELAY > 0 and self.game.turn_player >= len(self.game.players):
+            timers.schedule(AI_TURN_DELAY, self.game.actor.submit, self.step)
+        else:
+            self.game.actor.submit(self.step)
+
+    def step(self):
+        # plays one turn on the actor, then queues the next one
+        try:
+            played = self.playTurn()
+        except Exception:
+            print_exc()
+            with self.game.lock:
+                self.running = False
+            return
+        if played:
+            self.schedule()
+
+    def run(self):
+        try:
+            for _ in self.turns():
+                pass
+        except Exception:
+            print_exc()
+            with self.game.lock:
+                self.running = False
+
+    def turns(self):
+        # plays a turn each time it's advanced, until a human has to play
+        while self.playTurn():
+            yield
+
+    def playTurn(self):
+        # returns False, and stops running, when there's no turn to play
+        game = self.game
+        with game.lock:
+            if not self.turnPending():
+                self.running = False
+                return False
+            if game.turn_player < len(game.players):
+                game.players[game.turn_player].skipTurn(game)
+            else:
+                game.aiPlayers[game.turn_player -
+                               len(game.players)].takeTurn(game)
+            return True
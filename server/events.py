@@ -1,93 +1,121 @@
+from contextlib import nullcontext
+
 import net
 from classes import *
 from protocol import *
 
 
 def handleAction(action: Action, connection: 'net.Connection'):
+    # actions in a running game are handled one at a time, since the game's turn scheduler plays AI turns on its own thread
+    game = games.get(connection.lobby.code, None)
+    with game.lock if game is not None else nullcontext():
+        error = _handleAction(action, connection)
+    if error is not None:
+        connection.reject(error, actionTypeNames[type(action)])
+
+
+def _handleAction(action: Action, connection: 'net.Connection') -> Optional[ErrorCode]:
+    # returns why the action was rejected, or None once it's been carried out
+    # a rejected action changes nothing, so every check comes before the first change
     print("Player " + connection.id +
           " (" + connection.name + "): " + str(action) + " action")
     lobby = connection.lobby
     # If the game hasn't started yet, this will be None
     game = games.get(lobby.code, None)
 
-    if isinstance(action, PongAction):
+    # the action classes are Protocols, which make isinstance slow, and are never subclassed, so the type is compared
+    if type(action) is PongAction:
 
         # A pong recieved from the client. Indicates that the connection is still active.
         pass
 
-    elif isinstance(action, NameAction):
+    elif type(action) is NameAction:
 
         # Sets the name of the current player.
         # The server should verify that the name is valid (not too long, not already in use, must contain a letter or number).
         #  - name (str): The name of the player.
-        assert game is None
+        if game is not None:
+            return "game_started"
         n = action.name.strip()
-        assert len(n) <= 20
-        assert any(c.isalnum() for c in n)
+        if len(n) > 20 or not any(c.isalnum() for c in n):
+            return "invalid_name"
         connection.name = n
         connection.lobby.informPlayersOfLobby()
 
-    elif isinstance(action, AIAction):
+    elif type(action) is AIAction:
 
         # Add or remove an AI player.
         # If adding a player, the server should verify that there's room in the lobby and that the game has not started.
         # If removing a player, the server should verify that there is an AI player in the lobby to remove, and the game has not started.
         #  - action (Literal["add", "remove"]): The action to perform.
-        assert game is None
+        if game is not None:
+            return "game_started"
         if action.action == "add":
             connection.lobby.addAIPlayer()
         elif action.action == "remove":
             connection.lobby.removeAIPlayer()
 
-    elif isinstance(action, JoinAction):
+    elif type(action) is JoinAction:
 
         # Joins a game. A game is left when the websocket connection is closed.
         # The server should verify that the game is not already running, and that thare are less than 4 players in the game.
         #  - code (str): The game code to join.
-        assert game is None
-        if action.code in net.lobbies and not action.code in games and len(net.lobbies[action.code].connections) + len(net.lobbies[action.code].aiPlayers) < 4:
-            net.lobbies[action.code].addPlayer(connection)
-
-    elif isinstance(action, StartAction):
+        if game is not None:
+            return "game_started"
+        target = net.lobbies.get(action.code)
+        if target is None:
+            return "cannot_join"
+        if target is lobby:
+            # already there, and leaving the lobby first would close it
+            return None
+        # the lobby being joined belongs to another actor, so it's locked while it's checked and joined
+        with net.lobbies.locking(lobby.code, target.code):
+            if net.lobbies.get(target.code) is not target or target.code in games or target.playerCount() >= 4:
+                return "cannot_join"
+            target.addPlayer(connection)
+
+    elif type(action) is StartAction:
 
         # Starts the current game.
         # The server should verify that at least two players are in the game.
-        assert game is None
-        assert len(lobby.connections) + len(lobby.aiPlayers) >= 2
-        game = Game(lobby)
+        if game is not None:
+            return "game_started"
+        # locked so nobody can join while the game is being set up
+        with net.lobbies.locking(lobby.code):
+            if lobby.playerCount() < 2:
+                return "not_enough_players"
+            game = Game(lobby)
         game.start()
 
-    elif isinstance(action, DrawAction):
+    elif type(action) is DrawAction:
 
         # Draws a card from the deck or the discard pile.
         # The server should verify that the card ID is at the top of the discard pile or the deck.
         #  - card_id (str): The ID of the card to draw. This can be the top card of the deck or the top card of the discard pile.
-        assert game is not None
-        player: Optional[BoardPlayer] = None
-        for p in game.players:
-            if p.connection is connection:
-                player = p
-                break
-        assert player is not None
-        game.assertCurrentTurn(connection)
-        assert game.turn_has_drawn is False
+        if game is None:
+            return "no_game"
+        player = game.playerFor(connection)
+        if player is None or not game.isCurrentTurn(connection):
+            return "not_your_turn"
+        if game.turn_has_drawn:
+            return "already_drawn"
         deckCard = game.deck.top()
         discardCard = game.discard.top()
         if deckCard is not None and deckCard.id == action.card_id:
             game.moveCardsToHand([deckCard], game.deck, player, player.getDestinationHandPosition(
-                deckCard, game.settings))
+                deckCard, game.rules))
             game.turn_has_drawn = True
             game.notifyPlayersOfTurnState()
         elif discardCard is not None and discardCard.id == action.card_id:
             game.moveCardsToHand([discardCard], game.discard, player, player.getDestinationHandPosition(
-                discardCard, game.settings))
+                discardCard, game.rules))
             game.turn_has_drawn = True
             game.non_discardable_card = discardCard
             game.notifyPlayersOfTurnState()
         else:
-            raise RuntimeError("Invalid card ID")
+            return "card_not_found"
 
-    elif isinstance(action, MeldAction):
+    elif type(action) is MeldAction:
 
         # TODO: "Rummy"
         # TODO: A player can't go out until at least their second turn
@@ -95,27 +123,26 @@ def handleAction(action: Action, connection: 'net.Connection'):
         # Lay down some cards to create a meld.
         # The server should verify that (A) all cards are in the player's hand, and (B) that the cards form a valid meld.
         #  - card_ids (list[str]): A list of card IDs to lay down.
-        assert game is not None
-        player: Optional[BoardPlayer] = None
-        for p in game.players:
-            if p.connection is connection:
-                player = p
-                break
-        assert player is not None
-        game.assertCurrentTurn(connection)
-        assert game.turn_has_drawn is True
-        if game.settings.require_end_discard:
+        if game is None:
+            return "no_game"
+        player = game.playerFor(connection)
+        if player is None or not game.isCurrentTurn(connection):
+            return "not_your_turn"
+        if not game.turn_has_drawn:
+            return "not_drawn"
+        if game.settings.require_end_discard and len(action.card_ids) >= len(player.hand.cards):
             # only allow a meld or lay if there's at least a card left over to discard
-            assert len(action.card_ids) < len(player.hand.cards)
-        assert all(any(c == h.id for h in player.hand.cards)
-                   for c in action.card_ids)
-        cards = [c for c in player.hand.cards if c.id in action.card_ids]
-        assert funlib.checkLegal(cards, game.settings)
-        funlib.sortStack(cards, game.settings)
+            return "must_keep_discard"
+        cards = game.findCards(action.card_ids, player.hand)
+        if cards is None:
+            return "card_not_found"
+        if not funlib.checkLegal(cards, game.rules):
+            return "illegal_meld"
+        game.rules.sortMeld(cards)
         game.moveCardsToMeld(cards, player.hand, len(game.melds), 0)
         game.checkGameOver()
 
-    elif isinstance(action, LayAction):
+    elif type(action) is LayAction:
 
         # TODO: A player can't go out until at least their second turn
 
@@ -123,61 +150,64 @@ def handleAction(action: Action, connection: 'net.Connection'):
         # The server should verify that the card is in the player's hand, and that the card forms a valid meld.
         #  - card_ids (list[str]): The ID of the card to lay.
         #  - meld_number (int): The index of the meld to add the card to.
-        assert game is not None
-        player: Optional[BoardPlayer] = None
-        for p in game.players:
-            if p.connection is connection:
-                player = p
-                break
-        assert player is not None
-        game.assertCurrentTurn(connection)
-        assert game.turn_has_drawn is True
-        if game.settings.require_end_discard:
+        if game is None:
+            return "no_game"
+        player = game.playerFor(connection)
+        if player is None or not game.isCurrentTurn(connection):
+            return "not_your_turn"
+        if not game.turn_has_drawn:
+            return "not_drawn"
+        if game.settings.require_end_discard and len(action.card_ids) >= len(player.hand.cards):
             # only allow a meld or lay if there's at least a card left over to discard
-            assert len(action.card_ids) < len(player.hand.cards)
-        assert len(game.melds) > action.meld_number
-        assert all(any(c == h.id for h in player.hand.cards)
-                   for c in action.card_ids)
-        cards = game.melds[action.meld_number].cards + \
-            [c for c in player.hand.cards if c.id in action.card_ids]
-        assert funlib.checkLegal(cards, game.settings)
-        funlib.sortStack(cards, game.settings)
+            return "must_keep_discard"
+        if not 0 <= action.meld_number < len(game.melds):
+            return "no_such_meld"
+        laid = game.findCards(action.card_ids, player.hand)
+        if laid is None:
+            return "card_not_found"
+        meld = game.melds[action.meld_number]
+        if len(laid) == 1:
+            legal = meld.acceptsFor(game.rules).get(laid[0].code)
+        else:
+            legal = funlib.checkLegal(meld.cards + laid, game.rules)
+        if not legal:
+            return "illegal_meld"
+        cards = game.rules.sortMeld(meld.cards + laid)
         game.moveCardsToMeld(cards, player.hand, action.meld_number, 0)
         game.checkGameOver()
 
-    elif isinstance(action, DiscardAction):
+    elif type(action) is DiscardAction:
 
         # Discard a card. This ends the player's turn.
         # The server should verify that the card is in the player's hand.
         #  - card_id (str): The ID of the card to discard.
-        assert game is not None
-        player: Optional[BoardPlayer] = None
-        for p in game.players:
-            if p.connection is connection:
-                player = p
-                break
-        assert player is not None
-        game.assertCurrentTurn(connection)
-        assert game.turn_has_drawn is True
-        card: Optional[ServerCard] = None
-        for c in player.hand.cards:
-            if c.id == action.card_id:
-                card = c
-                break
-        assert card is not None
-        assert card is not game.non_discardable_card
+        if game is None:
+            return "no_game"
+        player = game.playerFor(connection)
+        if player is None or not game.isCurrentTurn(connection):
+            return "not_your_turn"
+        if not game.turn_has_drawn:
+            return "not_drawn"
+        cards = game.findCards([action.card_id], player.hand)
+        if cards is None:
+            return "card_not_found"
+        card = cards[0]
+        if card is game.non_discardable_card:
+            return "cannot_discard"
         game.moveCardsToDiscard([card], player.hand)
         if not game.checkGameOver():
             game.nextTurn()
 
-    elif isinstance(action, SettingsAction):
+    elif type(action) is SettingsAction:
 
         # Changes the current game settings.
         # The server should verify that the settings are valid and that the game has not started.
         #  - settings (GameSettings): The new settings.
-        assert game is None
-        lobby.settings = action.settings
+        if game is not None:
+            return "game_started"
+        lobby.changeSettings(action.settings)
         lobby.informPlayersOfLobby()
 
     else:
         raise RuntimeError("Unknown action type")
+    return None
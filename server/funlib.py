@@ -1,19 +1,27 @@
-from copy import copy
-from functools import reduce
+import os
 from random import shuffle
 from typing import Optional
-from uuid import uuid4
 
+import analysis
+import cardcodes
 import classes
-from protocol import CardFace, CardRank, GameSettings
+import solver
+from cardids import CardIDs
+from gamerules import GameRules
+from lru import LRUCache
+from meldindex import RUN, SET
+from protocol import CardFace, CardRank
+
+# results of checkLegal, checkRun and checkSet, keyed by the sorted face codes and the rules that apply
+# the size can be tuned with the RUMMY_LEGAL_CACHE_SIZE environment variable; legalCache.info() reports the hit rate
+legalCache: LRUCache[bool] = LRUCache(
+    int(os.environ.get("RUMMY_LEGAL_CACHE_SIZE", 65536)))
 
 # this just returns one or more decks, shuffled.
 
 
-def sortStack(cards: list['classes.ServerCard'], settings: GameSettings):
-    cards.sort(key=lambda card: card.sortingSuitPosition(settings))
-    cards.sort(key=lambda card: card.sortingRankPosition(settings))
-    return cards
+def sortStack(cards: list['classes.ServerCard'], rules: GameRules):
+    return rules.sortMeld(cards)
 
 
 def printCards(cards: list['classes.ServerCard']):
@@ -32,161 +40,112 @@ def printCards(cards: list['classes.ServerCard']):
     }[card.face.suit] + "\x1b[0m" for card in cards]))
 
 
-def findRuns(cards: list['classes.ServerCard'], settings: GameSettings):
-    nonWilds = [card for card in cards if card.face.rank != "W"]
-    wilds = [card for card in cards if card.face.rank == "W"]
-    buckets: dict[str, list['classes.ServerCard']] = {}
-    for card in nonWilds:
-        suit = "*" if settings.allow_run_mixed_suit else card.face.suit
-        if suit not in buckets:
-            buckets[suit] = []
-        buckets[suit].append(card)
-    runs: list[list['classes.ServerCard']] = []
-    for suit in buckets:
-        bucket = buckets[suit]
-        bucket.sort(key=lambda card: rankValue(card, settings))
-        for i in range(len(bucket)):
-            run = [bucket[i]]
-            availableWilds = len(wilds)
-            for j in range(i + 1, len(bucket)):
-                if rankValue(bucket[j], settings) == rankValue(run[-1], settings):
-                    continue
-                if rankValue(bucket[j], settings) > rankValue(run[-1], settings) and \
-                        rankValue(bucket[j], settings) - rankValue(run[-1], settings) - 1 <= availableWilds and\
-                            (settings.limit_meld_size is None or len(run) + rankValue(bucket[j], settings) - rankValue(run[-1], settings) <= settings.limit_meld_size):
-                    for k in range(rankValue(bucket[j], settings) - rankValue(run[-1], settings) - 1):
-                        run.append(wilds[-availableWilds])
-                        availableWilds -= 1
-                    run.append(bucket[j])
-                else:
-                    break
-            if len(run) + availableWilds >= 3:
-                for j in range(3 - len(run)):
-                    run.append(wilds[-availableWilds])
-                    availableWilds -= 1
-                runs.append(sortStack(run, settings))
-    return runs
-
-
-def findSets(cards: list['classes.ServerCard'], settings: GameSettings):
-    nonWilds = [card for card in cards if card.face.rank != "W"]
-    wilds = [card for card in cards if card.face.rank == "W"]
-    buckets = {}
-    for card in nonWilds:
-        if card.face.rank not in buckets:
-            buckets[card.face.rank] = []
-        buckets[card.face.rank].append(card)
-    sets: list[list['classes.ServerCard']] = [wilds[:i]
-                                              for i in range(3, len(wilds) + 1)]
-    for rank in buckets:
-        availableWilds = len(wilds)
-        bucket = sortStack(buckets[rank], settings)
-        if not settings.allow_set_duplicate_suit:
-            suits = []
-            bucket = [*filter(lambda card: (suits.append(card.face.suit) or True)
-                              if card.face.suit not in suits else False, bucket)]
-        if settings.limit_meld_size is not None and len(bucket) > settings.limit_meld_size:
-            bucket = bucket[:settings.limit_meld_size]
-        if len(bucket) >= 3:
-            sets.append(bucket)
-        # only add wilds to sets of 2 or more, since a lone card will be caught by findRun as a run of 3 with two wilds
-        # this isn't strictly necessary, but it prevents duplicate melds being found
-        if availableWilds > 0 and len(bucket) >= 2 and len(bucket) + availableWilds >= 3:
-            if len(bucket) < 3 and len(bucket) + availableWilds > 3:
-                sets.append(
-                    sortStack(bucket + wilds[:3 - len(bucket)], settings))
-            sets.append(sortStack(bucket + wilds, settings))
-    return sets
-
-
-def findLays(card: 'classes.ServerCard', melds: list['classes.Stack'], settings: GameSettings, runsOnly: bool):
-    indexes: list[int] = []
-    for i in range(len(melds)):
-        meld = melds[i]
-        if card.face.rank == "W":
-            indexes.append(i)
-            continue
-        if checkLegal(meld.cards + [card], settings) and (not runsOnly or checkRun(meld.cards + [card], settings)):
-            indexes.append(i)
-            continue
-    return indexes
-
-
-def findNextPreferredLay(cards: list['classes.ServerCard'], melds: list['classes.Stack'], settings: GameSettings, cannotDiscard: Optional['classes.ServerCard']):
-    if len(melds) == 0:
-        return None, None
+def findRuns(cards: list['classes.ServerCard'], rules: GameRules):
+    return rules.findRuns(cards)
 
-    if settings.require_end_discard and len(cards) == 1:
-        return None, None
 
-    # first look for runs that don't involve jokers
-    for i in range(len(cards)):
-        if len(cards) == 2 and cards[(i + 1) % 2] is cannotDiscard:
-            continue
-        if cards[i].face.suit == "joker":
-            continue
-        lays = findLays(cards[i], melds, settings, True)
-        if len(lays) > 0:
-            return i, lays[0]
-
-    # if there are no runs, find sets that don't involve jokers
-    for i in range(len(cards)):
-        if len(cards) == 2 and cards[(i + 1) % 2] is cannotDiscard:
-            continue
-        if cards[i].face.suit == "joker":
-            continue
-        lays = findLays(cards[i], melds, settings, False)
-        if len(lays) > 0:
-            return i, lays[0]
-
-    nonWilds = [card for card in cards if card.face.suit != "joker"]
-
-    # don't lay wilds unnecessarily
-    if len(nonWilds) > 1 or (len(nonWilds) == 1 and nonWilds[0] is cannotDiscard):
-        return None, None
+def findSets(cards: list['classes.ServerCard'], rules: GameRules):
+    return rules.findSets(cards)
+
+
+def findLays(card: 'classes.ServerCard', melds: list['classes.Stack'], rules: GameRules, runsOnly: bool):
+    kinds = RUN if runsOnly else RUN | SET
+    return [i for i, meld in enumerate(melds) if meld.acceptsFor(rules).get(card.code) & kinds]
 
-    # if there are no sets or runs without jokers, find runs that involve jokers
-    for i in range(len(cards)):
-        if len(cards) == 2 and cards[(i + 1) % 2] is cannotDiscard:
-            continue
-        if cards[i].face.suit != "joker":
-            continue
-        lays = findLays(cards[i], melds, settings, True)
-        if len(lays) > 0:
-            return i, lays[0]
-
-    # finally, find sets that involve jokers
-    for i in range(len(cards)):
-        if len(cards) == 2 and cards[(i + 1) % 2] is cannotDiscard:
-            continue
-        if cards[i].face.suit != "joker":
-            continue
-        lays = findLays(cards[i], melds, settings, False)
-        if len(lays) > 0:
-            return i, lays[0]
-
-    return None, None
+
+def findLayPlan(cards: list['classes.ServerCard'], melds: list['classes.Stack'], rules: GameRules, cannotDiscard: Optional['classes.ServerCard']):
+    # every card to lay onto an existing meld, in order, as (card, meld number) pairs
+    # each lay is the one preferred at that point: runs first, then sets, and wilds only once they're all that's left
+    # neither `cards` nor `melds` are changed
+    if len(melds) == 0:
+        return []
+    cards = cards.copy()
+    accepts = [meld.acceptsFor(rules) for meld in melds]
+    # a meld's index is only copied once something is planned to be laid onto it
+    copied = [False] * len(melds)
+
+    # bitmasks of the melds that each card can be laid onto, as part of a run or at all
+    runMasks: list[int] = []
+    layMasks: list[int] = []
+    for card in cards:
+        runMask = layMask = 0
+        for m in range(len(accepts)):
+            kinds = accepts[m].get(card.code)
+            if kinds:
+                layMask |= 1 << m
+                if kinds & RUN:
+                    runMask |= 1 << m
+        runMasks.append(runMask)
+        layMasks.append(layMask)
+
+    def nextLay(remaining: list[int]):
+        for wild, masks in ((False, runMasks), (False, layMasks), (True, runMasks), (True, layMasks)):
+            if wild:
+                # don't lay wilds unnecessarily
+                nonWilds = [i for i in remaining if cards[i].code != cardcodes.JOKER]
+                if len(nonWilds) > 1 or (len(nonWilds) == 1 and cards[nonWilds[0]] is cannotDiscard):
+                    return None
+            for i in remaining:
+                if (cards[i].code == cardcodes.JOKER) != wild or masks[i] == 0:
+                    continue
+                # never leave the card we can't discard as the only card in our hand
+                if len(remaining) == 2 and cards[remaining[remaining[0] == i]] is cannotDiscard:
+                    continue
+                return i, (masks[i] & -masks[i]).bit_length() - 1
+        return None
+
+    plan: list[tuple['classes.ServerCard', int]] = []
+    remaining = list(range(len(cards)))
+    while not rules.requireEndDiscard or len(remaining) > 1:
+        lay = nextLay(remaining)
+        if lay is None:
+            break
+        i, m = lay
+        plan.append((cards[i], m))
+        remaining.remove(i)
+        # only the meld that was laid onto accepts different cards now
+        if not copied[m]:
+            accepts[m] = accepts[m].copy()
+            copied[m] = True
+        accepts[m].add([cards[i]])
+        bit = 1 << m
+        for j in remaining:
+            kinds = accepts[m].get(cards[j].code)
+            layMasks[j] = layMasks[j] | bit if kinds else layMasks[j] & ~bit
+            runMasks[j] = runMasks[j] | bit if kinds & RUN else runMasks[j] & ~bit
+    return plan
+
+
+def findNextPreferredLay(cards: list['classes.ServerCard'], melds: list['classes.Stack'], rules: GameRules, cannotDiscard: Optional['classes.ServerCard']):
+    plan = findLayPlan(cards, melds, rules, cannotDiscard)
+    if len(plan) == 0:
+        return None, None
+    card, meldNumber = plan[0]
+    return next(i for i in range(len(cards)) if cards[i] is card), meldNumber
 
 
 def nonWildCards(cards: list['classes.ServerCard']):
-    return len([card for card in cards if card.face.rank != "W"])
+    return len([card for card in cards if card.code != cardcodes.JOKER])
 
 
-def canWinWith(meld: list['classes.ServerCard'], totalCards: int, settings: GameSettings):
+def canWinWith(meld: list['classes.ServerCard'], totalCards: int, rules: GameRules):
     winLength = totalCards - 1
-    return len(meld) >= winLength and (not settings.require_end_discard or len(meld) <= totalCards - 1)
-
-
-def findMelds(cards: list['classes.ServerCard'], settings: GameSettings, cannotDiscard: Optional['classes.ServerCard']):
-    maxLength = len(cards) - 1 if settings.require_end_discard else len(cards)
-    if settings.limit_meld_size is not None and maxLength > settings.limit_meld_size:
-        maxLength = settings.limit_meld_size
-    melds = findRuns(cards, settings) + findSets(cards, settings)
-    melds = [*filter(lambda meld:
-                     (nonWildCards(meld) >= 2 or canWinWith(
-                         meld, len(cards), settings))
-                     and len(meld) <= maxLength and
-                     (len(meld) < len(cards) - 1 or cannotDiscard is None or cannotDiscard in meld), melds)]
+    return len(meld) >= winLength and (not rules.requireEndDiscard or len(meld) <= totalCards - 1)
+
+
+def keepMeld(meld: list['classes.ServerCard'], totalCards: int, rules: GameRules, cannotDiscard: Optional['classes.ServerCard']):
+    # whether findMelds suggests a meld found in a hand of `totalCards` cards
+    maxLength = totalCards - 1 if rules.requireEndDiscard else totalCards
+    if rules.limit is not None and maxLength > rules.limit:
+        maxLength = rules.limit
+    return (nonWildCards(meld) >= 2 or canWinWith(meld, totalCards, rules)) and len(meld) <= maxLength and \
+        (len(meld) < totalCards - 1 or cannotDiscard is None or cannotDiscard in meld)
+
+
+def findMelds(cards: list['classes.ServerCard'], rules: GameRules, cannotDiscard: Optional['classes.ServerCard']):
+    melds = findRuns(cards, rules) + findSets(cards, rules)
+    melds = [meld for meld in melds if keepMeld(
+        meld, len(cards), rules, cannotDiscard)]
     # least important, sort by least number of wild cards
     melds.sort(key=lambda meld: len(meld) - nonWildCards(meld))
     # most important, sort by highest number of non-wild cards
@@ -195,8 +154,8 @@ def findMelds(cards: list['classes.ServerCard'], settings: GameSettings, cannotD
     return melds
 
 
-def findNextMeld(cards: list['classes.ServerCard'], settings: GameSettings, cannotDiscard: Optional['classes.ServerCard']):
-    melds = findMelds(cards, settings, cannotDiscard)
+def findNextMeld(cards: list['classes.ServerCard'], rules: GameRules, cannotDiscard: Optional['classes.ServerCard']):
+    melds = findMelds(cards, rules, cannotDiscard)
     print("Current melds:")
     for meld in melds:
         printCards(meld)
@@ -205,7 +164,30 @@ def findNextMeld(cards: list['classes.ServerCard'], settings: GameSettings, cann
     return melds[0]
 
 
-def newDeck(decks: int = 1, jokers: int = 0):
+def findMeldPlan(cards: list['classes.ServerCard'], rules: GameRules, cannotDiscard: Optional['classes.ServerCard']):
+    return analysis.HandAnalysis(cards, rules).meldPlan(cannotDiscard)
+
+
+def handValue(cards: list['classes.ServerCard'], melds: list['classes.Stack'], rules: GameRules):
+    # the score of a hand after laying down as many of its cards as possible, both as new melds and onto existing ones
+    partition = solver.solveHand(cards, rules)
+    tableMelds = [meld.cards.copy() for meld in melds] + partition.melds
+    hand = partition.deadwood.copy()
+    laid = True
+    while laid:
+        laid = False
+        for card in hand:
+            meld = next(
+                (meld for meld in tableMelds if checkLegal(meld + [card], rules)), None)
+            if meld is not None:
+                meld.append(card)
+                hand.remove(card)
+                laid = True
+                break
+    return sum(rules.scoreValues[card.code] for card in hand)
+
+
+def newDeck(decks: int = 1, jokers: int = 0, ids: Optional[CardIDs] = None):
     retval: list['classes.ServerCard'] = []
     ranks: list[CardRank] = ["A", "2", "3", "4",
                              "5", "6", "7", "8", "9", "10", "J", "Q", "K"]
@@ -221,10 +203,10 @@ def newDeck(decks: int = 1, jokers: int = 0):
                 suit = "spades"
             for n in range(13):
                 rank: CardRank = ranks[n]
-                retval.append(classes.ServerCard(CardFace(suit, rank)))
+                retval.append(classes.ServerCard(CardFace(suit, rank), ids))
         id = deck * 54 + 52
     for n in range(jokers):
-        retval.append(classes.ServerCard(CardFace("joker", "W")))
+        retval.append(classes.ServerCard(CardFace("joker", "W"), ids))
     shuffle(retval)
     return retval
 
@@ -235,14 +217,14 @@ def newDeck(decks: int = 1, jokers: int = 0):
 # Sets are 3+ of the same card, in different suits
 # Runs are 3+ in a row of the same suit, i.e. 3, 4, 5 of hearts or 10, J, Q of spades.
 # Aces are high or low, according to the settings.
-def checkLegal(cards: list['classes.ServerCard'], settings: GameSettings):
-    # Check for length real quick
-    if len(cards) < 3:
-        return False
-    if settings.limit_meld_size is not None and len(cards) > settings.limit_meld_size:
-        return False
-
-    return checkSet(cards, settings) or checkRun(cards, settings)
+def checkLegal(cards: list['classes.ServerCard'], rules: GameRules):
+    faces = tuple(sorted(card.code for card in cards))
+    key = ("legal", rules.fingerprint, faces)
+    legal = legalCache.get(key)
+    if legal is None:
+        legal = rules.checkLegal(faces)
+        legalCache.put(key, legal)
+    return legal
 
 
 # checkSet(cards)
@@ -251,98 +233,33 @@ def checkLegal(cards: list['classes.ServerCard'], settings: GameSettings):
 #
 # look through all the cards. If any of them are different numbers or the same suit, return false.
 # unless the offending card is a joker.
-def checkSet(cards: list['classes.ServerCard'], settings: GameSettings):
-    rank = None
-
-    # for each card, if it's a different number, return false
-    for i in range(len(cards)):
-        # we do need to know which number the set is tho
-        if (cards[i].face.rank != "W"):
-            if rank is None:
-                rank = cards[i].face.rank
-            elif rank != cards[i].face.rank:
-                return False
-
-    if not settings.allow_set_duplicate_suit:
-        if len(cards) > 4:
-            return False  # prevent using a wild as a 5th card
-
-        suits = []
-        # for each card, if it's suit has been represented already, return false.
-        for i in range(len(cards)):
-            # if that suit has been done already, return false.
-            if(cards[i].face.suit in suits and not cards[i].face.suit == "joker"):
-                return False
-            else:
-                suits.append(cards[i].face.suit)
-
-    # if we get this far, it's a set.
-    return True
-
-
-def rankValue(card: 'classes.ServerCard', settings: GameSettings):
-    if card.face.rank == "W":
-        return -1
-    elif card.face.rank == "J":
-        return 11
-    elif card.face.rank == "Q":
-        return 12
-    elif card.face.rank == "K":
-        return 13
-    elif card.face.rank == "A":
-        if settings.ace_rank == "low":
-            return 1
-        else:
-            return 14
-    else:
-        return int(card.face.rank)
-
-
-def scoreValue(card: 'classes.ServerCard', settings: GameSettings):
-    if card.face.rank == "W":
-        return 15
-    elif card.face.rank == "J":
-        return 10
-    elif card.face.rank == "Q":
-        return 10
-    elif card.face.rank == "K":
-        return 10
-    elif card.face.rank == "A":
-        if settings.ace_rank == "low":
-            return 1
-        else:
-            return 11
-    else:
-        return int(card.face.rank)
+def checkSet(cards: list['classes.ServerCard'], rules: GameRules):
+    faces = tuple(sorted(card.code for card in cards))
+    key = ("set", rules.fingerprint, faces)
+    legal = legalCache.get(key)
+    if legal is None:
+        legal = rules.checkSet(faces)
+        legalCache.put(key, legal)
+    return legal
+
+
+def rankValue(card: 'classes.ServerCard', rules: GameRules):
+    return rules.rankValues[card.code]
+
+
+def scoreValue(card: 'classes.ServerCard', rules: GameRules):
+    return rules.scoreValues[card.code]
 
 # checkSet but for runs.
 # cards is an array
 # returns a bool for whether cards is a valid run or not.
 
 
-def checkRun(cards: list['classes.ServerCard'], settings: GameSettings):
-    # prevent using a wild as a 14th card
-    if len(cards) > 13:
-        return False
-    # filter out non-wild cards and sort by rank
-    rankedCards = [card for card in cards if card.face.rank != "W"]
-    rankedCards.sort(key=lambda card: rankValue(card, settings))
-    if len(rankedCards) == 0:
-        return True
-    wilds = len(cards) - len(rankedCards)
-    if not settings.allow_run_mixed_suit:
-        # find out what suit the run is
-        suit = rankedCards[0].face.suit
-        # make sure all cards are the same suit.
-        if any(card.face.suit != suit for card in rankedCards):
-            return False
-    # find out what the first rank is
-    rank = rankValue(rankedCards[0], settings) - 1
-    # check each card
-    for card in rankedCards:
-        nextRank = rankValue(card, settings)
-        if nextRank - rank - 1 > wilds or nextRank <= rank:
-            return False
-        wilds -= nextRank - rank - 1
-        rank = nextRank
-    return True
+def checkRun(cards: list['classes.ServerCard'], rules: GameRules):
+    faces = tuple(sorted(card.code for card in cards))
+    key = ("run", rules.fingerprint, faces)
+    legal = legalCache.get(key)
+    if legal is None:
+        legal = rules.checkRun(faces)
+        legalCache.put(key, legal)
+    return legal
@@ -0,0 +1,124 @@
+from threading import Lock
+from typing import Any, Callable, Optional, Sequence
+
+import cardcodes
+from cardcodes import JOKER, Coded
+from protocol import GameSettings
+
+# This file compiles GameSettings into the rules the meld engine actually runs.
+#
+# The settings are a handful of flags that every rule check used to branch on. Compiling them once per lobby turns those
+# branches into lookup tables indexed by face code and into meld checks specialized for the variant being played.
+
+
+def _handSortKey(code: int, aceHigh: bool):
+    # hands are sorted by suit, then by rank, with wilds at the very end
+    if code == JOKER:
+        return 4 << 4 | 15
+    rank = code & 15
+    return (code >> 4) << 4 | (14 if rank == 1 and aceHigh else rank)
+
+
+class GameRules:
+    """
+    The meld rules of a game, compiled from its settings. Compiled rules can't be changed.
+
+    Properties:
+        fingerprint (tuple): The settings that decide whether cards form a meld (see GameSettings.fingerprint()).
+        requireEndDiscard (bool): Whether a player has to discard to end the round, so can't meld their whole hand.
+        aceHigh (bool): Whether aces rank above kings.
+        mixedSuit (bool): Whether runs may mix suits.
+        duplicateSuit (bool): Whether sets may repeat a suit.
+        limit (int | None): The most cards a meld may hold.
+        rankValues (tuple[int, ...]): The rank of each face code, used to order runs. Wilds have a rank of -1.
+        scoreValues (tuple[int, ...]): The points each face code is worth at the end of a round.
+        meldSortKeys (tuple[int, ...]): A key for each face code that sorts melds by rank, then suit, with wilds last.
+        handSortKeys (tuple[int, ...]): A key for each face code that sorts hands by suit, then rank, with wilds last.
+        checkRun (Callable[[Sequence[int]], bool]): Whether face codes form a run.
+        checkSet (Callable[[Sequence[int]], bool]): Whether face codes form a set.
+        checkLegal (Callable[[Sequence[int]], bool]): Whether face codes form a meld that can be laid down.
+    """
+
+    __slots__ = ("fingerprint", "requireEndDiscard", "aceHigh", "mixedSuit", "duplicateSuit", "limit", "rankValues",
+                 "scoreValues", "meldSortKeys", "handSortKeys", "checkRun", "checkSet", "checkLegal")
+
+    fingerprint: tuple
+    requireEndDiscard: bool
+    aceHigh: bool
+    mixedSuit: bool
+    duplicateSuit: bool
+    limit: Optional[int]
+    rankValues: tuple[int, ...]
+    scoreValues: tuple[int, ...]
+    meldSortKeys: tuple[int, ...]
+    handSortKeys: tuple[int, ...]
+    checkRun: Callable[[Sequence[int]], bool]
+    checkSet: Callable[[Sequence[int]], bool]
+    checkLegal: Callable[[Sequence[int]], bool]
+
+    def __init__(self, settings: GameSettings):
+        """
+        Args:
+            settings (GameSettings): The settings to compile.
+        """
+        aceHigh = settings.ace_rank == "high"
+        fields: dict[str, Any] = {
+            "fingerprint": settings.fingerprint(),
+            "requireEndDiscard": settings.require_end_discard,
+            "aceHigh": aceHigh,
+            "mixedSuit": settings.allow_run_mixed_suit,
+            "duplicateSuit": settings.allow_set_duplicate_suit,
+            "limit": settings.limit_meld_size,
+            "rankValues": tuple(cardcodes.RANK_VALUES[aceHigh]),
+            "scoreValues": tuple(cardcodes.SCORE_VALUES[aceHigh]),
+            "meldSortKeys": tuple(cardcodes.MELD_SORT_KEYS[aceHigh]),
+            "handSortKeys": tuple(_handSortKey(code, aceHigh) for code in range(cardcodes.CODE_COUNT)),
+            "checkRun": cardcodes.runChecker(aceHigh, settings.allow_run_mixed_suit),
+            "checkSet": cardcodes.setChecker(settings.allow_set_duplicate_suit),
+            "checkLegal": cardcodes.legalChecker(aceHigh, settings.allow_run_mixed_suit,
+                                                 settings.allow_set_duplicate_suit, settings.limit_meld_size),
+        }
+        for name, value in fields.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name: str, value: Any):
+        raise AttributeError("GameRules can't be changed")
+
+    def __delattr__(self, name: str):
+        raise AttributeError("GameRules can't be changed")
+
+    def sortMeld(self, cards: list[Coded]):
+        keys = self.meldSortKeys
+        cards.sort(key=lambda card: keys[card.code])
+        return cards
+
+    def sortHand(self, cards: list[Coded]):
+        keys = self.handSortKeys
+        cards.sort(key=lambda card: keys[card.code])
+        return cards
+
+    def findRuns(self, cards: list[Coded]):
+        return cardcodes.findRuns(cards, self.aceHigh, self.mixedSuit, self.limit)
+
+    def findSets(self, cards: list[Coded]):
+        return cardcodes.findSets(cards, self.duplicateSuit, self.limit)
+
+
+# compiled rules are shared between every lobby playing the same variant
+_compiled: dict[tuple, GameRules] = {}
+_compiledLock = Lock()
+
+
+def compileRules(settings: GameSettings) -> GameRules:
+    """
+    Compiles settings into rules. Settings that have been compiled before reuse the same rules.
+
+    Args:
+        settings (GameSettings): The settings to compile.
+    """
+    key = (settings.fingerprint(), settings.require_end_discard)
+    compiled = _compiled.get(key)
+    if compiled is None:
+        with _compiledLock:
+            compiled = _compiled.setdefault(key, GameRules(settings))
+    return compiled
@@ -0,0 +1,77 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Generic, Hashable, Optional, TypeVar
+
+V = TypeVar("V")
+
+
+class LRUCache(Generic[V]):
+    """
+    A bounded mapping that forgets its least recently used entry once it's full.
+
+    Lookups are counted, so the hit rate can be checked to decide how big the cache should be.
+
+    Properties:
+        maxsize (int): The most entries the cache will hold.
+        hits (int): The number of lookups that found an entry.
+        misses (int): The number of lookups that didn't find an entry.
+        evictions (int): The number of entries dropped to make room for new ones.
+    """
+
+    def __init__(self, maxsize: int):
+        """
+        Args:
+            maxsize (int): The most entries the cache will hold.
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries: OrderedDict[Hashable, V] = OrderedDict()
+        # connection threads share caches, so entries are only looked up, added or removed while holding the lock
+        self.lock = Lock()
+
+    def get(self, key: Hashable) -> Optional[V]:
+        # lookups reorder the entries and update the counters, so they hold the lock like everything else
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: V):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def resize(self, maxsize: int):
+        with self.lock:
+            self.maxsize = maxsize
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def info(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0
+            }
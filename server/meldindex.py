@@ -0,0 +1,133 @@
+from sys import maxsize
+from typing import Iterable
+
+from cardcodes import JOKER, NATURAL_CODES, Coded, countGaps
+from gamerules import GameRules
+
+# This file contains the index of which cards can be laid onto a meld on the table.
+#
+# A meld is summarized by a few bitmasks (the rank values, ranks and suits of its natural cards) that are updated as
+# cards are added. From that summary, every face that could be laid onto the meld on its own is worked out ahead of
+# time, so finding or validating a lay is a dictionary lookup instead of checking the whole meld again.
+
+# kinds of meld a card can be laid into
+RUN = 1
+SET = 2
+
+
+# the codes of each suit and of each rank, to narrow down which faces are worth checking
+_SUIT_CODES = [[code for code in NATURAL_CODES if code >> 4 == suit] for suit in range(4)]
+_RANK_CODES = [[code for code in NATURAL_CODES if code & 15 == rank] for rank in range(14)]
+
+
+def _single(mask: int):
+    # whether at most one bit is set
+    return mask & (mask - 1) == 0
+
+
+class MeldAccepts:
+    """
+    The faces that can be laid onto a meld, one card at a time.
+
+    Properties:
+        rules (GameRules): The rules the index was built for.
+        size (int): The number of cards in the meld.
+        wilds (int): The number of wilds in the meld.
+        values (int): A bitmask of the rank values of the natural cards, as used to order runs.
+        ranks (int): A bitmask of the ranks of the natural cards.
+        suits (int): A bitmask of the suits of the natural cards.
+        repeatedValue (bool): Whether two natural cards share a rank value, so the meld can't be a run.
+        repeatedSuit (bool): Whether two natural cards share a suit.
+        faces (dict[int, int]): For each face code that can be laid onto the meld, whether the meld would be a RUN, a SET,
+            or both afterwards. Wilds are stored under JOKER.
+    """
+
+    def __init__(self, cards: Iterable[Coded], rules: GameRules):
+        """
+        Args:
+            cards (Iterable[Coded]): The cards in the meld.
+            rules (GameRules): The rules that melds have to follow.
+        """
+        self.rules = rules
+        self.size = 0
+        self.wilds = 0
+        self.values = 0
+        self.ranks = 0
+        self.suits = 0
+        self.repeatedValue = False
+        self.repeatedSuit = False
+        self.faces: dict[int, int] = {}
+        self.add(cards)
+
+    def copy(self):
+        accepts = MeldAccepts((), self.rules)
+        accepts.__dict__.update(self.__dict__)
+        accepts.faces = self.faces.copy()
+        return accepts
+
+    def get(self, code: int):
+        return self.faces.get(code, 0)
+
+    def add(self, cards: Iterable[Coded]):
+        values = self.rules.rankValues
+        for card in cards:
+            code = card.code
+            self.size += 1
+            if code == JOKER:
+                self.wilds += 1
+                continue
+            valueBit = 1 << values[code]
+            if self.values & valueBit:
+                self.repeatedValue = True
+            self.values |= valueBit
+            suitBit = 1 << (code >> 4)
+            if self.suits & suitBit:
+                self.repeatedSuit = True
+            self.suits |= suitBit
+            self.ranks |= 1 << (code & 15)
+        self._build()
+        return self
+
+    def _build(self):
+        # mirrors GameRules.checkLegal, checkRun and checkSet for the meld with one more card
+        rules = self.rules
+        faces: dict[int, int] = {}
+        self.faces = faces
+        size = self.size + 1
+        if size < 3 or size > (rules.limit if rules.limit is not None else maxsize):
+            return
+
+        canRun = size <= 13 and not self.repeatedValue and (
+            rules.mixedSuit or _single(self.suits))
+        canSet = _single(self.ranks) and (
+            rules.duplicateSuit or (size <= 4 and not self.repeatedSuit))
+
+        wildKinds = 0
+        if canRun and (self.values == 0 or countGaps(self.values) <= self.wilds + 1):
+            wildKinds |= RUN
+        if canSet:
+            wildKinds |= SET
+        if wildKinds:
+            faces[JOKER] = wildKinds
+
+        candidates: set[int] = set()
+        if canRun:
+            candidates.update(NATURAL_CODES if rules.mixedSuit or self.suits == 0
+                              else _SUIT_CODES[self.suits.bit_length() - 1])
+        if canSet:
+            candidates.update(NATURAL_CODES if self.ranks == 0
+                              else _RANK_CODES[self.ranks.bit_length() - 1])
+
+        values = rules.rankValues
+        for code in candidates:
+            kinds = 0
+            if canRun:
+                valueBit = 1 << values[code]
+                if not self.values & valueBit and (rules.mixedSuit or _single(self.suits | 1 << (code >> 4))) \
+                        and countGaps(self.values | valueBit) <= self.wilds:
+                    kinds = RUN
+            if canSet and _single(self.ranks | 1 << (code & 15)) and \
+                    (rules.duplicateSuit or not self.suits & 1 << (code >> 4)):
+                kinds |= SET
+            if kinds:
+                faces[code] = kinds
@@ -1,4 +1,7 @@
+import os
 import random
+import time
+from itertools import count
 from traceback import print_exc
 from uuid import uuid4
 
@@ -6,14 +9,53 @@ from flask_sock import Server
 from names import generateName
 
 import events
+import outbox
+import wire
+from actor import Actor
+from gamerules import compileRules
+from outbox import Outbox, OutboxFull, ThreadedSocket
 from protocol import *
+from registry import Registry
+from schema import DecodeError, decoderFor
+from timerwheel import timers
 
-connections: dict[str, 'Connection'] = {}
+connections: Registry[str, 'Connection'] = Registry()
+
+# unexpected errors while handling actions get a full traceback once in this many times, and a single line otherwise, so
+# a client that keeps triggering one can't keep the server busy formatting them
+TRACEBACK_SAMPLE = max(1, int(os.environ.get("RUMMY_TRACEBACK_SAMPLE", "100")))
+_unexpectedErrors = count()
+
+# a client that hasn't sent anything for PING_AFTER seconds is pinged, and one that still hasn't PING_TIMEOUT seconds
+# after that is dropped (see watch)
+PING_AFTER = 10
+PING_TIMEOUT = 10
+
+
+class Socket(Protocol):
+    """
+    The part of a websocket that a Connection sends with: usually an Outbox (a ThreadedSocket wrapping a flask_sock
+    Server, or an asyncnet.AsyncSocket), which doesn't wait for the client.
+    """
+
+    def send(self, data: Union[str, bytes]) -> None:
+        ...
+
+    def close(self) -> None:
+        ...
 
 
 class Connection:
-    def __init__(self, sock: Server):
+    def __init__(self, sock: Socket, binary: bool = False):
         self.sock = sock
+        # whether the client asked for the binary encoding (see wire.py) instead of JSON
+        self.binary = binary
+        # the number of actions rejected from this connection, by error code
+        self.rejections: dict[str, int] = {}
+        # whether the client's outbox overflowed, and events are being dropped until it's sent the whole state instead
+        self.resyncing = False
+        # when the client last sent anything, from time.monotonic()
+        self.lastActivity = time.monotonic()
         self.id = uuid4().hex
         self.name = generateName()
         self.lobby = Lobby()
@@ -23,15 +65,71 @@ class Connection:
     def sendEvent(self, event: Event):
         if not self.id in connections:
             return
+        self.sendEncoded(self.encodeEvent(event))
+
+    def reject(self, code: ErrorCode, actionType: Optional[str]):
+        # tells the client that an action changed nothing, so it can stop retrying it
+        self.rejections[code] = self.rejections.get(code, 0) + 1
+        self.sendEvent(ErrorEvent(code, actionType))
+
+    def encodeEvent(self, event: Event) -> Union[str, bytes]:
+        return event.encodeBytes() if self.binary else event.encodeString()
+
+    def sendEncoded(self, data: Union[str, bytes]):
+        # sends an event that has already been encoded, so an event sent to many players is only encoded once
+        if not self.id in connections:
+            return
+        if self.resyncing:
+            outbox.countDropped(1)
+            return
         try:
-            self.sock.send(event.encodeString())
+            self.sock.send(data)
+        except OutboxFull:
+            self.overflow(data)
         except Exception:
-            print_exc()
-            removeConnection(self.id)
+            # the client is gone; it's taken out of its lobby on the lobby's actor, not in the middle of a broadcast
+            dropConnection(self)
+
+    def endFrame(self):
+        # sends the events waiting to be coalesced into a frame right away (see outbox.py)
+        if isinstance(self.sock, Outbox):
+            self.sock.endFrame()
+
+    def overflow(self, data: Union[str, bytes]):
+        # the client has fallen too far behind to queue another event (see outbox.py)
+        sock = self.sock
+        assert isinstance(sock, Outbox)
+        policy = outbox.OUTBOX_POLICY
+        if policy == "coalesce":
+            sock.coalesce()
             try:
-                self.lobby.removePlayer(self)
-            except Exception:
+                sock.send(data)
+                outbox.countOverflow(policy, 0)
+                return
+            except OutboxFull:
                 pass
+        elif policy == "resync":
+            outbox.countOverflow(policy, sock.clear() + 1)
+            self.resyncing = True
+            # the state is read once the task that's changing it has finished
+            self.lobby.actor.submit(self.resync)
+            return
+        outbox.countOverflow("disconnect", sock.depth() + 1)
+        print(f"Disconnecting {self.id}, which has {sock.depth()} events waiting")
+        dropConnection(self)
+
+    def resync(self):
+        # sends a client that fell behind the whole state of its game, or its lobby, in place of the events it missed
+        self.resyncing = False
+        if not self.id in connections:
+            return
+        game = events.games.get(self.lobby.code)
+        player = game.playerFor(self) if game is not None else None
+        event = game.syncEventFor(player) if game is not None and player is not None else self.lobby.lobbyEventFor(self)
+        try:
+            self.sock.send(self.encodeEvent(event))
+        except Exception:
+            dropConnection(self)
 
 
 class AILobbyPlayer:
@@ -44,14 +142,21 @@ class Lobby:
     def __init__(self):
         self.connections: list[str] = []
         self.aiPlayers: list[AILobbyPlayer] = []
-        self.code = str(random.randint(0, 999999)).rjust(6, "0")
         self.settings = GameSettings()
-        lobbies[self.code] = self
+        # the rules are compiled whenever the settings change, so games don't have to
+        self.rules = compileRules(self.settings)
+        # runs the actions of the lobby's players, and the game played in it (see actor.py)
+        self.actor = Actor()
+        self.code = str(random.randint(0, 999999)).rjust(6, "0")
+        while not lobbies.add(self.code, self):
+            self.code = str(random.randint(0, 999999)).rjust(6, "0")
 
     def addPlayer(self, player: Connection):
-        player.lobby.removePlayer(player)
-        player.lobby = self
-        self.connections.append(player.id)
+        # players move between lobbies from the actor of the lobby they're leaving, so both lobbies are locked
+        with lobbies.locking(player.lobby.code, self.code):
+            player.lobby.removePlayer(player)
+            player.lobby = self
+            self.connections.append(player.id)
         self.informPlayersOfLobby()
 
     def removePlayer(self, player: Connection):
@@ -59,38 +164,55 @@ class Lobby:
             g = events.games.get(player.lobby.code)
             if g is not None:
                 g.removePlayer(player.id)
-            self.connections.remove(player.id)
-            if len(self.connections) == 0:
-                lobbies.pop(self.code)
+            with lobbies.locking(self.code):
+                self.connections.remove(player.id)
+                if len(self.connections) == 0:
+                    lobbies.discard(self.code, self)
             if g is None:
                 self.informPlayersOfLobby()
         except:
             pass
 
+    def playerCount(self):
+        return len(self.connections) + len(self.aiPlayers)
+
+    def changeSettings(self, settings: GameSettings):
+        self.settings = settings
+        self.rules = compileRules(settings)
+
+    def humanPlayers(self) -> list[Connection]:
+        # a player who has just disconnected may still be in the lobby until its actor gets to them, so they're skipped
+        return [player for player in map(connections.get, self.connections) if player is not None]
+
     def informPlayersOfLobby(self):
-        for player in map(lambda x: connections[x], self.connections):
-            player.sendEvent(LobbyEvent(
-                lobby=ClientLobby(
-                    code=self.code,
-                    current_player_id=player.id,
-                    players=[LobbyPlayer(
-                        id=p.id,
-                        human=True,
-                        name=p.name
-                    ) for p in map(lambda x: connections[x], self.connections)] +
-                    [LobbyPlayer(
-                        id=p.id,
-                        human=False,
-                        name=p.name
-                    ) for p in self.aiPlayers],
-                    settings=self.settings
-                )
-            ))
+        for player in self.humanPlayers():
+            player.sendEvent(self.lobbyEventFor(player))
+
+    def lobbyEventFor(self, player: Connection):
+        return LobbyEvent(
+            lobby=ClientLobby(
+                code=self.code,
+                current_player_id=player.id,
+                players=[LobbyPlayer(
+                    id=p.id,
+                    human=True,
+                    name=p.name
+                ) for p in self.humanPlayers()] +
+                [LobbyPlayer(
+                    id=p.id,
+                    human=False,
+                    name=p.name
+                ) for p in self.aiPlayers],
+                settings=self.settings
+            )
+        )
 
     def addAIPlayer(self):
-        if len(self.connections) + len(self.aiPlayers) >= 4:
-            return
-        self.aiPlayers.append(AILobbyPlayer())
+        # locked like a join, which may be filling the lobby from another actor
+        with lobbies.locking(self.code):
+            if self.playerCount() >= 4:
+                return
+            self.aiPlayers.append(AILobbyPlayer())
         self.informPlayersOfLobby()
 
     def removeAIPlayer(self):
@@ -100,34 +222,23 @@ class Lobby:
         self.informPlayersOfLobby()
 
 
-lobbies: dict[str, Lobby] = {}
+lobbies: Registry[str, Lobby] = Registry()
 
 
-def addConnection(sock: Server):
+def addConnection(sock: Server, binary: bool = False):
+    # serves a connection from flask_sock on the thread that accepted it, until it closes
     try:
-        connection = Connection(sock)
+        # events are written by a thread of their own, so a slow client doesn't hold up the game
+        connection = Connection(ThreadedSocket(sock), binary)
+        # the timer wheel pings the client when it's quiet, and closes the socket (ending the loop) if it's gone
+        watch(connection)
         try:
             while True:
-                data: Union[str, bytes, None] = sock.receive(10)
-                if data is None:
-                    connection.sendEvent(PingEvent())
-                    data: Union[str, bytes, None] = sock.receive(10)
-                    if data is None:
-                        raise RuntimeError("Connection timed out")
-                if isinstance(data, bytes):
-                    data = data.decode("utf-8")
-                action = parseAction(data)
-                try:
-                    events.handleAction(action, connection)
-                except Exception:
-                    print_exc()
+                data: Union[str, bytes] = sock.receive()
+                handleMessage(connection, data)
         except Exception:
             print_exc()
-            removeConnection(connection.id)
-            try:
-                connection.lobby.removePlayer(connection)
-            except Exception:
-                pass
+            dropConnection(connection)
     except:
         pass
     try:
@@ -136,6 +247,113 @@ def addConnection(sock: Server):
         print_exc()
 
 
+def handleMessage(connection: Connection, data: Union[str, bytes]):
+    # handles one message from a client on the thread it was received on, waiting until it's been handled
+    future = submitMessage(connection, data)
+    if future is not None:
+        future.result()
+
+
+def submitMessage(connection: Connection, data: Union[str, bytes]):
+    """
+    Decodes a message from a client, and queues its action on the actor of the player's lobby.
+    The next message from the same client shouldn't be submitted until this one has been handled, since it may move the
+    player to a different lobby.
+
+    Returns:
+        A future that's done once the action has been handled, or None if the message was rejected right away.
+    """
+    connection.lastActivity = time.monotonic()
+    action = parseAction(data, connection.binary)
+    if isinstance(action, DecodeError):
+        connection.reject("invalid_action", None)
+        return None
+    return connection.lobby.actor.submit(_handleAction, connection, action)
+
+
+def _handleAction(connection: Connection, action: Action):
+    try:
+        events.handleAction(action, connection)
+    except Exception as e:
+        printSampled(e)
+        connection.reject("internal_error", actionTypeNames[type(action)])
+
+
+def dropConnection(connection: Connection):
+    # forgets a connection that has closed, and takes the player out of their lobby or game on its actor
+    removeConnection(connection.id)
+    return connection.lobby.actor.submit(_removeFromLobby, connection)
+
+
+def watch(connection: Connection):
+    """
+    Keeps track of whether a client is still there, from the timer wheel instead of the thread or task receiving from it:
+    a client that's quiet for PING_AFTER seconds is pinged, and one that doesn't answer within PING_TIMEOUT is dropped.
+    Messages only update the connection's lastActivity, so a busy client costs nothing extra.
+    """
+    timers.schedule(PING_AFTER, _checkActivity, connection)
+
+
+def _checkActivity(connection: Connection):
+    if not connection.id in connections:
+        return
+    idle = time.monotonic() - connection.lastActivity
+    if idle >= PING_AFTER + PING_TIMEOUT:
+        print(f"Connection {connection.id} timed out")
+        dropConnection(connection)
+    elif idle >= PING_AFTER:
+        connection.sendEvent(PingEvent())
+        timers.schedule(PING_AFTER + PING_TIMEOUT - idle, _checkActivity, connection)
+    else:
+        timers.schedule(PING_AFTER - idle, _checkActivity, connection)
+
+
+def _removeFromLobby(connection: Connection):
+    try:
+        connection.lobby.removePlayer(connection)
+    except Exception:
+        pass
+
+
+# when the metrics were last read, and the frames and bytes sent by then, so they can report rates
+_lastMetrics = (time.monotonic(), 0, 0)
+
+
+def outboxMetrics():
+    """
+    How far behind clients are: the events waiting in all outboxes, the most waiting for any one client (now, and ever),
+    how many times outboxes have overflowed by the policy that dealt with them, and how many events were dropped.
+    Also how many events, frames and bytes have been sent, and the frames and bytes sent per second since the metrics
+    were last read, for tuning the coalescing window.
+    """
+    global _lastMetrics
+    outboxes = [connection.sock for connection in connections.values() if isinstance(connection.sock, Outbox)]
+    now, frames, sent = time.monotonic(), outbox.framesSent, outbox.bytesSent
+    then, framesThen, sentThen = _lastMetrics
+    _lastMetrics = (now, frames, sent)
+    elapsed = max(now - then, 1e-9)
+    return {
+        "connections": len(outboxes),
+        "queued": sum(sock.depth() for sock in outboxes),
+        "deepest": max((sock.depth() for sock in outboxes), default=0),
+        "peak": max((sock.peakDepth for sock in outboxes), default=0),
+        "overflows": dict(outbox.overflows),
+        "dropped": outbox.droppedEvents,
+        "events": outbox.eventsQueued,
+        "frames": frames,
+        "bytes": sent,
+        "framesPerSecond": round((frames - framesThen) / elapsed, 1),
+        "bytesPerSecond": round((sent - sentThen) / elapsed, 1),
+    }
+
+
+def printSampled(error: Exception):
+    if next(_unexpectedErrors) % TRACEBACK_SAMPLE == 0:
+        print_exc()
+    else:
+        print("Error handling action: " + repr(error))
+
+
 def removeConnection(id: str):
     try:
         connections[id].sock.close()
@@ -147,9 +365,22 @@ def removeConnection(id: str):
         pass
 
 
-def parseAction(action: str) -> Action:
-    o = json.loads(action)
-    assert isinstance(o, dict)
-    assert "type" in o
-    assert o["type"] in actionTypeMap
-    return actionTypeMap[o["type"]].decodeObject(o)
+def parseAction(action: Union[str, bytes], binary: bool = False) -> Union[Action, DecodeError]:
+    # returns why the action is invalid instead of raising, so bad input is cheap to turn away
+    try:
+        # connections that asked for the binary encoding send their actions in it, and everything else is JSON, which
+        # may still arrive in a binary frame
+        o = wire.decode(action) if binary else json.loads(action)
+    except Exception:
+        return DecodeError(None, "malformed message")
+    if type(o) is not dict:
+        return DecodeError(None, "expected an object")
+    actionType = o.get("type")
+    decoder = actionDecoders.get(actionType) if type(actionType) is str else None
+    if decoder is None:
+        return DecodeError("type", "unknown action type")
+    result, error = decoder(o)
+    return result if error is None else error
+
+
+actionDecoders = {actionType: decoderFor(cls) for actionType, cls in actionTypeMap.items()}
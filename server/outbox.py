@@ -0,0 +1,222 @@
+import os
+from collections import deque
+from threading import Event, Lock, Thread
+from typing import Any, Literal, Optional, Union
+
+from protocol import batchEncoded, listEncoded
+
+# This file contains the queues that events wait in on their way to a client.
+#
+# Game logic never writes to a socket itself: sending an event puts it in the connection's outbox, and a writer (a thread
+# for the Flask server, a task for the asyncio one, see asyncnet.py) takes it out and writes it. A client that's slow to
+# read only holds up its own writer, never the game. Outboxes are bounded, and when a client falls so far behind that its
+# outbox is full, its connection deals with it according to OUTBOX_POLICY (see net.Connection.overflow).
+#
+# Writers can also coalesce frames: with a window set, a writer that's woken by an event waits out the window (or until
+# the next turn starts, see endFrame), and then sends everything that has been queued meanwhile as one array of events.
+# Dealing and AI turns send many small events in quick succession, and each frame costs websocket framing and a system
+# call on both ends.
+
+OutboxPolicy = Literal["coalesce", "resync", "disconnect"]
+"""
+What to do with a client whose outbox is full.
+
+`"coalesce"`: The waiting events are joined into one batch event, which costs the client less to receive. A client whose
+    outbox is still too big (see OUTBOX_BYTES) is disconnected.
+`"resync"`: The waiting events are dropped, and the client is sent the whole state of its lobby or game instead.
+`"disconnect"`: The client is disconnected.
+"""
+
+# the most events that may be waiting for a client, and how big they may be in all, tuned with the RUMMY_OUTBOX_LIMIT
+# and RUMMY_OUTBOX_BYTES environment variables
+OUTBOX_LIMIT = int(os.environ.get("RUMMY_OUTBOX_LIMIT", 256))
+OUTBOX_BYTES = int(os.environ.get("RUMMY_OUTBOX_BYTES", 1 << 20))
+# chosen with the RUMMY_OUTBOX_POLICY environment variable
+OUTBOX_POLICY: OutboxPolicy = os.environ.get("RUMMY_OUTBOX_POLICY", "resync")  # type: ignore
+# how long writers gather events into one frame, in seconds, set in milliseconds with the RUMMY_COALESCE_WINDOW
+# environment variable (the default of 0 sends every event as a frame of its own)
+COALESCE_WINDOW = float(os.environ.get("RUMMY_COALESCE_WINDOW", 0)) / 1000
+
+# how many times outboxes have filled up, by the policy that dealt with them, and how many events were dropped
+overflows: dict[str, int] = {}
+droppedEvents = 0
+# how many events have been queued, and how many frames (and bytes, or characters for JSON) have been taken to be written
+eventsQueued = 0
+framesSent = 0
+bytesSent = 0
+_countLock = Lock()
+
+
+class OutboxFull(Exception):
+    pass
+
+
+class Outbox:
+    """
+    A bounded queue of encoded events waiting to be written to a socket. Subclasses write them, and are woken whenever
+    the queue stops being empty.
+
+    Properties:
+        limit (int): The most events that may be waiting.
+        maxBytes (int): How big the waiting events may be in all (in characters, for JSON).
+        window (float): How long events are gathered into one frame, in seconds, or 0 to send each on its own.
+        closed (bool): Whether the socket has been closed, by either side.
+        peakDepth (int): The most events that have been waiting at once.
+    """
+
+    def __init__(self, limit: int = OUTBOX_LIMIT, maxBytes: int = OUTBOX_BYTES, window: float = COALESCE_WINDOW):
+        self.limit = limit
+        self.maxBytes = maxBytes
+        self.window = window
+        self.closed = False
+        self.peakDepth = 0
+        self._pending: deque[Union[str, bytes]] = deque()
+        self._bytes = 0
+        # guards _pending and _bytes, and is only held for a moment
+        self._lock = Lock()
+
+    def send(self, data: Union[str, bytes]):
+        # queues an event, raising OutboxFull (and queueing nothing) if there's no room for it
+        if self.closed:
+            raise ConnectionError("Socket is closed")
+        with self._lock:
+            if len(self._pending) >= self.limit or self._bytes + len(data) > self.maxBytes:
+                raise OutboxFull()
+            # the writer only needs waking when the queue was empty, since otherwise it's already going to look again
+            wasEmpty = len(self._pending) == 0
+            self._pending.append(data)
+            self._bytes += len(data)
+            self.peakDepth = max(self.peakDepth, len(self._pending))
+        countQueued()
+        if wasEmpty:
+            self.wake()
+
+    def take(self) -> Optional[Union[str, bytes]]:
+        # the next event to write, or None when there isn't one
+        with self._lock:
+            if not self._pending:
+                return None
+            data = self._pending.popleft()
+            self._bytes -= len(data)
+            return data
+
+    def takeFrame(self) -> Optional[Union[str, bytes]]:
+        # the next frame to write: one event, or everything waiting when frames are coalesced
+        if self.window <= 0:
+            data = self.take()
+        else:
+            with self._lock:
+                if not self._pending:
+                    return None
+                data = self._pending[0] if len(self._pending) == 1 else listEncoded(list(self._pending))
+                self._pending.clear()
+                self._bytes = 0
+        if data is not None:
+            countFrame(len(data))
+        return data
+
+    def depth(self):
+        return len(self._pending)
+
+    def coalesce(self):
+        # joins the waiting events into one batch event
+        with self._lock:
+            if len(self._pending) > 1:
+                data = batchEncoded(list(self._pending))
+                self._pending.clear()
+                self._pending.append(data)
+                self._bytes = len(data)
+
+    def clear(self):
+        # drops the waiting events, returning how many there were
+        with self._lock:
+            count = len(self._pending)
+            self._pending.clear()
+            self._bytes = 0
+            return count
+
+    def wake(self):
+        raise NotImplementedError
+
+    def endFrame(self):
+        # sends what's waiting without waiting out the rest of the window
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+
+class ThreadedSocket(Outbox):
+    """
+    Writes the events queued for a blocking socket (a flask_sock Server) on a thread of its own.
+
+    Properties:
+        sock (Any): The socket, which has blocking send and close methods.
+    """
+
+    def __init__(self, sock: Any, limit: int = OUTBOX_LIMIT, maxBytes: int = OUTBOX_BYTES,
+                 window: float = COALESCE_WINDOW):
+        super().__init__(limit, maxBytes, window)
+        self.sock = sock
+        self._ready = Event()
+        self._frameEnded = Event()
+        Thread(target=self.write, name="writer", daemon=True).start()
+
+    def wake(self):
+        self._ready.set()
+
+    def endFrame(self):
+        self._frameEnded.set()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._frameEnded.set()
+            self._ready.set()
+
+    def write(self):
+        # runs until the socket is closed, writing whatever is sent
+        try:
+            while True:
+                self._ready.wait()
+                self._ready.clear()
+                if self.window > 0:
+                    self._frameEnded.wait(self.window)
+                    self._frameEnded.clear()
+                while (data := self.takeFrame()) is not None:
+                    self.sock.send(data)
+                if self.closed:
+                    break
+        except Exception:
+            # the client has gone, so the next send fails and drops the connection
+            self.closed = True
+        try:
+            self.sock.close()
+        except Exception:
+            pass
+
+
+def countOverflow(policy: str, dropped: int):
+    global droppedEvents
+    with _countLock:
+        overflows[policy] = overflows.get(policy, 0) + 1
+        droppedEvents += dropped
+
+
+def countDropped(dropped: int):
+    global droppedEvents
+    with _countLock:
+        droppedEvents += dropped
+
+
+def countQueued():
+    global eventsQueued
+    with _countLock:
+        eventsQueued += 1
+
+
+def countFrame(size: int):
+    global framesSent, bytesSent
+    with _countLock:
+        framesSent += 1
+        bytesSent += size
@@ -1,8 +1,11 @@
 import json
-from typing import Literal, Mapping, Optional, Protocol, Sequence, Type, Union
+from typing import ClassVar, Literal, Mapping, Optional, Protocol, Sequence, Type, Union
 
 from typing_extensions import Self
 
+import wire
+from schema import Boolean, DecodeError, Field, Integer, ListOf, Nested, OneOf, String, decoderFor
+
 JSONSafe = Union[Mapping[str, "JSONSafe"],
                  Sequence["JSONSafe"], str, int, float, bool, None]
 
@@ -14,18 +17,49 @@ class Encodable(Protocol):
     def encodeString(self) -> str:
         return json.dumps(self.encodeObject())
 
+    def encodeBytes(self) -> bytes:
+        return wire.encode(self.encodeObject())
+
 
 class Decodable(Protocol):
+    # the fields of the class, which its decoder is generated from (see schema.py)
+    schema: ClassVar[dict[str, Field]]
+
+    @classmethod
+    def decodeChecked(cls, data: JSONSafe) -> tuple[Optional[Self], Optional[DecodeError]]:
+        # decodes without raising, returning either the object or why it couldn't be decoded
+        return decoderFor(cls)(data)
+
     @classmethod
     def decodeObject(cls, data: JSONSafe) -> Self:
-        raise NotImplementedError()
+        result, error = decoderFor(cls)(data)
+        assert error is None, str(error)
+        return result
 
     @classmethod
     def decodeString(cls, data: str) -> Self:
         return cls.decodeObject(json.loads(data))
 
+    @classmethod
+    def decodeBytes(cls, data: bytes) -> Self:
+        return cls.decodeObject(wire.decode(data))
+
 
 class GameSettings(Encodable, Decodable):
+    schema = {
+        "deck_count": Integer(),
+        "enable_jokers": Boolean(),
+        "hand_size": Integer(),
+        "first_turn": OneOf("next_player", "prev_winner", "random"),
+        "allow_draw_choice": Boolean(),
+        "allow_run_mixed_suit": Boolean(),
+        "allow_set_duplicate_suit": Boolean(),
+        "limit_meld_size": OneOf(3, 4, None),
+        "ace_rank": OneOf("low", "high"),
+        "deck_exhaust": OneOf("flip_discard", "shuffle_discard", "end_round"),
+        "require_end_discard": Boolean(),
+        "lay_at_end": Boolean(),
+    }
 
     # deck_count, hand_size, first_turn, allow_draw_choice, allow_run_mixed_suit, limit_meld_size, ace_rank, deck_exhaust, require_end_discard, lay_at_end
     def __init__(self,
@@ -72,49 +106,9 @@ class GameSettings(Encodable, Decodable):
             "lay_at_end": self.lay_at_end
         }
 
-    @classmethod
-    def decodeObject(cls, data: JSONSafe) -> Self:
-        assert isinstance(data, dict)
-        assert "deck_count" in data
-        assert "enable_jokers" in data
-        assert "hand_size" in data
-        assert "first_turn" in data
-        assert "allow_draw_choice" in data
-        assert "allow_run_mixed_suit" in data
-        assert "allow_set_duplicate_suit" in data
-        assert "limit_meld_size" in data
-        assert "ace_rank" in data
-        assert "deck_exhaust" in data
-        assert "require_end_discard" in data
-        assert "lay_at_end" in data
-        assert isinstance(data["deck_count"], int)
-        assert isinstance(data["enable_jokers"], bool)
-        assert isinstance(data["hand_size"], int)
-        assert data["first_turn"] in ["next_player", "prev_winner", "random"]
-        assert isinstance(data["allow_draw_choice"], bool)
-        assert isinstance(data["allow_run_mixed_suit"], bool)
-        assert isinstance(data["allow_set_duplicate_suit"], bool)
-        assert data["limit_meld_size"] in [
-            3, 4] or data["limit_meld_size"] is None
-        assert data["ace_rank"] in ["low", "high"]
-        assert data["deck_exhaust"] in [
-            "flip_discard", "shuffle_discard", "end_round"]
-        assert isinstance(data["require_end_discard"], bool)
-        assert isinstance(data["lay_at_end"], bool)
-        return cls(
-            deck_count=data["deck_count"],
-            enable_jokers=data["enable_jokers"],
-            hand_size=data["hand_size"],
-            first_turn=data["first_turn"],
-            allow_draw_choice=data["allow_draw_choice"],
-            allow_run_mixed_suit=data["allow_run_mixed_suit"],
-            allow_set_duplicate_suit=data["allow_set_duplicate_suit"],
-            limit_meld_size=data["limit_meld_size"],
-            ace_rank=data["ace_rank"],
-            deck_exhaust=data["deck_exhaust"],
-            require_end_discard=data["require_end_discard"],
-            lay_at_end=data["lay_at_end"]
-        )
+    def fingerprint(self):
+        # the settings that decide whether a group of cards is a legal meld, in a hashable form
+        return (self.ace_rank, self.allow_run_mixed_suit, self.allow_set_duplicate_suit, self.limit_meld_size)
 
 
 CardSuit = Literal["hearts", "diamonds", "spades", "clubs", "joker"]
@@ -488,24 +482,29 @@ class RedeckEvent(Encodable):
     Indicates that the deck has been replenished from the discard pile.
 
     All cards in the discard pile are considered to be destroyed, and the deck is replaced with new cards.
+    The IDs of the new cards are `"<nonce>-0"`, `"<nonce>-1"`, ... up to `count - 1`, from the bottom of the deck up (see cardids.redeckIDs).
 
     Properties:
-        new_card_ids (list[str]): The server should generate a new list of card IDs to use for the new deck.
+        nonce (str): A string that the server generates for each redeck, which the new card IDs are made from.
+        count (int): The number of cards in the new deck.
     """
 
-    def __init__(self, new_card_ids: list[str]):
+    def __init__(self, nonce: str, count: int):
         """
         Indicates that the deck has been replenished from the discard pile.
 
         All cards in the discard pile are considered to be destroyed, and the deck is replaced with new cards.
+        The IDs of the new cards are `"<nonce>-0"`, `"<nonce>-1"`, ... up to `count - 1`, from the bottom of the deck up (see cardids.redeckIDs).
 
         Args:
-            new_card_ids (list[str]): The server should generate a new list of card IDs to use for the new deck.
+            nonce (str): A string that the server generates for each redeck, which the new card IDs are made from.
+            count (int): The number of cards in the new deck.
         """
-        self.new_card_ids = new_card_ids
+        self.nonce = nonce
+        self.count = count
 
     def encodeObject(self) -> JSONSafe:
-        return {"type": "redeck", "new_card_ids": self.new_card_ids}
+        return {"type": "redeck", "nonce": self.nonce, "count": self.count}
 
 
 class EndEvent(Encodable):
@@ -536,8 +535,124 @@ class EndEvent(Encodable):
         }
 
 
+class BatchEvent(Encodable):
+    """
+    Several events that the client should apply together, in order, as one step. Used to send a whole deal, or all the melds and lays of a turn, in one message.
+
+    Properties:
+        events (list[Union[MoveEvent, RedeckEvent, TurnEvent, EndEvent]]): The events in the batch, in the order they happened.
+    """
+
+    def __init__(self, events: list[Union[MoveEvent, RedeckEvent, TurnEvent, EndEvent]]):
+        """
+        Several events that the client should apply together, in order, as one step. Used to send a whole deal, or all the melds and lays of a turn, in one message.
+
+        Args:
+            events (list[Union[MoveEvent, RedeckEvent, TurnEvent, EndEvent]]): The events in the batch, in the order they happened.
+        """
+        self.events = events
+
+    def encodeObject(self) -> JSONSafe:
+        return {
+            "type": "batch",
+            "events": [event.encodeObject() for event in self.events]
+        }
+
+
+def batchEncoded(events: list[Union[str, bytes]]) -> Union[str, bytes]:
+    """
+    Joins events that have already been encoded, all in the same format, into one batch event without decoding them.
+    The client applies them in order, the same as if they had been sent one at a time.
+    """
+    if isinstance(events[0], bytes):
+        return wire.encodeBatch(events)  # type: ignore
+    return '{"type": "batch", "events": [' + ", ".join(events) + "]}"  # type: ignore
+
+
+def listEncoded(events: list[Union[str, bytes]]) -> Union[str, bytes]:
+    """
+    Joins events that have already been encoded, all in the same format, into an array, to be sent as one message.
+    Unlike a batch, the client handles them just as if they had been sent one at a time.
+    """
+    if isinstance(events[0], bytes):
+        return wire.encodeList(events)  # type: ignore
+    return "[" + ", ".join(events) + "]"  # type: ignore
+
+
+class SyncEvent(Encodable):
+    """
+    Replaces the whole state of the game. Sent instead of the events a client missed by falling too far behind.
+
+    Properties:
+        board (ClientBoard): The game, as the client sees it.
+        settings (GameSettings): The game settings.
+    """
+
+    def __init__(self, board: ClientBoard, settings: GameSettings):
+        """
+        Replaces the whole state of the game. Sent instead of the events a client missed by falling too far behind.
+
+        Args:
+            board (ClientBoard): The game, as the client sees it.
+            settings (GameSettings): The game settings.
+        """
+        self.board = board
+        self.settings = settings
+
+    def encodeObject(self) -> JSONSafe:
+        return {"type": "sync", "board": self.board.encodeObject(), "settings": self.settings.encodeObject()}
+
+
+ErrorCode = Literal["invalid_action", "internal_error", "game_started", "no_game", "not_your_turn", "already_drawn",
+                    "not_drawn", "card_not_found", "illegal_meld", "no_such_meld", "must_keep_discard", "cannot_discard",
+                    "invalid_name", "cannot_join", "not_enough_players"]
+"""
+Why an action was rejected.
+
+`"invalid_action"`: The message couldn't be decoded, or isn't an action the server knows.
+`"internal_error"`: The server ran into a problem of its own while handling the action.
+`"game_started"`: The action can only be taken in the lobby, before the game starts.
+`"no_game"`: The action can only be taken in a game.
+`"not_your_turn"`: It isn't the player's turn.
+`"already_drawn"`: The player has already drawn a card this turn.
+`"not_drawn"`: The player has to draw a card first.
+`"card_not_found"`: A card isn't in the player's hand (or, when drawing, on top of the deck or the discard pile).
+`"illegal_meld"`: The cards don't make a legal meld.
+`"no_such_meld"`: There's no meld with that number.
+`"must_keep_discard"`: A card has to be kept to discard at the end of the turn.
+`"cannot_discard"`: The card drawn from the discard pile can't be discarded in the same turn.
+`"invalid_name"`: The name is too long or has no letters or numbers.
+`"cannot_join"`: The game doesn't exist, has started or is full.
+`"not_enough_players"`: A game needs at least two players.
+"""
+
+
+class ErrorEvent(Encodable):
+    """
+    Indicates that an action was rejected, and changed nothing. Only sent to the player who took the action.
+
+    Properties:
+        code (ErrorCode): Why the action was rejected.
+        action (str | None): The type of the action, or None if it couldn't be decoded.
+    """
+
+    def __init__(self, code: ErrorCode, action: Optional[str]):
+        """
+        Indicates that an action was rejected, and changed nothing. Only sent to the player who took the action.
+
+        Args:
+            code (ErrorCode): Why the action was rejected.
+            action (str | None): The type of the action, or None if it couldn't be decoded.
+        """
+        self.code = code
+        self.action = action
+
+    def encodeObject(self) -> JSONSafe:
+        return {"type": "error", "code": self.code, "action": self.action}
+
+
 Event = Union[PingEvent, LobbyEvent, StartEvent,
-              TurnEvent, MoveEvent, RedeckEvent, EndEvent]
+              TurnEvent, MoveEvent, RedeckEvent, EndEvent, BatchEvent, ErrorEvent, SyncEvent]
 """
 A message recieved from the server.
 
@@ -548,6 +663,9 @@ A message recieved from the server.
 `"move"`: Indicates that a card has been moved, either by the current player or by someone else. `card.face` being present indicates that the card is face-up.
 `"redeck"`: Indicates that the deck has been replenished from the discard pile.
 `"end"`: Indicates that the game has ended. The values of the remaining hands are tallied for scorekeeping.
+`"batch"`: Several events that the client should apply together, in order, as one step.
+`"error"`: Indicates that an action was rejected.
+`"sync"`: Replaces the whole state of the game, for a client that fell behind.
 """
 
 
@@ -555,16 +673,13 @@ class PongAction(Decodable):
     """
     A pong recieved from the client. Indicates that the connection is still active.
     """
+    schema = {}
 
     def __init__(self):
         """
         A pong recieved from the client. Indicates that the connection is still active.
         """
 
-    @classmethod
-    def decodeObject(cls, data: JSONSafe) -> Self:
-        return PongAction()
-
 
 class NameAction(Decodable):
     """
@@ -575,6 +690,7 @@ class NameAction(Decodable):
     Properties:
         name (str): The name of the player.
     """
+    schema = {"name": String()}
 
     def __init__(self, name: str):
         """
@@ -587,12 +703,6 @@ class NameAction(Decodable):
         """
         self.name = name
 
-    @classmethod
-    def decodeObject(cls, data: JSONSafe) -> Self:
-        assert isinstance(data, dict)
-        assert isinstance(data["name"], str)
-        return NameAction(name=data["name"])
-
 
 class AIAction(Decodable):
     """
@@ -604,6 +714,7 @@ class AIAction(Decodable):
     Properties:
         action (Literal["add", "remove"]): The action to perform.
     """
+    schema = {"action": OneOf("add", "remove")}
 
     def __init__(self, action: Literal["add", "remove"]):
         """
@@ -617,12 +728,6 @@ class AIAction(Decodable):
         """
         self.action = action
 
-    @classmethod
-    def decodeObject(cls, data: JSONSafe) -> Self:
-        assert isinstance(data, dict)
-        assert data["action"] in ["add", "remove"]
-        return AIAction(action=data["action"])
-
 
 class JoinAction(Decodable):
     """
@@ -633,6 +738,7 @@ class JoinAction(Decodable):
     Properties:
         code (str): The game code to join.
     """
+    schema = {"code": String()}
 
     def __init__(self, code: str):
         """
@@ -645,12 +751,6 @@ class JoinAction(Decodable):
         """
         self.code = code
 
-    @classmethod
-    def decodeObject(cls, data: JSONSafe) -> Self:
-        assert isinstance(data, dict)
-        assert isinstance(data["code"], str)
-        return JoinAction(data["code"])
-
 
 class StartAction(Decodable):
     """
@@ -658,9 +758,7 @@ class StartAction(Decodable):
 
     The server should verify that at least two players are in the game.
     """
-    @classmethod
-    def decodeObject(cls, data: JSONSafe) -> Self:
-        return StartAction()
+    schema = {}
 
 
 class DrawAction(Decodable):
@@ -672,6 +770,7 @@ class DrawAction(Decodable):
     Properties:
         card_id (str): The ID of the card to draw. This can be the top card of the deck or the top card of the discard pile.
     """
+    schema = {"card_id": String()}
 
     def __init__(self, card_id: str):
         """
@@ -684,12 +783,6 @@ class DrawAction(Decodable):
         """
         self.card_id = card_id
 
-    @classmethod
-    def decodeObject(cls, data: JSONSafe) -> Self:
-        assert isinstance(data, dict)
-        assert isinstance(data["card_id"], str)
-        return DrawAction(data["card_id"])
-
 
 class MeldAction(Decodable):
     """
@@ -700,6 +793,7 @@ class MeldAction(Decodable):
     Properties:
         card_ids (list[str]): A list of card IDs to lay down.
     """
+    schema = {"card_ids": ListOf(String())}
 
     def __init__(self, card_ids: list[str]):
         """
@@ -712,13 +806,6 @@ class MeldAction(Decodable):
         """
         self.card_ids = card_ids
 
-    @classmethod
-    def decodeObject(cls, data: JSONSafe) -> Self:
-        assert isinstance(data, dict)
-        assert isinstance(data["card_ids"], list)
-        assert all(isinstance(card_id, str) for card_id in data["card_ids"])
-        return MeldAction(data["card_ids"])  # type: ignore
-
 
 class LayAction(Decodable):
     """
@@ -730,6 +817,7 @@ class LayAction(Decodable):
         card_ids (list[str]): The IDs of the cards to lay.
         meld_number (int): The index of the meld to add the card to.
     """
+    schema = {"card_ids": ListOf(String(), 1), "meld_number": Integer()}
 
     def __init__(self, card_ids: str, meld_number: int):
         """
@@ -744,15 +832,6 @@ class LayAction(Decodable):
         self.card_ids = card_ids
         self.meld_number = meld_number
 
-    @classmethod
-    def decodeObject(cls, data: JSONSafe) -> Self:
-        assert isinstance(data, dict)
-        assert isinstance(data["meld_number"], int)
-        assert isinstance(data["card_ids"], list)
-        assert len(data["card_ids"]) > 0
-        assert all(isinstance(card_id, str) for card_id in data["card_ids"])
-        return LayAction(data["card_ids"], data["meld_number"])  # type: ignore
-
 
 class DiscardAction(Decodable):
     """
@@ -763,6 +842,7 @@ class DiscardAction(Decodable):
     Properties:
         card_id (str): The ID of the card to discard.
     """
+    schema = {"card_id": String()}
 
     def __init__(self, card_id: str):
         """
@@ -775,12 +855,6 @@ class DiscardAction(Decodable):
         """
         self.card_id = card_id
 
-    @classmethod
-    def decodeObject(cls, data: JSONSafe) -> Self:
-        assert isinstance(data, dict)
-        assert isinstance(data["card_id"], str)
-        return DiscardAction(data["card_id"])
-
 
 class SettingsAction(Decodable):
     """
@@ -791,6 +865,7 @@ class SettingsAction(Decodable):
     Properties:
         settings (GameSettings): The new settings.
     """
+    schema = {"settings": Nested(GameSettings)}
 
     def __init__(self, settings: GameSettings):
         """
@@ -803,12 +878,6 @@ class SettingsAction(Decodable):
         """
         self.settings = settings
 
-    @classmethod
-    def decodeObject(cls, data: JSONSafe) -> Self:
-        assert isinstance(data, dict)
-        assert "settings" in data
-        return SettingsAction(GameSettings.decodeObject(data["settings"]))
-
 
 Action = Union[PongAction, NameAction, AIAction, JoinAction, StartAction,
                DrawAction, MeldAction, LayAction, DiscardAction, SettingsAction]
@@ -843,3 +912,5 @@ actionTypeMap: dict[str, Type[Action]] = {
     "discard": DiscardAction,
     "settings": SettingsAction
 }
+
+actionTypeNames: dict[Type[Action], str] = {cls: actionType for actionType, cls in actionTypeMap.items()}
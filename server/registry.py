@@ -0,0 +1,104 @@
+from contextlib import ExitStack, contextmanager
+from threading import RLock
+from typing import Generic, Iterator, Optional, TypeVar
+
+# This file contains the registries of connections, lobbies and games that every thread shares.
+#
+# A registry is a dict split into shards, each with its own lock, so threads working on different lobbies don't wait on
+# each other. Looking up a single key doesn't lock, since a dict lookup is already atomic. Changing a key does, and so does
+# anything that looks at the registry and then changes it based on what it saw (see `locking`).
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+_MISSING = object()
+
+
+class Registry(Generic[K, V]):
+    """
+    A dict that's safe to share between threads, locked a shard at a time.
+
+    Properties:
+        shards (int): The number of shards.
+    """
+
+    def __init__(self, shards: int = 16):
+        self.shards = shards
+        self._dicts: list[dict[K, V]] = [{} for _ in range(shards)]
+        self._locks = [RLock() for _ in range(shards)]
+
+    def _index(self, key: K):
+        return hash(key) % self.shards
+
+    @contextmanager
+    def locking(self, *keys: K):
+        """
+        Holds the locks of the shards the keys are in, for a change that has to see a registry that nobody else is
+        changing. The locks are taken in the same order by everyone, so two threads locking the same keys can't each be
+        left waiting on the other.
+        """
+        with ExitStack() as stack:
+            for index in sorted({self._index(key) for key in keys}):
+                stack.enter_context(self._locks[index])
+            yield
+
+    def get(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        return self._dicts[self._index(key)].get(key, default)
+
+    def __getitem__(self, key: K) -> V:
+        return self._dicts[self._index(key)][key]
+
+    def __contains__(self, key: K):
+        return key in self._dicts[self._index(key)]
+
+    def __setitem__(self, key: K, value: V):
+        index = self._index(key)
+        with self._locks[index]:
+            self._dicts[index][key] = value
+
+    def __delitem__(self, key: K):
+        index = self._index(key)
+        with self._locks[index]:
+            del self._dicts[index][key]
+
+    def add(self, key: K, value: V):
+        # adds the key only if it isn't there yet, returning whether it was added
+        index = self._index(key)
+        with self._locks[index]:
+            if key in self._dicts[index]:
+                return False
+            self._dicts[index][key] = value
+            return True
+
+    def pop(self, key: K, default=_MISSING):
+        index = self._index(key)
+        with self._locks[index]:
+            if default is _MISSING:
+                return self._dicts[index].pop(key)
+            return self._dicts[index].pop(key, default)
+
+    def discard(self, key: K, value: V):
+        # removes the key only if it still holds this value, returning whether it did
+        index = self._index(key)
+        with self._locks[index]:
+            if self._dicts[index].get(key) is not value:
+                return False
+            del self._dicts[index][key]
+            return True
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._dicts)
+
+    def __iter__(self) -> Iterator[K]:
+        # iterates over a copy of the keys, so the registry can change meanwhile
+        for index in range(self.shards):
+            with self._locks[index]:
+                keys = list(self._dicts[index])
+            yield from keys
+
+    def values(self) -> list[V]:
+        result: list[V] = []
+        for index in range(self.shards):
+            with self._locks[index]:
+                result += self._dicts[index].values()
+        return result
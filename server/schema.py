@@ -0,0 +1,184 @@
+from typing import Any, Callable, Optional
+
+# This file contains the schemas that actions (and the settings inside them) are decoded with.
+#
+# A class declares its fields once, as a dict from each key to the kind of value it holds, and a decoder is generated from
+# that: a single Python function that checks every field with plain type and membership tests and then calls the class.
+# A decoder never raises. It returns the decoded object, or a DecodeError saying which field was wrong, so malformed
+# input costs a few comparisons instead of an exception and a traceback.
+
+
+class DecodeError:
+    """
+    Why a message couldn't be decoded.
+
+    Properties:
+        field (str | None): The key of the field that was wrong, with nested keys joined by dots, or None if the message
+            itself was wrong (not an object, for example).
+        reason (str): What was wrong with it.
+    """
+
+    def __init__(self, field: Optional[str], reason: str):
+        self.field = field
+        self.reason = reason
+
+    def within(self, field: str):
+        # the same error, for a field nested inside another
+        return DecodeError(field if self.field is None else field + "." + self.field, self.reason)
+
+    def __str__(self):
+        return self.reason if self.field is None else f"{self.field}: {self.reason}"
+
+    def __repr__(self):
+        return f"DecodeError({self.field!r}, {self.reason!r})"
+
+
+Decoder = Callable[[Any], tuple[Any, Optional[DecodeError]]]
+
+
+class _Missing:
+    # stands in for a key that isn't in the message, so it can't be mistaken for a null value
+    pass
+
+
+_MISSING = _Missing()
+
+
+class Field:
+    """
+    The kind of value a field holds. Subclasses turn themselves into a test in the generated decoder.
+
+    Properties:
+        reason (str): What the field should have held, for when it doesn't.
+    """
+    reason = "invalid"
+
+    def check(self, value: str, constants: dict[str, Any]) -> str:
+        """
+        Returns a Python expression that's true when the variable named `value` holds a valid value.
+
+        Args:
+            value (str): The name of the variable.
+            constants (dict[str, Any]): The globals of the generated decoder, which the expression can add to.
+        """
+        raise NotImplementedError()
+
+    def statements(self, value: str, constants: dict[str, Any], fail: str) -> list[str]:
+        # the lines of the decoder that run `fail` when the variable named `value` doesn't hold a valid value
+        return [f"if not ({self.check(value, constants)}):", "    " + fail]
+
+
+class String(Field):
+    reason = "expected a string"
+
+    def check(self, value: str, constants: dict[str, Any]):
+        return f"type({value}) is str"
+
+
+class Integer(Field):
+    reason = "expected an integer"
+
+    def check(self, value: str, constants: dict[str, Any]):
+        # bools are ints in Python, but not in JSON, so isinstance isn't used
+        return f"type({value}) is int"
+
+
+class Boolean(Field):
+    reason = "expected true or false"
+
+    def check(self, value: str, constants: dict[str, Any]):
+        return f"type({value}) is bool"
+
+
+class OneOf(Field):
+    """
+    A field that holds one of a few strings, numbers or null.
+    """
+
+    def __init__(self, *values: Any):
+        self.values = frozenset(values)
+        self.types = frozenset(type(value) for value in values)
+        self.reason = "expected one of " + ", ".join(sorted(repr(value) for value in values))
+
+    def check(self, value: str, constants: dict[str, Any]):
+        name = f"c{len(constants)}"
+        constants[name + "types"] = self.types
+        constants[name] = self.values
+        # the type is checked first, so only hashable values are looked up (and True isn't mistaken for 1)
+        return f"type({value}) in {name}types and {value} in {name}"
+
+
+class ListOf(Field):
+    """
+    A field that holds a list of values of one kind.
+    """
+
+    def __init__(self, item: Field, minLength: int = 0):
+        self.item = item
+        self.minLength = minLength
+        self.reason = f"expected a list of at least {minLength} values" if minLength else "expected a list"
+        self.reason += f" ({item.reason[len('expected '):]})" if item.reason.startswith("expected ") else ""
+
+    def check(self, value: str, constants: dict[str, Any]):
+        item = f"{value}_item"
+        return f"type({value}) is list and len({value}) >= {self.minLength} and " \
+            f"all({self.item.check(item, constants)} for {item} in {value})"
+
+    def statements(self, value: str, constants: dict[str, Any], fail: str):
+        # a loop is a good deal faster than all() with a generator
+        item = f"{value}_item"
+        return [f"if type({value}) is not list or len({value}) < {self.minLength}:", "    " + fail,
+                f"for {item} in {value}:"] + ["    " + line for line in self.item.statements(item, constants, fail)]
+
+
+class Nested(Field):
+    """
+    A field that holds an object of a class with a schema of its own.
+    """
+
+    def __init__(self, cls: type):
+        self.cls = cls
+
+
+def compileDecoder(cls: type, schema: dict[str, Field]) -> Decoder:
+    """
+    Generates the decoder for a class. The class is called with each field of the schema as a keyword argument.
+
+    Args:
+        cls (type): The class to decode into.
+        schema (dict[str, Field]): The fields of the class, by key. Keys that aren't in the schema are ignored.
+    """
+    constants: dict[str, Any] = {"cls": cls, "MISSING": _MISSING, "notObject": DecodeError(None, "expected an object")}
+    lines = ["def decode(data):",
+             "    if type(data) is not dict:",
+             "        return None, notObject"]
+    arguments = []
+    for i, (key, field) in enumerate(schema.items()):
+        value = f"v{i}"
+        constants[f"error{i}"] = DecodeError(key, field.reason)
+        constants[f"missing{i}"] = DecodeError(key, "missing")
+        lines.append(f"    {value} = data.get({key!r}, MISSING)")
+        lines.append(f"    if {value} is MISSING:")
+        lines.append(f"        return None, missing{i}")
+        if isinstance(field, Nested):
+            constants[f"decoder{i}"] = decoderFor(field.cls)
+            lines.append(f"    {value}, error = decoder{i}({value})")
+            lines.append(f"    if error is not None:")
+            lines.append(f"        return None, error.within({key!r})")
+        else:
+            lines += ["    " + line for line in field.statements(value, constants, f"return None, error{i}")]
+        arguments.append(f"{key}={value}")
+    lines.append(f"    return cls({', '.join(arguments)}), None")
+    exec("\n".join(lines), constants)
+    return constants["decode"]
+
+
+_decoders: dict[type, Decoder] = {}
+
+
+def decoderFor(cls: type) -> Decoder:
+    # the decoder of a class with a `schema`, compiled the first time it's needed
+    decoder = _decoders.get(cls)
+    if decoder is None:
+        decoder = _decoders[cls] = compileDecoder(cls, cls.schema)  # type: ignore
+    return decoder
@@ -0,0 +1,182 @@
+import sys
+sys.path.append("./")
+
+import contextlib
+import cProfile
+import json
+import os
+import pstats
+import random
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import classes
+import net
+from protocol import GameSettings
+
+# This file contains the headless self-play simulator.
+#
+# Games are played by AI players alone, with no connections to send events to, so the rules engine and the AI can be
+# timed on their own. Each game is seeded, so a run can be repeated exactly, and batches of games can be spread across
+# processes. Run from the repository root with `python server/simulate.py --help`.
+
+
+class GameResult:
+    """
+    The outcome of one simulated game.
+
+    Properties:
+        seed (int): The seed the game was played with.
+        turns (int): The number of turns that were started.
+        winner (int | None): The seat of the AI player who went out, or None if nobody did.
+        seconds (float): How long the game took to play.
+    """
+
+    def __init__(self, seed: int, turns: int, winner: Optional[int], seconds: float):
+        self.seed = seed
+        self.turns = turns
+        self.winner = winner
+        self.seconds = seconds
+
+
+def playGame(seed: int, settings: GameSettings, players: int = 4, maxTurns: int = 1000):
+    """
+    Plays one round between AI players, from the deal until someone goes out.
+
+    Args:
+        seed (int): Seeds the deck and every other random choice, so the same seed plays the same game.
+        settings (GameSettings): The settings to play with.
+        players (int): The number of AI players, from 2 to 4.
+        maxTurns (int): Some variants (such as a meld size limit of 3) can reach a point where nobody can go out, so
+            the round is ended without a winner after this many turns.
+    """
+    assert 2 <= players <= 4
+    random.seed(seed)
+    start = time.perf_counter()
+    lobby = net.Lobby()
+    # the lobby is only needed to set up the game, and shouldn't be joinable
+    net.lobbies.pop(lobby.code, None)
+    lobby.changeSettings(settings)
+    for _ in range(players):
+        lobby.addAIPlayer()
+    game = classes.Game(lobby, headless=True)
+    # the simulator plays the turns itself, so it can stop a round that can't end
+    game.scheduler.running = True
+    with game.lock:
+        game.start()
+    for _ in game.scheduler.turns():
+        if game.turns >= maxTurns:
+            with game.lock:
+                game.end(None)
+            break
+    winner = None
+    for i, player in enumerate(game.aiPlayers):
+        if player.profile.id == game.winnerID:
+            winner = i
+    return GameResult(seed, game.turns, winner, time.perf_counter() - start)
+
+
+def playGames(seeds: list[int], settings: GameSettings, players: int, maxTurns: int, profile: bool):
+    # plays a batch of games in one process, returning the results and (optionally) the profile of the whole batch
+    profiler = cProfile.Profile() if profile else None
+    results: list[GameResult] = []
+    # the AI explains each of its decisions with print(), which isn't worth timing
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        if profiler is not None:
+            profiler.enable()
+        for seed in seeds:
+            results.append(playGame(seed, settings, players, maxTurns))
+        if profiler is not None:
+            profiler.disable()
+    if profiler is None:
+        return results, None
+    profiler.create_stats()
+    return results, profiler.stats  # type: ignore
+
+
+class _Stats:
+    # lets pstats merge the raw stats returned by worker processes
+    def __init__(self, stats: dict):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def simulate(games: int, settings: GameSettings, players: int = 4, workers: int = 1, firstSeed: int = 0,
+             maxTurns: int = 1000, profile: bool = False, batchSize: int = 25):
+    """
+    Plays many games, spread across worker processes.
+
+    Args:
+        games (int): The number of games to play. Game i is played with the seed firstSeed + i.
+        settings (GameSettings): The settings to play with.
+        players (int): The number of AI players in each game.
+        workers (int): The number of processes to play on. With 1, games are played in this process.
+        firstSeed (int): The seed of the first game.
+        maxTurns (int): The number of turns after which a game is ended without a winner.
+        profile (bool): Whether to profile the games. The profiles of every process are merged.
+        batchSize (int): The number of games sent to a worker at a time.
+
+    Returns:
+        A tuple of the results of every game, in seed order, the wall-clock time in seconds, and the merged profile
+        (or None when not profiling).
+    """
+    seeds = list(range(firstSeed, firstSeed + games))
+    batches = [seeds[i:i + batchSize] for i in range(0, len(seeds), batchSize)]
+    results: list[GameResult] = []
+    merged: Optional[pstats.Stats] = None
+    start = time.perf_counter()
+    if workers <= 1:
+        outputs = [playGames(batch, settings, players, maxTurns, profile) for batch in batches]
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            outputs = list(pool.map(playGames, batches, [settings] * len(batches), [players] * len(batches),
+                                    [maxTurns] * len(batches), [profile] * len(batches)))
+    elapsed = time.perf_counter() - start
+    for batchResults, stats in outputs:
+        results += batchResults
+        if stats is not None:
+            if merged is None:
+                merged = pstats.Stats(_Stats(stats))
+            else:
+                merged.add(_Stats(stats))
+    return results, elapsed, merged
+
+
+def report(results: list[GameResult], elapsed: float, players: int, profile: Optional[pstats.Stats], top: int = 20):
+    turns = sum(result.turns for result in results)
+    print(f"games:     {len(results)} in {elapsed:.2f}s ({len(results) / elapsed:.1f} games/s)")
+    print(f"turns:     {turns} ({turns / elapsed:.1f} turns/s, {turns / max(len(results), 1):.1f} per game)")
+    slowest = max(results, key=lambda result: result.seconds, default=None)
+    if slowest is not None:
+        print(f"slowest:   seed {slowest.seed} ({slowest.seconds * 1000:.1f} ms, {slowest.turns} turns)")
+    for seat in range(players):
+        wins = sum(result.winner == seat for result in results)
+        print(f"seat {seat}:    {wins} wins ({wins / max(len(results), 1):.1%})")
+    stalled = sum(result.winner is None for result in results)
+    print(f"no winner: {stalled} ({stalled / max(len(results), 1):.1%})")
+    if profile is not None:
+        print()
+        profile.sort_stats("tottime").print_stats(top)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Plays AI-only games without a server and reports how fast they ran.")
+    parser.add_argument("--games", type=int, default=200)
+    parser.add_argument("--players", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--seed", type=int, default=0, help="the seed of the first game")
+    parser.add_argument("--max-turns", type=int, default=1000)
+    parser.add_argument("--settings", default="{}",
+                        help="JSON game settings, such as '{\"limit_meld_size\": 4}'; anything left out keeps its default")
+    parser.add_argument("--profile", action="store_true", help="report where the time went, by function")
+    args = parser.parse_args()
+
+    settings = GameSettings.decodeObject(
+        GameSettings().encodeObject() | json.loads(args.settings))  # type: ignore
+    results, elapsed, profile = simulate(args.games, settings, args.players, args.workers, args.seed,
+                                         args.max_turns, args.profile)
+    report(results, elapsed, args.players, profile)
@@ -0,0 +1,242 @@
+from itertools import compress
+from typing import Optional
+
+import classes
+from cardcodes import JOKER
+from gamerules import GameRules
+
+# This file contains an exact solver that splits a hand into melds and leftover deadwood.
+#
+# Cards are processed from the lowest rank up. The lowest remaining card is either deadwood, the lowest natural card of a
+# set, or the lowest natural card of a run, so trying each of those choices (and remembering the best answer for every
+# multiset of remaining faces) finds the partition with the least deadwood.
+
+
+class HandPartition:
+    """
+    The best way to split a hand into melds.
+
+    Properties:
+        melds (list[list[ServerCard]]): The melds to lay down, each sorted like funlib.sortStack.
+        deadwood (list[ServerCard]): The cards that are left over, in hand order.
+        score (int): The total score value of the deadwood.
+    """
+
+    def __init__(self, melds: list[list['classes.ServerCard']], deadwood: list['classes.ServerCard'], score: int):
+        """
+        Args:
+            melds (list[list[ServerCard]]): The melds to lay down, each sorted like funlib.sortStack.
+            deadwood (list[ServerCard]): The cards that are left over, in hand order.
+            score (int): The total score value of the deadwood.
+        """
+        self.melds = melds
+        self.deadwood = deadwood
+        self.score = score
+
+
+def solveHand(cards: list['classes.ServerCard'], rules: GameRules, reserve: int = 0, wildMelds: bool = True,
+              memo: Optional[dict] = None):
+    """
+    Finds the partition of `cards` into legal melds with the lowest deadwood score.
+
+    Args:
+        cards (list[ServerCard]): The hand to partition.
+        rules (GameRules): The rules that melds have to follow.
+        reserve (int): The minimum number of cards to leave as deadwood, for example to keep a card to discard.
+        wildMelds (bool): Whether melds with fewer than two natural (non-wild) cards may be used.
+        memo (dict | None): The solutions found so far. Hands that share cards can pass the same dict to reuse the
+            work done for each other, as long as the rules and `wildMelds` are the same.
+    """
+    canonical = _canonicalFaces(rules)
+    meldCodes, deadCodes, score = _solve(
+        [canonical(card.code) for card in cards], rules, reserve, wildMelds, {} if memo is None else memo)
+
+    # hand the actual cards back out, in hand order for each face
+    pools: dict[int, list['classes.ServerCard']] = {}
+    for card in reversed(cards):
+        pools.setdefault(canonical(card.code), []).append(card)
+    melds = [rules.sortMeld([pools[code].pop() for code in meld])
+             for meld in meldCodes]
+    dead = set(map(id, (pools[code].pop() for code in deadCodes)))
+    return HandPartition(melds, [card for card in cards if id(card) in dead], score)
+
+
+def _canonicalFaces(rules: GameRules):
+    if rules.mixedSuit and rules.duplicateSuit:
+        # suits don't matter for either kind of meld, so every card of a rank is the same card
+        return lambda code: code if code == JOKER else code & 15
+    return lambda code: code
+
+
+def _solve(codes: list[int], rules: GameRules, reserve: int, wildMelds: bool, memo: dict):
+    values = rules.rankValues
+    scores = rules.scoreValues
+    limit = rules.limit
+    runCap = 13 if limit is None else min(13, limit)
+    setCap = limit
+    if not rules.duplicateSuit:
+        setCap = 4 if limit is None else min(4, limit)
+    setCopies = None if rules.duplicateSuit else 1
+    # with mixed-suit runs, the suit of a card only matters for keeping the suits of a set distinct
+    # taking a card from whichever suit of its rank has the most cards left is then never worse than any other suit
+    mixed = rules.mixedSuit
+
+    # each distinct natural face gets a slot, ordered by rank value, then suit
+    faces = sorted({code for code in codes if code != JOKER},
+                   key=lambda code: (values[code], code >> 4))
+    slots = {code: i for i, code in enumerate(faces)}
+    startCounts = [0] * len(faces)
+    for code in codes:
+        if code != JOKER:
+            startCounts[slots[code]] += 1
+    startWilds = len(codes) - sum(startCounts)
+    # slots for each rank value, used to build sets and extend runs
+    byValue: dict[int, list[int]] = {}
+    for i, code in enumerate(faces):
+        byValue.setdefault(values[code], []).append(i)
+
+    def plentiful(value: int, remaining: list[int], k: int):
+        group = byValue.get(value, ())
+        if len(group) == 1:
+            return [group[0]] if remaining[group[0]] > 0 else []
+        group = [slot for slot in group if remaining[slot] > 0]
+        group.sort(key=lambda slot: -remaining[slot])
+        return group[:k]
+
+    # memo maps a state to (score, dead cards, meld codes, dead codes, next state)
+    # states are keyed by the faces left rather than by slot, so they can be shared with other hands
+    def keyOf(counts: tuple[int, ...], wilds: int, need: int):
+        return tuple(compress(zip(faces, counts), counts)), wilds, need
+
+    def best(counts: tuple[int, ...], wilds: int, need: int, key: tuple) -> tuple:
+        found = memo.get(key)
+        if found is not None:
+            return found
+        result = None
+
+        def consider(meld: tuple[int, ...], dead: tuple[int, ...], nextCounts: tuple[int, ...], nextWilds: int, nextNeed: int):
+            nonlocal result
+            if result is not None and result[0] == 0 and result[1] == 0:
+                # nothing beats leaving no deadwood at all, so the rest of the options can be skipped
+                return
+            nextKey = keyOf(nextCounts, nextWilds, nextNeed)
+            rest = best(nextCounts, nextWilds, nextNeed, nextKey)
+            if rest[0] is None:
+                return
+            option = (rest[0] + sum(scores[code] for code in dead), rest[1] + len(dead),
+                      meld, dead, nextKey)
+            if result is None or result[0] is None or option[:2] < result[:2]:
+                result = option
+
+        def addWilds(chosen: list[int], remaining: list[int]):
+            # finish a set by adding any number of wilds
+            if not wildMelds and len(chosen) < 2:
+                return
+            for w in range(wilds + 1):
+                size = len(chosen) + w
+                if setCap is not None and size > setCap:
+                    break
+                if size >= 3:
+                    consider(tuple(chosen) + (JOKER,) * w, (),
+                             tuple(remaining), wilds - w, need)
+
+        def extendRun(top: int, suit: int, chosen: list[int], remaining: list[int], span: int, used: int):
+            if wildMelds or len(chosen) >= 2:
+                # extra wilds can be placed at either end of the run
+                for extra in range(wilds - used + 1):
+                    size = span + extra
+                    if size > runCap:
+                        break
+                    if size >= 3:
+                        consider(tuple(chosen) + (JOKER,) * (used + extra), (),
+                                 tuple(remaining), wilds - used - extra, need)
+            # the next natural card can be any number of ranks higher, as long as there are wilds to fill the gap
+            for step in range(1, runCap - span + 1):
+                if step - 1 > wilds - used:
+                    break
+                if mixed:
+                    candidates = plentiful(top + step, remaining, 1)
+                else:
+                    candidates = [slot for slot in byValue.get(top + step, ())
+                                  if remaining[slot] > 0 and faces[slot] >> 4 == suit]
+                for slot in candidates:
+                    remaining[slot] -= 1
+                    extendRun(top + step, suit, chosen + [faces[slot]], remaining,
+                              span + step, used + step - 1)
+                    remaining[slot] += 1
+
+        first = next((i for i, n in enumerate(counts) if n > 0), None)
+        if first is None:
+            if wilds == 0:
+                result = (0, 0, (), (), None) if need == 0 else (
+                    None, None, (), (), None)
+            else:
+                # only wilds are left; a wild is either part of an all-wild meld or deadwood
+                if wildMelds:
+                    for size in range(3, min(wilds, runCap) + 1):
+                        consider((JOKER,) * size, (), counts,
+                                 wilds - size, need)
+                consider((), (JOKER,), counts, wilds - 1, max(need - 1, 0))
+        else:
+            value = values[faces[first]]
+            if mixed:
+                first = plentiful(value, list(counts), 1)[0]
+            code = faces[first]
+            taken = list(counts)
+            taken[first] -= 1
+
+            # the card is the first natural card of a set
+            if mixed and setCopies == 1:
+                for k in range(1, len(byValue[value]) + 1):
+                    remaining = list(counts)
+                    chosen = plentiful(value, remaining, k)
+                    if len(chosen) < k:
+                        break
+                    for slot in chosen:
+                        remaining[slot] -= 1
+                    addWilds([faces[slot] for slot in chosen], remaining)
+            else:
+                others = [slot for slot in byValue[value] if slot > first]
+
+                def chooseSet(k: int, chosen: list[int], remaining: list[int]):
+                    if k == len(others):
+                        addWilds(chosen, remaining)
+                        return
+                    slot = others[k]
+                    most = remaining[slot] if setCopies is None else min(
+                        remaining[slot], setCopies)
+                    for n in range(most + 1):
+                        remaining[slot] -= n
+                        chooseSet(k + 1, chosen +
+                                  [faces[slot]] * n, remaining)
+                        remaining[slot] += n
+
+                most = counts[first] if setCopies is None else min(
+                    counts[first], setCopies)
+                for n in range(1, most + 1):
+                    remaining = list(counts)
+                    remaining[first] -= n
+                    chooseSet(0, [code] * n, remaining)
+
+            # the card is the lowest natural card of a run
+            extendRun(value, code >> 4, [code], taken, 1, 0)
+
+            # the card is deadwood
+            consider((), (code,), tuple(taken), wilds, max(need - 1, 0))
+
+        memo[key] = result
+        return result
+
+    meldCodes: list[tuple[int, ...]] = []
+    deadCodes: list[int] = []
+    state: Optional[tuple] = keyOf(tuple(startCounts), startWilds, reserve)
+    score = best(tuple(startCounts), startWilds, reserve, state)[0]
+    if score is None:
+        # there aren't enough cards to leave the reserve, so nothing can be melded
+        return [], codes, sum(scores[code] for code in codes)
+    while state is not None:
+        _, _, meld, dead, state = memo[state]
+        if len(meld) > 0:
+            meldCodes.append(meld)
+        deadCodes += dead
+    return meldCodes, deadCodes, score
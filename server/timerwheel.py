@@ -0,0 +1,100 @@
+import time
+from math import ceil
+from threading import Lock, Thread
+from traceback import print_exc
+from typing import Any, Callable, Optional
+
+# This file contains the timer wheel that runs everything the server does after a delay: pinging idle clients and
+# dropping the ones that stopped answering (see net.watch), and pacing AI turns (see classes.TurnScheduler).
+#
+# A timer wheel is a ring of slots, one per tick. A timer goes in the slot of the tick it's due on, and each tick, one
+# thread runs whatever is in the next slot, so thousands of idle connections cost one thread waking up once a tick rather
+# than a thread (or a timeout) each. Timers further away than a full turn of the wheel wait out the extra turns in their
+# slot.
+
+
+class Timer:
+    """
+    A callback waiting in a TimerWheel.
+
+    Properties:
+        cancelled (bool): Whether the timer has been cancelled, so it won't run.
+    """
+
+    def __init__(self, callback: Callable[..., Any], args: tuple, rounds: int):
+        self.callback = callback
+        self.args = args
+        # the number of times the wheel passes the timer's slot before it's due
+        self.rounds = rounds
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel:
+    """
+    Runs callbacks after a delay, to within a tick, on a thread of its own. Callbacks should be quick, handing anything
+    slow to an actor, since every other timer due on the same tick waits for them.
+
+    Properties:
+        tick (float): How long each tick is, in seconds.
+        slots (int): The number of ticks in a turn of the wheel.
+    """
+
+    def __init__(self, tick: float = 0.1, slots: int = 256):
+        self.tick = tick
+        self.slots = slots
+        self._wheel: list[list[Timer]] = [[] for _ in range(slots)]
+        # the number of ticks that have been run
+        self._ticks = 0
+        # guards _wheel and _ticks, and is only held for a moment
+        self._lock = Lock()
+        self._thread: Optional[Thread] = None
+
+    def schedule(self, delay: float, callback: Callable[..., Any], *args: Any) -> Timer:
+        """
+        Runs a callback once a delay has passed, returning a timer that can cancel it.
+
+        Args:
+            delay (float): How long to wait, in seconds. It's rounded up to a whole number of ticks, counted from the
+                tick that's under way.
+            callback (Callable): The function to call.
+            *args: The arguments to call it with.
+        """
+        ticks = max(1, ceil(delay / self.tick))
+        timer = Timer(callback, args, (ticks - 1) // self.slots)
+        with self._lock:
+            self._wheel[(self._ticks + ticks) % self.slots].append(timer)
+            if self._thread is None:
+                self._thread = Thread(target=self.run, name="timers", daemon=True)
+                self._thread.start()
+        return timer
+
+    def advance(self):
+        # runs the next tick's timers, and keeps the ones that are a turn or more away
+        with self._lock:
+            self._ticks += 1
+            index = self._ticks % self.slots
+            slot = self._wheel[index]
+            due = [timer for timer in slot if timer.rounds == 0 and not timer.cancelled]
+            waiting = [timer for timer in slot if timer.rounds > 0 and not timer.cancelled]
+            for timer in waiting:
+                timer.rounds -= 1
+            self._wheel[index] = waiting
+        for timer in due:
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                print_exc()
+
+    def run(self):
+        # ticks are counted from the start, so a slow tick doesn't push back every tick after it
+        start = time.monotonic()
+        while True:
+            time.sleep(max(0.0, start + (self._ticks + 1) * self.tick - time.monotonic()))
+            self.advance()
+
+
+# the wheel the server's timers share
+timers = TimerWheel()
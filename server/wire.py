@@ -0,0 +1,180 @@
+from struct import pack, unpack_from
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from protocol import JSONSafe
+
+# This file contains the compact binary encoding that clients can choose instead of JSON.
+#
+# A message is the same object that would be sent as JSON, written as a tree of tagged values. Numbers are written as
+# varints, and the strings that make up most of the protocol (keys like "type" and values like "hearts") are written as
+# an index into WORDS instead of spelled out. public/js/wire.js is the matching encoder and decoder for the client.
+
+NULL = 0
+FALSE = 1
+TRUE = 2
+INT = 3  # followed by a varint
+NEGATIVE_INT = 4  # followed by a varint holding -n - 1
+FLOAT = 5  # followed by a little-endian float64
+STRING = 6  # followed by a varint byte length and the UTF-8 bytes
+WORD = 7  # followed by a varint index into WORDS
+ARRAY = 8  # followed by a varint length and the values
+OBJECT = 9  # followed by a varint length and that many keys (STRING or WORD values) and values
+
+# Strings that are written as an index. This list has to match the one in public/js/wire.js exactly, and new strings can
+# only be added to the end, so clients that haven't reloaded can still read messages.
+WORDS = [
+    # event and action types
+    "type", "ping", "pong", "lobby", "start", "turn", "move", "redeck", "end", "batch",
+    "name", "ai", "join", "draw", "meld", "lay", "discard", "settings",
+    # keys
+    "id", "face", "suit", "rank", "cards", "card_id", "card_ids", "destination", "player", "player_id", "position",
+    "meld_number", "state", "play", "winner_id", "hand_values", "nonce", "count", "events", "players",
+    "current_player_id", "code", "game_code", "hand", "human", "action", "add", "remove",
+    # settings
+    "deck_count", "enable_jokers", "hand_size", "first_turn", "allow_draw_choice", "allow_run_mixed_suit",
+    "allow_set_duplicate_suit", "limit_meld_size", "ace_rank", "deck_exhaust", "require_end_discard", "lay_at_end",
+    "next_player", "prev_winner", "random", "low", "high", "flip_discard", "shuffle_discard", "end_round",
+    # faces
+    "hearts", "clubs", "diamonds", "spades", "joker",
+    "W", "A", "2", "3", "4", "5", "6", "7", "8", "9", "10", "J", "Q", "K",
+    # errors
+    "error", "invalid_action", "internal_error", "game_started", "no_game", "not_your_turn", "already_drawn", "not_drawn",
+    "card_not_found", "illegal_meld", "no_such_meld", "must_keep_discard", "cannot_discard", "invalid_name", "cannot_join",
+    "not_enough_players",
+    # resyncs
+    "sync", "board", "melds", "deck",
+]
+_WORD_INDEX = {word: i for i, word in enumerate(WORDS)}
+
+
+def _writeVarint(out: bytearray, number: int):
+    while number > 0x7F:
+        out.append(number & 0x7F | 0x80)
+        number >>= 7
+    out.append(number)
+
+
+def _write(out: bytearray, value: 'JSONSafe'):
+    if value is None:
+        out.append(NULL)
+    elif value is True:
+        out.append(TRUE)
+    elif value is False:
+        out.append(FALSE)
+    elif isinstance(value, int):
+        if value >= 0:
+            out.append(INT)
+            _writeVarint(out, value)
+        else:
+            out.append(NEGATIVE_INT)
+            _writeVarint(out, -value - 1)
+    elif isinstance(value, float):
+        out.append(FLOAT)
+        out += pack("<d", value)
+    elif isinstance(value, str):
+        index = _WORD_INDEX.get(value)
+        if index is not None:
+            out.append(WORD)
+            _writeVarint(out, index)
+        else:
+            data = value.encode("utf-8")
+            out.append(STRING)
+            _writeVarint(out, len(data))
+            out += data
+    elif isinstance(value, dict):
+        out.append(OBJECT)
+        _writeVarint(out, len(value))
+        for key, item in value.items():
+            _write(out, key)
+            _write(out, item)
+    else:
+        assert isinstance(value, (list, tuple))
+        out.append(ARRAY)
+        _writeVarint(out, len(value))
+        for item in value:
+            _write(out, item)
+
+
+def encode(value: 'JSONSafe') -> bytes:
+    out = bytearray()
+    _write(out, value)
+    return bytes(out)
+
+
+def encodeList(messages: list[bytes]) -> bytes:
+    # an array of messages that are already encoded, which are copied rather than decoded and encoded again
+    out = bytearray([ARRAY])
+    _writeVarint(out, len(messages))
+    for message in messages:
+        out += message
+    return bytes(out)
+
+
+# everything in an encoded batch event before its array of events
+_BATCH_PREFIX = encode({"type": "batch", "events": []})[:-2]
+
+
+def encodeBatch(messages: list[bytes]) -> bytes:
+    # a batch event holding messages that are already encoded
+    return _BATCH_PREFIX + encodeList(messages)
+
+
+class _Reader:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.position = 0
+
+    def varint(self):
+        number = 0
+        shift = 0
+        while True:
+            byte = self.data[self.position]
+            self.position += 1
+            number |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return number
+            shift += 7
+
+    def value(self) -> 'JSONSafe':
+        tag = self.data[self.position]
+        self.position += 1
+        if tag == NULL:
+            return None
+        elif tag == FALSE:
+            return False
+        elif tag == TRUE:
+            return True
+        elif tag == INT:
+            return self.varint()
+        elif tag == NEGATIVE_INT:
+            return -self.varint() - 1
+        elif tag == FLOAT:
+            number = unpack_from("<d", self.data, self.position)[0]
+            self.position += 8
+            return number
+        elif tag == STRING:
+            length = self.varint()
+            assert self.position + length <= len(self.data)
+            text = self.data[self.position:self.position + length].decode("utf-8")
+            self.position += length
+            return text
+        elif tag == WORD:
+            return WORDS[self.varint()]
+        elif tag == ARRAY:
+            return [self.value() for _ in range(self.varint())]
+        elif tag == OBJECT:
+            result: dict[str, 'JSONSafe'] = {}
+            for _ in range(self.varint()):
+                key = self.value()
+                assert isinstance(key, str)
+                result[key] = self.value()
+            return result
+        raise ValueError("Unknown tag " + str(tag))
+
+
+def decode(data: bytes) -> 'JSONSafe':
+    reader = _Reader(data)
+    value = reader.value()
+    assert reader.position == len(data)
+    return value
@@ -0,0 +1,175 @@
+import sys
+sys.path.append("../")
+sys.path.append("./")
+sys.path.append("./server/")
+
+import contextlib
+import io
+import os
+import random
+import time
+import timeit
+import traceback
+
+from funlib import *
+from classes import *
+import net
+import simulate
+import solver
+from gamerules import GameRules, compileRules
+
+# Benchmarks for the rules engine. Run from the repository root with `python test/bench.py`.
+
+
+def greedyPartition(cards: list[ServerCard], rules: GameRules):
+    # the old approach: repeatedly play the first meld findNextMeld suggests
+    hand = cards.copy()
+    with contextlib.redirect_stdout(io.StringIO()):
+        meld = findNextMeld(hand, rules, None)
+        while meld is not None:
+            for card in meld:
+                hand.remove(card)
+            meld = findNextMeld(hand, rules, None)
+    return sum(scoreValue(card, rules) for card in hand)
+
+
+def benchPartition(rounds: int = 20):
+    print("Hand partitioning: greedy findNextMeld loop vs. solver.solveHand")
+    print(f"{'rules':<14}{'cards':>6}{'jokers':>7}{'greedy ms':>11}{'solver ms':>11}{'greedy pts':>12}{'solver pts':>12}")
+    rng = random.Random(0)
+    deck = newDeck(2, 0)
+    variants = {
+        "default": GameSettings(),
+        "duplicate set": GameSettings(allow_set_duplicate_suit=True),
+        "mixed run": GameSettings(allow_run_mixed_suit=True),
+        "limit 4": GameSettings(limit_meld_size=4),
+    }
+    for name, settings in variants.items():
+        rules = compileRules(settings)
+        for size, jokers in [(7, 0), (11, 1), (15, 2), (20, 3), (30, 4), (30, 6)]:
+            greedyTime = solverTime = 0.0
+            greedyScore = solverScore = 0
+            for _ in range(rounds):
+                hand = rng.sample(deck, size - jokers) + \
+                    [ServerCard(CardFace("joker", "W")) for _ in range(jokers)]
+                start = time.perf_counter()
+                greedyScore += greedyPartition(hand, rules)
+                greedyTime += time.perf_counter() - start
+                start = time.perf_counter()
+                solverScore += solver.solveHand(hand, rules).score
+                solverTime += time.perf_counter() - start
+            print(f"{name:<14}{size:>6}{jokers:>7}{greedyTime / rounds * 1000:>11.2f}{solverTime / rounds * 1000:>11.2f}"
+                  f"{greedyScore / rounds:>12.1f}{solverScore / rounds:>12.1f}")
+
+
+def checkedLays(card: ServerCard, melds: list[Stack], rules: GameRules, runsOnly: bool):
+    # the old approach: check every meld with the card added
+    return [i for i, meld in enumerate(melds)
+            if checkLegal(meld.cards + [card], rules) and (not runsOnly or checkRun(meld.cards + [card], rules))]
+
+
+def benchLays(rounds: int = 200):
+    print("Lay lookup: checkLegal per meld vs. accepts index")
+    print(f"{'melds':>6}{'checked us':>12}{'indexed us':>12}")
+    rng = random.Random(0)
+    rules = compileRules(GameSettings())
+    deck = newDeck(2, 4)
+    candidates = findRuns(deck, rules) + findSets(deck, rules)
+    for count in [2, 5, 10, 20]:
+        checkedTime = indexedTime = 0.0
+        for _ in range(rounds):
+            melds = [Stack.of(list(meld)) for meld in rng.sample(candidates, count)]
+            for meld in melds:
+                meld.acceptsFor(rules)
+            hand = rng.sample(deck, 10)
+            start = time.perf_counter()
+            checked = [checkedLays(card, melds, rules, runsOnly) for card in hand for runsOnly in (True, False)]
+            checkedTime += time.perf_counter() - start
+            start = time.perf_counter()
+            indexed = [findLays(card, melds, rules, runsOnly) for card in hand for runsOnly in (True, False)]
+            indexedTime += time.perf_counter() - start
+            assert checked == indexed
+        print(f"{count:>6}{checkedTime / rounds * 1e6:>12.1f}{indexedTime / rounds * 1e6:>12.1f}")
+
+
+
+def benchStack(rounds: int = 5):
+    print("Stack moves: play through a whole deck, drawing into a hand and discarding from it")
+    print(f"{'decks':>6}{'cards':>7}{'ms':>9}")
+    for decks in [2, 8, 32]:
+        elapsed = 0.0
+        for _ in range(rounds):
+            deck = Stack(decks, True)
+            hand = Stack(0, False)
+            discard = Stack(0, False)
+            for card in deck.cards[:10]:
+                hand.insert([card], 0)
+            deck.remove(hand.cards)
+            start = time.perf_counter()
+            while len(deck.cards) > 0:
+                card = deck.assertedTop()
+                deck.remove([card])
+                hand.insert([card], len(hand.cards) // 2)
+                card = hand.cards[len(hand.cards) // 3]
+                hand.remove([card])
+                discard.insert([card], len(discard.cards))
+            elapsed += time.perf_counter() - start
+        print(f"{decks:>6}{decks * 54:>7}{elapsed / rounds * 1000:>9.2f}")
+
+
+def assertedParse(data: str):
+    # the old approach: a chain of asserts per action, with the traceback printed whenever one fails
+    try:
+        o = json.loads(data)
+        assert isinstance(o, dict)
+        assert o["type"] in actionTypeMap
+        if o["type"] == "lay":
+            assert isinstance(o["meld_number"], int)
+            assert isinstance(o["card_ids"], list)
+            assert len(o["card_ids"]) > 0
+            assert all(isinstance(card_id, str) for card_id in o["card_ids"])
+            return LayAction(o["card_ids"], o["meld_number"])
+        assert isinstance(o["card_id"], str)
+        return DiscardAction(o["card_id"])
+    except Exception:
+        traceback.format_exc()
+        return None
+
+
+def benchDecode(rounds: int = 20000):
+    print("Action decoding: asserts and tracebacks vs. schema decoders")
+    print(f"{'action':<16}{'asserted us':>13}{'schema us':>11}")
+    actions = {
+        "valid lay": '{"type": "lay", "card_ids": ["0a1b2c3d", "4e5f6g7h"], "meld_number": 2}',
+        "bad lay": '{"type": "lay", "card_ids": ["0a1b2c3d", 7], "meld_number": 2}',
+        "valid discard": '{"type": "discard", "card_id": "0a1b2c3d"}',
+        "bad discard": '{"type": "discard"}',
+    }
+    for name, data in actions.items():
+        # the best of a few runs, since each one is short
+        asserted = min(timeit.repeat(lambda: assertedParse(data), number=rounds, repeat=5))
+        schema = min(timeit.repeat(lambda: net.parseAction(data), number=rounds, repeat=5))
+        print(f"{name:<16}{asserted / rounds * 1e6:>13.2f}{schema / rounds * 1e6:>11.2f}")
+
+
+def benchSelfPlay(games: int = 200):
+    print("Self-play: AI-only games, one process per CPU")
+    variants = {
+        "default": GameSettings(),
+        "mixed run": GameSettings(allow_run_mixed_suit=True, require_end_discard=True),
+        "limit 4": GameSettings(limit_meld_size=4, ace_rank="high"),
+    }
+    print(f"{'rules':<14}{'games/s':>9}{'turns/s':>9}{'turns':>7}{'no winner':>11}")
+    for name, settings in variants.items():
+        results, elapsed, _ = simulate.simulate(games, settings, workers=os.cpu_count() or 1)
+        turns = sum(result.turns for result in results)
+        stalled = sum(result.winner is None for result in results)
+        print(f"{name:<14}{games / elapsed:>9.1f}{turns / elapsed:>9.1f}{turns / games:>7.1f}{stalled:>11}")
+
+
+if __name__ == '__main__':
+    benchPartition()
+    benchLays()
+    benchStack()
+    benchDecode()
+    benchSelfPlay()
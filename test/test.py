@@ -2,12 +2,41 @@ import sys
 sys.path.append("../")
 sys.path.append("./")
 import app
+import asyncapp
 
 from funlib import *
 from classes import *
+import cardcodes
+import events
+import net
+import outbox
+import simulate
+import solver
+import wire
+from actor import Actor
+from analysis import HandAnalysis
+from cardids import CardIDs, redeckIDs
+from gamerules import GameRules, compileRules
+from lru import LRUCache
+from meldindex import MeldAccepts, RUN, SET
+from outbox import Outbox, OutboxFull, ThreadedSocket
+from registry import Registry
+from timerwheel import TimerWheel
+from schema import DecodeError
+import aiohttp.test_utils
+import contextlib
+import io
+import itertools
+import json
+import os
+import random
+import re
+import threading
+import time
 import unittest
+import unittest.mock
 import logging
-from typing import Literal
+from typing import Literal, Optional
 
 logger = logging.getLogger()
 logger.level = logging.DEBUG
@@ -44,25 +73,25 @@ def legal(cards: list[Literal[
     "AD", "2D", "3D", "4D", "5D", "6D", "7D", "8D", "9D", "10D", "JD", "QD", "KD",
     "AC", "2C", "3C", "4C", "5C", "6C", "7C", "8C", "9C", "10C", "JC", "QC", "KC",
     "WJ"
-]], settings: GameSettings):
-    return checkLegal(c(cards), settings)
+]], rules: GameRules):
+    return checkLegal(c(cards), rules)
 
 
 class TestRules(unittest.TestCase):
 
-    normalRules = GameSettings(
-        ace_rank="low", allow_set_duplicate_suit=False, limit_meld_size=None, allow_run_mixed_suit=False)
-    aceHighRules = GameSettings(
+    normalRules = compileRules(GameSettings(
+        ace_rank="low", allow_set_duplicate_suit=False, limit_meld_size=None, allow_run_mixed_suit=False))
+    aceHighRules = compileRules(GameSettings(
         ace_rank="high"
-    )
-    dupSetRules = GameSettings(
-        allow_set_duplicate_suit=True, limit_meld_size=None)
-    mixedRunRules = GameSettings(
-        allow_run_mixed_suit=True, limit_meld_size=None)
-    limit3Rules = GameSettings(
-        allow_set_duplicate_suit=False, limit_meld_size=3)
-    limit4Rules = GameSettings(
-        allow_set_duplicate_suit=True, limit_meld_size=4)
+    ))
+    dupSetRules = compileRules(GameSettings(
+        allow_set_duplicate_suit=True, limit_meld_size=None))
+    mixedRunRules = compileRules(GameSettings(
+        allow_run_mixed_suit=True, limit_meld_size=None))
+    limit3Rules = compileRules(GameSettings(
+        allow_set_duplicate_suit=False, limit_meld_size=3))
+    limit4Rules = compileRules(GameSettings(
+        allow_set_duplicate_suit=True, limit_meld_size=4))
 
     def test_legal_normalSet(self: 'TestRules'):
         self.assertTrue(legal(["AS", "AH", "AD"], self.normalRules))
@@ -171,8 +200,8 @@ class TestRules(unittest.TestCase):
 
 
 def compare(cards: list[ServerCard], target: list[ServerCard], silent: bool = False):
-    sortStack(cards, GameSettings())
-    sortStack(target, GameSettings())
+    sortStack(cards, compileRules(GameSettings()))
+    sortStack(target, compileRules(GameSettings()))
     ok = True
     if len(cards) != len(target):
         ok = False
@@ -241,12 +270,12 @@ def compareAll(stacks: list[list[ServerCard]], target: list[list[ServerCard]]):
 
 
 class TestAILogic(unittest.TestCase):
-    rules = GameSettings(
-        allow_run_mixed_suit=False, allow_set_duplicate_suit=False, limit_meld_size=None, require_end_discard=False)
-    discardReqiredRules = GameSettings(
-        allow_run_mixed_suit=False, allow_set_duplicate_suit=False, limit_meld_size=None, require_end_discard=True)
-    limitedRules = GameSettings(
-        allow_run_mixed_suit=False, allow_set_duplicate_suit=False, limit_meld_size=4, require_end_discard=False)
+    rules = compileRules(GameSettings(
+        allow_run_mixed_suit=False, allow_set_duplicate_suit=False, limit_meld_size=None, require_end_discard=False))
+    discardReqiredRules = compileRules(GameSettings(
+        allow_run_mixed_suit=False, allow_set_duplicate_suit=False, limit_meld_size=None, require_end_discard=True))
+    limitedRules = compileRules(GameSettings(
+        allow_run_mixed_suit=False, allow_set_duplicate_suit=False, limit_meld_size=4, require_end_discard=False))
 
     def test_canWin(self: 'TestAILogic'):
         self.assertTrue(canWinWith(c(["AH", "AD", "AC", "AS"]), 4, self.rules))
@@ -360,5 +389,845 @@ class TestAILogic(unittest.TestCase):
         self.assertIsNone(i)
 
 
+    def test_findLayPlan_chain(self: 'TestAILogic'):
+        # the nine only fits once the eight has been laid
+        cards = c(["9S", "2C", "8S"])
+        plan = findLayPlan(cards, [Stack.of(c(["5S", "6S", "7S"]))], self.rules, None)
+        self.assertEqual(plan, [(cards[2], 0), (cards[0], 0)])
+
+    def test_findLayPlan_keepsDiscard(self: 'TestAILogic'):
+        cards = c(["8S", "9S"])
+        plan = findLayPlan(cards, [Stack.of(c(["5S", "6S", "7S"]))], self.discardReqiredRules, None)
+        self.assertEqual(plan, [(cards[0], 0)])
+
+    def test_findLayPlan_wildsLast(self: 'TestAILogic'):
+        cards = c(["WJ", "4C"])
+        plan = findLayPlan(cards, [Stack.of(c(["4H", "4D", "4S"])), Stack.of(c(["5S", "6S", "7S"]))], self.rules, None)
+        self.assertEqual(plan, [(cards[1], 0), (cards[0], 1)])
+
+    def test_findLayPlan_wildsPreferRuns(self: 'TestAILogic'):
+        # like findNextPreferredLay always has, wilds go onto the first run that takes them, then the first set
+        cards = c(["WJ", "WJ"])
+        melds = [Stack.of(c(["4H", "4D", "4S"])), Stack.of(c(["5S", "6S", "7S"])), Stack.of(c(["9H", "10H", "JH"]))]
+        self.assertEqual(findLayPlan(cards, melds, self.rules, None), [(cards[0], 1), (cards[1], 1)])
+        # once the first run is full, the next wild goes onto the next run, and only then onto a set
+        self.assertEqual(findLayPlan(cards, melds, self.limitedRules, None), [(cards[0], 1), (cards[1], 2)])
+        self.assertEqual(findLayPlan(cards, melds[:2], self.limitedRules, None), [(cards[0], 1), (cards[1], 0)])
+
+    def test_findLayPlan_leavesMeldsAlone(self: 'TestAILogic'):
+        meld = Stack.of(c(["5S", "6S", "7S"]))
+        findLayPlan(c(["8S", "9S"]), [meld], self.rules, None)
+        self.assertEqual(len(meld.cards), 3)
+        self.assertEqual(meld.acceptsFor(self.rules).get(c(["9S"])[0].code), 0)
+
+
+class TestCardCodes(unittest.TestCase):
+
+    def test_roundTrip(self: 'TestCardCodes'):
+        for card in newDeck(1, 2):
+            face = cardcodes.decodeFace(card.code)
+            self.assertEqual((face.suit, face.rank),
+                             (card.face.suit, card.face.rank))
+
+    def test_jokerCode(self: 'TestCardCodes'):
+        self.assertEqual(c(["WJ"])[0].code, cardcodes.JOKER)
+
+    def test_rankValue_ace(self: 'TestCardCodes'):
+        self.assertEqual(rankValue(c(["AS"])[0], compileRules(GameSettings(ace_rank="low"))), 1)
+        self.assertEqual(rankValue(c(["AS"])[0], compileRules(GameSettings(ace_rank="high"))), 14)
+
+    def test_scoreValue(self: 'TestCardCodes'):
+        rules = compileRules(GameSettings(ace_rank="low"))
+        self.assertEqual([scoreValue(card, rules) for card in c(["AS", "7H", "10D", "KC", "WJ"])],
+                         [1, 7, 10, 10, 15])
+
+    def test_findRuns_gapFilledByWild(self: 'TestCardCodes'):
+        compareAll(findRuns(c(["4S", "6S", "WJ", "9H"]), compileRules(GameSettings())), [
+            c(["4S", "WJ", "6S"]),
+        ])
+
+    def test_findRuns_duplicateStarts(self: 'TestCardCodes'):
+        cards = c(["4S", "4S", "5S", "6S"])
+        runs = findRuns(cards, compileRules(GameSettings()))
+        self.assertEqual(len(runs), 2)
+        self.assertIs(runs[0][0], cards[0])
+        self.assertIs(runs[1][0], cards[1])
+
+    def test_findSets_duplicateSuit(self: 'TestCardCodes'):
+        compareAll(findSets(c(["8S", "8S", "8H"]), compileRules(GameSettings(allow_set_duplicate_suit=True))), [
+            c(["8S", "8S", "8H"]),
+        ])
+        compareAll(findSets(c(["8S", "8S", "8H"]), compileRules(GameSettings(allow_set_duplicate_suit=False))), [])
+
+
+class TestSolver(unittest.TestCase):
+    rules = compileRules(GameSettings(
+        allow_run_mixed_suit=False, allow_set_duplicate_suit=False, limit_meld_size=None, require_end_discard=False))
+
+    def test_beatsGreedy(self: 'TestSolver'):
+        # the greedy approach plays the 4-card run first, stranding two sevens
+        partition = solver.solveHand(
+            c(["4H", "5H", "6H", "7H", "7S", "7D"]), self.rules)
+        self.assertEqual(partition.score, 0)
+        compareAll(partition.melds, [
+            c(["4H", "5H", "6H"]),
+            c(["7H", "7S", "7D"])
+        ])
+
+    def test_deadwood(self: 'TestSolver'):
+        partition = solver.solveHand(c(["AH", "AD", "AC", "KS", "2C"]), self.rules)
+        compare(partition.deadwood, c(["KS", "2C"]))
+        self.assertEqual(partition.score, 12)
+
+    def test_wilds(self: 'TestSolver'):
+        partition = solver.solveHand(c(["3S", "5S", "WJ", "9H", "9D", "WJ"]), self.rules)
+        self.assertEqual(partition.score, 0)
+
+    def test_reserve(self: 'TestSolver'):
+        partition = solver.solveHand(c(["AH", "AD", "AC", "AS"]), self.rules, 1)
+        self.assertEqual(len(partition.deadwood), 1)
+        self.assertEqual(len(partition.melds), 1)
+
+    def test_noWildMelds(self: 'TestSolver'):
+        partition = solver.solveHand(c(["5H", "WJ", "WJ", "KC"]), self.rules, 0, False)
+        self.assertEqual(partition.melds, [])
+
+    def test_handValue_laysOnTable(self: 'TestSolver'):
+        self.assertEqual(handValue(c(["4S", "9H", "9D", "9C"]), [
+            Stack.of(c(["AS", "2S", "3S"]))
+        ], self.rules), 0)
+
+
+class TestGameRules(unittest.TestCase):
+
+    def test_sharedBetweenEqualSettings(self: 'TestGameRules'):
+        rules = compileRules(GameSettings(ace_rank="high", hand_size=7))
+        self.assertIs(compileRules(GameSettings(ace_rank="high", hand_size=11)), rules)
+        self.assertIsNot(compileRules(GameSettings(ace_rank="low")), rules)
+        self.assertIsNot(compileRules(GameSettings(ace_rank="high", require_end_discard=True)), rules)
+
+    def test_immutable(self: 'TestGameRules'):
+        rules = compileRules(GameSettings())
+        with self.assertRaises(AttributeError):
+            rules.aceHigh = True  # type: ignore
+
+    def test_checkLegal(self: 'TestGameRules'):
+        rules = compileRules(GameSettings(limit_meld_size=3))
+        self.assertTrue(rules.checkLegal([card.code for card in c(["5S", "6S", "WJ"])]))
+        self.assertFalse(rules.checkLegal([card.code for card in c(["5S", "6S", "7S", "8S"])]))
+        self.assertFalse(rules.checkLegal([card.code for card in c(["5S", "6S"])]))
+
+    def test_sortMeld(self: 'TestGameRules'):
+        rules = compileRules(GameSettings(ace_rank="high"))
+        self.assertEqual([card.face.rank + card.face.suit[0] for card in rules.sortMeld(c(["WJ", "AS", "KS", "QH", "QS"]))],
+                         ["Qh", "Qs", "Ks", "As", "Wj"])
+
+    def test_sortHand(self: 'TestGameRules'):
+        rules = compileRules(GameSettings(ace_rank="low"))
+        self.assertEqual([card.face.rank + card.face.suit[0] for card in rules.sortHand(c(["WJ", "AS", "KH", "2C", "AH"]))],
+                         ["Ah", "Kh", "2c", "As", "Wj"])
+
+
+class TestMeldAccepts(unittest.TestCase):
+    rules = compileRules(GameSettings())
+
+    def accepted(self: 'TestMeldAccepts', accepts: MeldAccepts, cards: list[ServerCard]):
+        return [accepts.get(card.code) for card in cards]
+
+    def test_runEnds(self: 'TestMeldAccepts'):
+        accepts = MeldAccepts(c(["5S", "6S", "7S"]), self.rules)
+        self.assertEqual(self.accepted(accepts, c(["4S", "8S", "9S", "8H", "WJ"])), [RUN, RUN, 0, 0, RUN])
+
+    def test_runGapFilled(self: 'TestMeldAccepts'):
+        accepts = MeldAccepts(c(["5S", "WJ", "7S"]), self.rules)
+        self.assertEqual(self.accepted(accepts, c(["6S", "4S", "8S", "3S"])), [RUN, RUN, RUN, 0])
+
+    def test_setSuits(self: 'TestMeldAccepts'):
+        accepts = MeldAccepts(c(["9H", "9D", "9C"]), self.rules)
+        self.assertEqual(self.accepted(accepts, c(["9S", "9H", "10S", "WJ"])), [SET, 0, 0, SET])
+
+    def test_fullSetRejectsWild(self: 'TestMeldAccepts'):
+        self.assertEqual(MeldAccepts(c(["9H", "9D", "9C", "9S"]), self.rules).get(cardcodes.JOKER), 0)
+        self.assertEqual(findLays(c(["WJ"])[0], [Stack.of(c(["9H", "9D", "9C", "9S"]))], self.rules, False), [])
+
+    def test_add(self: 'TestMeldAccepts'):
+        accepts = MeldAccepts(c(["5S", "6S", "7S"]), self.rules).add(c(["8S"]))
+        self.assertEqual(self.accepted(accepts, c(["8S", "9S", "4S"])), [0, RUN, RUN])
+
+    def test_limit(self: 'TestMeldAccepts'):
+        accepts = MeldAccepts(c(["5S", "6S", "7S"]), compileRules(GameSettings(limit_meld_size=3)))
+        self.assertEqual(accepts.faces, {})
+
+
+class TestHandAnalysis(unittest.TestCase):
+    rules = compileRules(GameSettings(
+        allow_run_mixed_suit=False, allow_set_duplicate_suit=False, limit_meld_size=None, require_end_discard=False))
+
+    def assertSameMelds(self: 'TestHandAnalysis', melds: list[list[ServerCard]], target: list[list[ServerCard]]):
+        # extra wilds aren't real cards, so melds are compared by face
+        def faces(melds: list[list[ServerCard]]):
+            return sorted(sorted(card.face.rank + card.face.suit for card in meld) for meld in melds)
+        self.assertEqual(faces(melds), faces(target))
+
+    def test_melds(self: 'TestHandAnalysis'):
+        cards = c(["AH", "AD", "AC", "AS", "9D", "3S", "4S", "5S", "WJ"])
+        self.assertSameMelds(HandAnalysis(cards, self.rules).melds(), findMelds(cards, self.rules, None))
+
+    def test_extraCardAndWild(self: 'TestHandAnalysis'):
+        cards = c(["4S", "6S", "9D", "9H", "KC"])
+        extra = c(["5S"])[0]
+        self.assertSameMelds(HandAnalysis(cards, self.rules).melds(extra, 1),
+                             findMelds(cards + [extra] + c(["WJ"]), self.rules, None))
+
+    def test_updates(self: 'TestHandAnalysis'):
+        cards = c(["4S", "5S", "9D", "9H", "KC"])
+        hand = HandAnalysis(cards, self.rules)
+        self.assertEqual(hand.meldCount(), 0)
+        drawn = c(["6S"])[0]
+        hand.addCard(drawn, 2)
+        self.assertSameMelds(hand.melds(), [c(["4S", "5S", "6S"])])
+        hand.removeCards([cards[0], cards[1], drawn])
+        self.assertEqual(hand.meldCount(), 0)
+        self.assertEqual(hand.meldCount(c(["9S"])[0]), 1)
+
+    def test_meldPlan(self: 'TestHandAnalysis'):
+        cards = c(["4H", "5H", "6H", "7H", "7S", "7D", "KC"])
+        self.assertSameMelds(HandAnalysis(cards, self.rules).meldPlan(None), [
+            c(["4H", "5H", "6H"]),
+            c(["7H", "7S", "7D"])
+        ])
+
+
+class TestLegalCache(unittest.TestCase):
+
+    def test_evictsLeastRecentlyUsed(self: 'TestLegalCache'):
+        cache: LRUCache[bool] = LRUCache(2)
+        cache.put("a", True)
+        cache.put("b", False)
+        self.assertEqual(cache.get("a"), True)
+        cache.put("c", True)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), True)
+        info = cache.info()
+        self.assertEqual((info["hits"], info["misses"], info["evictions"]), (2, 1, 1))
+
+    def test_countsEveryLookupAcrossThreads(self: 'TestLegalCache'):
+        cache: LRUCache[int] = LRUCache(8)
+
+        def lookUp(offset: int):
+            for i in range(2000):
+                if cache.get((offset + i) % 16) is None:
+                    cache.put((offset + i) % 16, i)
+
+        threads = [threading.Thread(target=lookUp, args=(offset,)) for offset in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        info = cache.info()
+        self.assertEqual(info["hits"] + info["misses"], 8 * 2000)
+        self.assertEqual(info["size"], 8)
+
+    def test_sharedAcrossOrder(self: 'TestLegalCache'):
+        legalCache.clear()
+        self.assertTrue(checkLegal(c(["5S", "6S", "7S"]), compileRules(GameSettings())))
+        self.assertTrue(checkLegal(c(["7S", "5S", "6S"]), compileRules(GameSettings())))
+        self.assertEqual(legalCache.info()["hits"], 1)
+
+    def test_keyedBySettings(self: 'TestLegalCache'):
+        legalCache.clear()
+        self.assertFalse(checkLegal(c(["AS", "2D", "3H"]), compileRules(GameSettings(allow_run_mixed_suit=False))))
+        self.assertTrue(checkLegal(c(["AS", "2D", "3H"]), compileRules(GameSettings(allow_run_mixed_suit=True))))
+        self.assertEqual(legalCache.info()["hits"], 0)
+
+
+
+class _FakeSocket:
+    def __init__(self):
+        self.sent: list = []
+
+    def send(self, data):
+        self.sent.append(data)
+
+    def close(self):
+        pass
+
+
+class _GameTestCase(unittest.TestCase):
+    # sets up lobbies and games between fake connections, and tears them down once the test is over
+
+    def connect(self: '_GameTestCase', sock: Optional[net.Socket] = None, binary: bool = False):
+        connection = net.Connection(sock if sock is not None else _FakeSocket(), binary)  # type: ignore
+        self.addCleanup(net.removeConnection, connection.id)
+        return connection
+
+    def joinLobby(self: '_GameTestCase', connections: list[net.Connection], aiPlayers: int = 0):
+        # puts every connection in the lobby of the first one, along with some AI players
+        lobby = connections[0].lobby
+        for connection in connections[1:]:
+            lobby.addPlayer(connection)
+        for _ in range(aiPlayers):
+            lobby.addAIPlayer()
+        return lobby
+
+    def newGame(self: '_GameTestCase', connections: list[net.Connection], aiPlayers: int = 0, start: bool = True):
+        # a game between the connections and some AI players, with nothing sent to the connections yet
+        # AI turns are played by whoever ends the turn before them, so they're over once that returns
+        game = Game(self.joinLobby(connections, aiPlayers))
+        self.addCleanup(self.endGame, game)
+        game.scheduler.background = False
+        if start:
+            game.start()
+        for connection in connections:
+            connection.sock.sent.clear()  # type: ignore
+        return game
+
+    def endGame(self: '_GameTestCase', game: Game):
+        # ends a game on its actor, unless it has already ended
+        game.actor.submit(lambda: games.get(game.net) is game and game.end(None)).result(5)
+
+
+class TestStack(unittest.TestCase):
+
+    def test_removeKeepsOrder(self: 'TestStack'):
+        cards = c(["AS", "2S", "3S", "4S", "5S"])
+        stack = Stack.of(cards.copy())
+        stack.remove([cards[3], cards[1]])
+        self.assertEqual(stack.cards, [cards[0], cards[2], cards[4]])
+        stack.remove([cards[4]])
+        self.assertEqual(stack.cards, [cards[0], cards[2]])
+        self.assertNotIn(cards[4], stack)
+        self.assertIn(cards[0], stack)
+
+    def test_insertMovesCards(self: 'TestStack'):
+        cards = c(["AS", "2S", "3S", "4S"])
+        stack = Stack.of(cards[:3])
+        stack.insert([cards[3]], 1)
+        self.assertEqual(stack.cards, [cards[0], cards[3], cards[1], cards[2]])
+        # inserting a card that's already in the stack moves it
+        stack.insert([cards[0]], 3)
+        self.assertEqual(stack.cards, [cards[3], cards[1], cards[2], cards[0]])
+        stack.insert(c(["5S", "6S"]), 99)
+        self.assertEqual(len(stack.cards), 6)
+
+    def test_sortedPositionMatchesScan(self: 'TestStack'):
+        rng = random.Random(0)
+        deck = newDeck(2, 4)
+        for rules in (compileRules(GameSettings()), compileRules(GameSettings(ace_rank="high"))):
+            keys = rules.handSortKeys
+            for size in range(0, 21):
+                hand = Stack.of(sorted(rng.sample(deck, size), key=lambda card: keys[card.code]))
+                card = rng.choice(deck)
+                expected = next((i for i, other in enumerate(hand.cards)
+                                 if keys[card.code] < keys[other.code]), len(hand.cards))
+                self.assertEqual(hand.sortedPosition(card, rules), expected)
+
+    def test_replacingCardsUpdatesMembers(self: 'TestStack'):
+        cards = c(["AS", "2S", "3S"])
+        stack = Stack(1, True)
+        self.assertEqual(len(stack.cards), 54)
+        stack.cards = cards[:2]
+        self.assertIn(cards[1], stack)
+        self.assertNotIn(cards[2], stack)
+
+
+class TestCardIDs(unittest.TestCase):
+
+    def test_idsAreShortAndUnique(self: 'TestCardIDs'):
+        ids = CardIDs()
+        minted = [ids.next() for _ in range(20000)]
+        self.assertEqual(len(set(minted)), len(minted))
+        for cardID in minted:
+            self.assertRegex(cardID, "^[0-9a-v]{8}$")
+
+    def test_gamesUseTheirOwnKey(self: 'TestCardIDs'):
+        first = CardIDs()
+        second = CardIDs()
+        self.assertNotEqual([first.next() for _ in range(10)], [second.next() for _ in range(10)])
+
+    def test_skipsRepeatedHashes(self: 'TestCardIDs'):
+        ids = CardIDs()
+        with unittest.mock.patch.object(ids, "_hash", side_effect=[7, 7, 7, 8]):
+            self.assertEqual([ids.next(), ids.next()], ["00000007", "00000008"])
+
+
+class TestTurnScheduler(_GameTestCase):
+
+    def startGame(self: 'TestTurnScheduler', aiPlayers: int):
+        # the deal is seeded with one in which nobody goes out during the first round of turns, ending the game early
+        self.addCleanup(random.setstate, random.getstate())
+        random.seed(0)
+        return self.newGame([self.connect()], aiPlayers)
+
+    def test_playsAITurnsUntilHumanTurn(self: 'TestTurnScheduler'):
+        game = self.startGame(3)
+        with game.lock:
+            game.players[0].skipTurn(game)
+        self.assertIs(games.get(game.net), game)
+        self.assertEqual((game.turn_player, game.turns), (0, 4))
+        self.assertFalse(game.scheduler.running)
+
+    def test_yieldsBetweenTurns(self: 'TestTurnScheduler'):
+        game = self.startGame(3)
+        game.turn_player = 1
+        game.scheduler.running = True
+        turns = game.scheduler.turns()
+        next(turns)
+        # the first AI turn has been played, and nothing past it
+        self.assertIs(games.get(game.net), game)
+        self.assertEqual((game.turn_player, game.turns), (2, 1))
+        for _ in turns:
+            pass
+        self.assertIs(games.get(game.net), game)
+        self.assertEqual((game.turn_player, game.turns), (0, 3))
+        self.assertFalse(game.scheduler.running)
+
+    def test_playsTurnsOnWorkers(self: 'TestTurnScheduler'):
+        game = self.startGame(3)
+        game.scheduler.background = True
+        with game.lock:
+            game.players[0].skipTurn(game)
+        deadline = time.monotonic() + 10
+        while game.scheduler.running and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(game.scheduler.running)
+        self.assertIs(games.get(game.net), game)
+        self.assertEqual((game.turn_player, game.turns), (0, 4))
+
+    def test_humanTurnIsNotPending(self: 'TestTurnScheduler'):
+        game = self.startGame(1)
+        self.assertFalse(game.scheduler.turnPending())
+        game.turn_player = 1
+        self.assertTrue(game.scheduler.turnPending())
+
+
+
+class TestGameIndex(_GameTestCase):
+
+    def setUp(self: 'TestGameIndex'):
+        self.connection = self.connect()
+        self.game = self.newGame([self.connection], 1)
+
+    def test_findsCardsInHand(self: 'TestGameIndex'):
+        player = self.game.playerFor(self.connection)
+        assert player is not None
+        hand = player.hand.cards
+        ids = [hand[2].id, hand[0].id, hand[2].id]
+        self.assertEqual(self.game.findCards(ids, player.hand), [hand[2], hand[0]])
+        self.assertIsNone(self.game.findCards([hand[0].id, self.game.deck.cards[0].id], player.hand))
+        self.assertIsNone(self.game.findCards(["not a card"], player.hand))
+
+    def test_followsMovesAndRedecks(self: 'TestGameIndex'):
+        game = self.game
+        top = game.deck.assertedTop()
+        game.moveCardsToDiscard([top], game.deck)
+        self.assertIs(game.cardStacks[top.id], game.discard)
+        discarded = game.discard.cards.copy()
+        game.deck.cards = []
+        oldIDs = [card.id for card in discarded]
+        game.redeck()
+        for cardID in oldIDs:
+            self.assertNotIn(cardID, game.cardsByID)
+        for card in game.deck.cards:
+            self.assertIs(game.cardStacks[card.id], game.deck)
+        self.assertIs(game.cardStacks[game.discard.cards[0].id], game.discard)
+
+
+    def test_redeckSendsNonce(self: 'TestGameIndex'):
+        game = self.game
+        game.deck.cards = []
+        self.connection.sock.sent.clear()  # type: ignore
+        count = len(game.discard.cards)
+        game.redeck()
+        event = json.loads(self.connection.sock.sent[0])  # type: ignore
+        self.assertEqual(event["type"], "redeck")
+        self.assertEqual(event["count"], count)
+        # the top card has been flipped back onto the discard pile
+        ids = redeckIDs(event["nonce"], count)
+        self.assertEqual([card.id for card in game.deck.cards] + [game.discard.cards[0].id], ids)
+
+
+class TestBroadcast(_GameTestCase):
+
+    def test_movesAreEncodedOncePerVersion(self: 'TestBroadcast'):
+        connections = [self.connect() for _ in range(3)]
+        game = self.newGame(connections, start=False)
+        encode = MoveEvent.encodeString
+        encoded = []
+
+        def counted(event):
+            encoded.append(event)
+            return encode(event)
+        owner = game.players[1]
+        with unittest.mock.patch.object(MoveEvent, "encodeString", counted):
+            game.moveCardsToHand([game.deck.assertedTop()], game.deck, owner, 0)
+        self.assertEqual(len(encoded), 2)
+        sent = [connection.sock.sent for connection in connections]  # type: ignore
+        self.assertIn('"suit"', sent[1][0])
+        self.assertNotIn('"suit"', sent[0][0])
+        self.assertIs(sent[0][0], sent[2][0])
+
+
+    def test_dealIsOneBatch(self: 'TestBroadcast'):
+        connections = [self.connect() for _ in range(2)]
+        game = self.newGame(connections, 1, start=False)
+        game.deal()
+        for connection, player in zip(connections, game.players):
+            sent = connection.sock.sent  # type: ignore
+            self.assertEqual(len(sent), 1)
+            batch = json.loads(sent[0])
+            self.assertEqual(batch["type"], "batch")
+            self.assertEqual(len(batch["events"]), 3 * game.settings.hand_size + 1)
+            for event in batch["events"]:
+                mine = event["destination"].get("player_id") == player.connection.id
+                public = event["destination"]["type"] == "discard"
+                self.assertEqual(event["cards"][0]["face"] is not None, mine or public)
+
+
+class TestWire(_GameTestCase):
+
+    def test_roundTrip(self: 'TestWire'):
+        values = [None, True, False, 0, 127, 128, 2 ** 40, -1, -300, 0.5, "", "hearts", "ünknown", [], [1, [2]],
+                  {"type": "move", "not a word": {"x": None}}]
+        for value in values:
+            self.assertEqual(wire.decode(wire.encode(value)), value)
+        event = BatchEvent([RedeckEvent("0123abcd", 104), TurnEvent("player", "draw")])
+        self.assertEqual(wire.decode(event.encodeBytes()), event.encodeObject())
+        self.assertLess(len(event.encodeBytes()), len(event.encodeString()))
+
+    def test_wordsMatchClient(self: 'TestWire'):
+        path = os.path.join(os.path.dirname(__file__), "..", "public", "js", "wire.js")
+        with open(path) as file:
+            source = file.read()
+        words = re.search(r"WORDS = \[(.*?)\n\]", source, re.DOTALL)
+        assert words is not None
+        self.assertEqual(re.findall(r'"([^"]*)"', words.group(1)), wire.WORDS)
+
+    def test_binaryConnectionsGetBytes(self: 'TestWire'):
+        connections = [self.connect(binary=binary) for binary in (False, True)]
+        game = self.newGame(connections, start=False)
+        game.broadcastMove([game.deck.assertedTop()], MoveDesinationDiscard(), True)
+        text, = connections[0].sock.sent  # type: ignore
+        data, = connections[1].sock.sent  # type: ignore
+        self.assertIsInstance(data, bytes)
+        self.assertEqual(wire.decode(data), json.loads(text))
+        action = net.parseAction(wire.encode({"type": "discard", "card_id": "abc"}), True)
+        self.assertIsInstance(action, DiscardAction)
+        # a JSON connection's actions are JSON, even when they arrive as bytes
+        self.assertIsInstance(net.parseAction(b'{"type": "start"}', False), StartAction)
+        self.assertIsInstance(net.parseAction(wire.encode({"type": "start"}), False), DecodeError)
+
+
+class TestSchema(unittest.TestCase):
+
+    def test_decodesValidActions(self: 'TestSchema'):
+        action = net.parseAction('{"type": "lay", "card_ids": ["a", "b"], "meld_number": 1}')
+        assert isinstance(action, LayAction)
+        self.assertEqual((action.card_ids, action.meld_number), (["a", "b"], 1))
+        action = net.parseAction(json.dumps({"type": "settings", "settings": GameSettings(limit_meld_size=4).encodeObject()}))
+        assert isinstance(action, SettingsAction)
+        self.assertEqual(action.settings.limit_meld_size, 4)
+        self.assertIsInstance(net.parseAction('{"type": "start"}'), StartAction)
+
+    def test_returnsErrors(self: 'TestSchema'):
+        settings = GameSettings().encodeObject()
+        cases = {
+            'not json': None,
+            '[1, 2]': None,
+            '{"type": "fly"}': "type",
+            '{"type": ["lay"]}': "type",
+            '{"type": "lay", "card_ids": [], "meld_number": 1}': "card_ids",
+            '{"type": "lay", "card_ids": ["a", 2], "meld_number": 1}': "card_ids",
+            '{"type": "lay", "card_ids": ["a"], "meld_number": true}': "meld_number",
+            '{"type": "lay", "card_ids": ["a"]}': "meld_number",
+            '{"type": "ai", "action": "multiply"}': "action",
+            json.dumps({"type": "settings", "settings": settings | {"limit_meld_size": 5}}): "settings.limit_meld_size",
+            json.dumps({"type": "settings", "settings": settings | {"ace_rank": ["low"]}}): "settings.ace_rank",
+        }
+        for data, field in cases.items():
+            error = net.parseAction(data)
+            assert isinstance(error, DecodeError), data
+            self.assertEqual(error.field, field)
+        with self.assertRaises(AssertionError):
+            GameSettings.decodeObject(settings | {"hand_size": "7"})
+
+
+class TestRejections(_GameTestCase):
+
+    def startGame(self: 'TestRejections'):
+        connections = [self.connect() for _ in range(2)]
+        game = self.newGame(connections)
+        current = game.players[game.turn_player].connection
+        return game, current, next(connection for connection in connections if connection is not current)
+
+    def test_rejectedActionsOnlyTellThePlayer(self: 'TestRejections'):
+        game, current, waiting = self.startGame()
+        events.handleAction(DrawAction(game.deck.assertedTop().id), waiting)
+        events.handleAction(DiscardAction(current.lobby.code), current)
+        events.handleAction(DrawAction("nope"), current)
+        events.handleAction(StartAction(), current)
+        self.assertEqual([json.loads(data) for data in waiting.sock.sent], [  # type: ignore
+            {"type": "error", "code": "not_your_turn", "action": "draw"}])
+        self.assertEqual([json.loads(data)["code"] for data in current.sock.sent],  # type: ignore
+                         ["not_drawn", "card_not_found", "game_started"])
+        self.assertEqual(current.rejections, {"not_drawn": 1, "card_not_found": 1, "game_started": 1})
+        self.assertFalse(game.turn_has_drawn)
+
+    def test_illegalMeldChangesNothing(self: 'TestRejections'):
+        game, current, _ = self.startGame()
+        events.handleAction(DrawAction(game.deck.assertedTop().id), current)
+        player = game.playerFor(current)
+        assert player is not None
+        hand = player.hand.cards.copy()
+        current.sock.sent.clear()  # type: ignore
+        cards = next(cards for cards in itertools.combinations(hand, 3) if not funlib.checkLegal(list(cards), game.rules))
+        events.handleAction(MeldAction([card.id for card in cards]), current)
+        events.handleAction(LayAction([hand[0].id], 5), current)
+        self.assertEqual([json.loads(data)["code"] for data in current.sock.sent],  # type: ignore
+                         ["illegal_meld", "no_such_meld"])
+        self.assertEqual(player.hand.cards, hand)
+
+    def test_tracebacksAreSampled(self: 'TestRejections'):
+        output = io.StringIO()
+        with unittest.mock.patch.object(net, "TRACEBACK_SAMPLE", 3), unittest.mock.patch.object(
+                net, "_unexpectedErrors", itertools.count()), contextlib.redirect_stderr(output), contextlib.redirect_stdout(output):
+            for _ in range(6):
+                try:
+                    raise RuntimeError("broken")
+                except RuntimeError as e:
+                    net.printSampled(e)
+        self.assertEqual(output.getvalue().count("Traceback"), 2)
+        self.assertEqual(output.getvalue().count("RuntimeError('broken')"), 4)
+
+
+class TestActors(_GameTestCase):
+
+    def test_actorRunsTasksInOrder(self: 'TestActors'):
+        actor = Actor()
+        running: list[int] = []
+        order: list[int] = []
+
+        def task(i: int):
+            running.append(i)
+            self.assertEqual(len(running), 1)
+            time.sleep(0.001)
+            order.append(i)
+            running.remove(i)
+            return i
+
+        futures = [actor.submit(task, i) for i in range(40)]
+        self.assertEqual([future.result(5) for future in futures], list(range(40)))
+        self.assertEqual(order, list(range(40)))
+
+    def test_registryOnlyDiscardsSameValue(self: 'TestActors'):
+        registry: Registry[str, object] = Registry(4)
+        first, second = object(), object()
+        self.assertTrue(registry.add("a", first))
+        self.assertFalse(registry.add("a", second))
+        self.assertFalse(registry.discard("a", second))
+        with registry.locking("b", "a"):
+            self.assertIs(registry["a"], first)
+        self.assertTrue(registry.discard("a", first))
+        self.assertNotIn("a", registry)
+        self.assertEqual(len(registry), 0)
+
+    def test_concurrentJoinsDontOverfill(self: 'TestActors'):
+        target = self.connect()
+        joining = [self.connect() for _ in range(8)]
+        code = target.lobby.code
+        futures = [net.submitMessage(connection, json.dumps({"type": "join", "code": code})) for connection in joining]
+        for future in futures:
+            assert future is not None
+            future.result(5)
+        self.assertEqual(target.lobby.playerCount(), 4)
+        self.assertEqual(sum(connection.lobby is target.lobby for connection in joining), 3)
+        self.assertEqual(sum(connection.rejections.get("cannot_join", 0) for connection in joining), 5)
+
+    def test_lobbySkipsDroppedPlayers(self: 'TestActors'):
+        staying = self.connect()
+        leaving = self.connect()
+        leaving.lobby.actor.submit(staying.lobby.addPlayer, leaving).result(5)
+        # the connection is forgotten straight away, but it's only taken out of the lobby once its actor gets to it
+        net.removeConnection(leaving.id)
+        self.assertIn(leaving.id, staying.lobby.connections)
+        future = net.submitMessage(staying, json.dumps({"type": "name", "name": "Staying"}))
+        assert future is not None
+        future.result(5)
+        self.assertEqual(staying.rejections, {})
+        event = json.loads(staying.sock.sent[-1])  # type: ignore
+        self.assertEqual([player["id"] for player in event["lobby"]["players"]], [staying.id])
+
+
+class _StalledSocket(Outbox):
+    # an outbox whose client never reads anything
+    def wake(self):
+        pass
+
+    def endFrame(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class TestOutbox(_GameTestCase):
+
+    def startGame(self: 'TestOutbox', policy: str):
+        # starts a game in which one player's outbox only has room for the start event and the deal
+        patcher = unittest.mock.patch.object(outbox, "OUTBOX_POLICY", policy)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        slow = self.connect(_StalledSocket(limit=2))
+        lobby = self.joinLobby([slow, self.connect()])
+        slow.sock.clear()  # type: ignore
+        future = net.submitMessage(slow, json.dumps({"type": "start"}))
+        assert future is not None
+        future.result(5)
+        # anything the overflow left for the actor to do is done once this runs
+        game = lobby.actor.submit(games.get, lobby.code).result(5)
+        # a game with only one player still connected has already ended
+        if game is not None:
+            self.addCleanup(self.endGame, game)
+        frames = []
+        while (data := slow.sock.take()) is not None:  # type: ignore
+            frames.append(json.loads(data))
+        return game, slow, frames
+
+    def test_outboxIsBounded(self: 'TestOutbox'):
+        sock = _StalledSocket(limit=2, maxBytes=10)
+        sock.send("a")
+        sock.send("b")
+        self.assertRaises(OutboxFull, sock.send, "c")
+        self.assertEqual([sock.take(), sock.take(), sock.take()], ["a", "b", None])
+        self.assertRaises(OutboxFull, sock.send, "x" * 11)
+        self.assertEqual(sock.peakDepth, 2)
+
+    def test_resyncSendsWholeGame(self: 'TestOutbox'):
+        resyncs = outbox.overflows.get("resync", 0)
+        game, slow, frames = self.startGame("resync")
+        self.assertEqual([frame["type"] for frame in frames], ["sync"])
+        board = frames[0]["board"]
+        cards = board["deck"] + board["discard"] + [card for player in board["players"] for card in player["hand"]]
+        self.assertEqual(sorted(card["id"] for card in cards), sorted(game.cardsByID))
+        hand = next(player["hand"] for player in board["players"] if player["id"] == slow.id)
+        self.assertTrue(all("face" in card for card in hand))
+        self.assertEqual(board["turn"]["player_id"], game.turnPlayerID())
+        self.assertEqual(outbox.overflows["resync"], resyncs + 1)
+
+    def test_coalesceJoinsWaitingEvents(self: 'TestOutbox'):
+        _, slow, frames = self.startGame("coalesce")
+        self.assertEqual([frame["type"] for frame in frames], ["batch", "turn"])
+        self.assertEqual([event["type"] for event in frames[0]["events"]], ["start", "batch"])
+        self.assertIn(slow.id, net.connections)
+
+    def waitForFrame(self: 'TestOutbox', sock: _FakeSocket):
+        deadline = time.monotonic() + 5
+        while not sock.sent and time.monotonic() < deadline:
+            time.sleep(0.001)
+        return sock.sent
+
+    def test_windowCoalescesFrames(self: 'TestOutbox'):
+        client = _FakeSocket()
+        sock = ThreadedSocket(client, window=0.05)
+        self.addCleanup(sock.close)
+        frames = outbox.framesSent
+        for event in (PingEvent(), TurnEvent("a", "draw"), PingEvent()):
+            sock.send(event.encodeString())
+        self.assertEqual([json.loads(data) for data in self.waitForFrame(client)], [
+            [{"type": "ping"}, {"type": "turn", "player_id": "a", "state": "draw"}, {"type": "ping"}]])
+        self.assertEqual(outbox.framesSent, frames + 1)
+
+    def test_endFrameSkipsWindow(self: 'TestOutbox'):
+        client = _FakeSocket()
+        sock = ThreadedSocket(client, window=60)
+        self.addCleanup(sock.close)
+        sock.send(wire.encode({"type": "ping"}))
+        sock.endFrame()
+        self.assertEqual([wire.decode(data) for data in self.waitForFrame(client)], [{"type": "ping"}])
+
+    def test_disconnectDropsSlowClient(self: 'TestOutbox'):
+        _, slow, _ = self.startGame("disconnect")
+        self.assertNotIn(slow.id, net.connections)
+        self.assertTrue(slow.sock.closed)  # type: ignore
+
+    def test_countsOverflowsAcrossThreads(self: 'TestOutbox'):
+        overflows, dropped = outbox.overflows.get("coalesce", 0), outbox.droppedEvents
+
+        def overflow():
+            for _ in range(2000):
+                outbox.countOverflow("coalesce", 1)
+
+        threads = [threading.Thread(target=overflow) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(outbox.overflows["coalesce"], overflows + 8 * 2000)
+        self.assertEqual(outbox.droppedEvents, dropped + 8 * 2000)
+
+
+class TestTimers(_GameTestCase):
+
+    def test_wheelRunsTimersWhenDue(self: 'TestTimers'):
+        # the wheel's own thread would wait an hour for its first tick, so the test turns it by hand
+        wheel = TimerWheel(tick=3600, slots=4)
+        fired: list[str] = []
+        wheel.schedule(3600, fired.append, "first")
+        wheel.schedule(3 * 3600, fired.append, "third")
+        wheel.schedule(6 * 3600, fired.append, "sixth")
+        wheel.schedule(2 * 3600, fired.append, "cancelled").cancel()
+        for tick in range(1, 7):
+            wheel.advance()
+            fired.append(str(tick))
+        self.assertEqual(fired, ["first", "1", "2", "third", "3", "4", "5", "sixth", "6"])
+
+    def test_quietClientsArePingedThenDropped(self: 'TestTimers'):
+        connection = self.connect()
+        connection.sock.sent.clear()  # type: ignore
+        net._checkActivity(connection)
+        self.assertEqual(connection.sock.sent, [])  # type: ignore
+        connection.lastActivity -= net.PING_AFTER
+        net._checkActivity(connection)
+        self.assertEqual([json.loads(data) for data in connection.sock.sent], [{"type": "ping"}])  # type: ignore
+        connection.lastActivity -= net.PING_TIMEOUT
+        with contextlib.redirect_stdout(io.StringIO()):
+            net._checkActivity(connection)
+        self.assertNotIn(connection.id, net.connections)
+
+
+class TestAsyncServer(unittest.IsolatedAsyncioTestCase):
+
+    async def test_servesStream(self: 'TestAsyncServer'):
+        async with aiohttp.test_utils.TestClient(aiohttp.test_utils.TestServer(asyncapp.makeApp())) as client:
+            page = await client.get("/")
+            self.assertIn("js/index.js", await page.text())
+            async with client.ws_connect("/stream") as first, client.ws_connect("/stream?format=binary") as second:
+                self.assertEqual((await first.receive_json())["type"], "lobby")
+                lobby = wire.decode(await second.receive_bytes())
+                assert isinstance(lobby, dict)
+                await first.send_json({"type": "join", "code": lobby["lobby"]["code"]})
+                self.assertEqual(len((await first.receive_json())["lobby"]["players"]), 2)
+                self.assertEqual(len(wire.decode(await second.receive_bytes())["lobby"]["players"]), 2)  # type: ignore
+                await second.send_bytes(wire.encode({"type": "name", "name": ""}))
+                self.assertEqual(wire.decode(await second.receive_bytes()),
+                                 {"type": "error", "code": "invalid_name", "action": "name"})
+
+
+class TestSimulator(unittest.TestCase):
+
+    def test_sameSeedPlaysSameGame(self: 'TestSimulator'):
+        with contextlib.redirect_stdout(io.StringIO()):
+            first = simulate.playGame(3, GameSettings(), 3)
+            second = simulate.playGame(3, GameSettings(), 3)
+        self.assertEqual((first.turns, first.winner), (second.turns, second.winner))
+
+    def test_stopsAfterMaxTurns(self: 'TestSimulator'):
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = simulate.playGame(0, GameSettings(limit_meld_size=3), 2, maxTurns=5)
+        self.assertLessEqual(result.turns, 5)
+        if result.winner is None:
+            self.assertEqual(result.turns, 5)
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
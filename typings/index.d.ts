@@ -131,8 +131,11 @@ declare interface Board {
  * `"move"`: Indicates that a card has been moved, either by the current player or by someone else. `card.face` being present indicates that the card is face-up.
  * `"redeck"`: Indicates that the deck has been replenished from the discard pile.
  * `"end"`: Indicates that the game has ended. The values of the remaining hands are tallied for scorekeeping.
+ * `"batch"`: Several events that the client should apply together, in order, as one step.
+ * `"error"`: Indicates that an action was rejected.
+ * `"sync"`: Replaces the whole state of the game, for a client that fell behind.
  */
-declare type GameEvent = PingEvent | LobbyEvent | StartEvent | TurnEvent | MoveEvent | RedeckEvent | EndEvent
+declare type GameEvent = PingEvent | LobbyEvent | StartEvent | TurnEvent | MoveEvent | RedeckEvent | EndEvent | BatchEvent | ErrorEvent | SyncEvent
 
 /**
  * A ping recieved from the server. Client should immediately respond with a pong action.
@@ -208,8 +211,10 @@ declare interface MoveEvent {
  */
 declare interface RedeckEvent {
     type: "redeck",
-    /** The server should generate a new list of card IDs to use for the new deck. */
-    new_card_ids: string[]
+    /** A string that the server generates for each redeck. The new card IDs are `"<nonce>-0"`, `"<nonce>-1"`, ... from the bottom of the deck up. */
+    nonce: string
+    /** The number of cards in the new deck. */
+    count: number
 }
 /**
  * Indicates that the game has ended. The values of the remaining hands are tallied for scorekeeping. The client keeps track of score.
@@ -221,6 +226,34 @@ declare interface EndEvent {
     /** A map (keyed by player ID) showing the hand values of the losing players. These point values will be added to the winner's score. "Rummy" should already be accounted for. */
     hand_values: Record<string, number>
 }
+/**
+ * Several events that the client should apply together, in order, as one step. Used to send a whole deal, or all the melds and lays of a turn, in one message.
+ */
+declare interface BatchEvent {
+    type: "batch"
+    /** The events in the batch, in the order they happened. */
+    events: GameEvent[]
+}
+/**
+ * Replaces the whole state of the game. Sent instead of the events a client missed by falling too far behind.
+ */
+declare interface SyncEvent {
+    type: "sync"
+    /** The game, as the client sees it. */
+    board: Omit<Board, "settings">
+    /** The game settings. */
+    settings: GameSettings
+}
+/**
+ * Indicates that an action was rejected, and changed nothing. Only sent to the player who took the action.
+ */
+declare interface ErrorEvent {
+    type: "error"
+    /** Why the action was rejected. */
+    code: "invalid_action" | "internal_error" | "game_started" | "no_game" | "not_your_turn" | "already_drawn" | "not_drawn" | "card_not_found" | "illegal_meld" | "no_such_meld" | "must_keep_discard" | "cannot_discard" | "invalid_name" | "cannot_join" | "not_enough_players"
+    /** The type of the action, or null if it couldn't be decoded. */
+    action: string | null
+}
 
 /**
  * A message sent to the server. Indicates an action that the client wishes to perform.